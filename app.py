@@ -3,6 +3,7 @@ import streamlit as st
 from ui_components.navigation import load_user_settings
 from utils.env_loader import load_environment_variables
 from utils.error_handlers import handle_error
+from utils.metrics import start_metrics_server
 from utils.prompt_manager import initialize_database
 from views.department_management_page import department_management_ui
 from views.main_page import main_page_app
@@ -11,6 +12,7 @@ from views.prompt_management_page import prompt_management_ui
 
 load_environment_variables()
 initialize_database()
+start_metrics_server()
 
 st.set_page_config(
     page_title="退院時サマリ作成アプリ",
@@ -31,6 +33,8 @@ if "current_page" not in st.session_state:
     st.session_state.current_page = "main"
 if "success_message" not in st.session_state:
     st.session_state.success_message = None
+if "error_message" not in st.session_state:
+    st.session_state.error_message = None
 if "available_models" not in st.session_state:
     st.session_state.available_models = []
 if "summary_generation_time" not in st.session_state:
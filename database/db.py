@@ -1,17 +1,134 @@
 import os
+import threading
 
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 
-from utils.config import MONGODB_URI
+from database.monitoring import CommandMetricsListener, PoolMetricsListener
+from database.profiler import SlowOperationListener
+from utils.config import MONGODB_ANALYTICS_URI, MONGODB_URI, MONGODB_USAGE_COLLECTION, STORAGE_BACKEND, get_config
 from utils.exceptions import DatabaseError
 from utils.env_loader import load_environment_variables
 
 load_environment_variables()
 
+# config.iniの[MONGODB]のキーと、MongoClientの引数・既定値。環境変数MONGODB_<キーの大文字>で上書きできる
+CLIENT_OPTIONS = {
+    "max_pool_size": ("maxPoolSize", int, 100),
+    "min_pool_size": ("minPoolSize", int, 0),
+    "max_idle_time_ms": ("maxIdleTimeMS", int, None),
+    "wait_queue_timeout_ms": ("waitQueueTimeoutMS", int, None),
+    "server_selection_timeout_ms": ("serverSelectionTimeoutMS", int, 5000),
+    "connect_timeout_ms": ("connectTimeoutMS", int, 5000),
+    "socket_timeout_ms": ("socketTimeoutMS", int, 30000),
+    "compressors": ("compressors", str, None),
+    "read_preference": ("readPreference", str, "primary"),
+}
+DUPLICATE_KEY_ERROR = 11000
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def get_available_compressors(compressors):
+    """
+    圧縮方式のうち、必要なパッケージがインストールされているものだけを返す関数
+    zstdはzstandard、snappyはpython-snappyが必要。zlibは標準ライブラリで常に使用できる
+    """
+    modules = {"zstd": "zstandard", "snappy": "snappy"}
+    available = []
+    for compressor in [name.strip() for name in compressors.split(",") if name.strip()]:
+        if compressor in modules:
+            try:
+                __import__(modules[compressor])
+            except ImportError:
+                print(f"MongoDBの圧縮方式{compressor}は{modules[compressor]}がないため使用しません")
+                continue
+        available.append(compressor)
+    return ",".join(available)
+
+
+def get_mongodb_settings():
+    """
+    config.iniの[MONGODB]と環境変数から、MongoClientに渡す接続プール・タイムアウト・圧縮・読み取り設定を作る関数
+    """
+    config = get_config()
+    mongodb_config = config['MONGODB'] if 'MONGODB' in config else {}
+
+    client_options = {}
+    for key, (option, value_type, default) in CLIENT_OPTIONS.items():
+        value = os.environ.get(f"MONGODB_{key.upper()}", mongodb_config.get(key))
+        if value in (None, ""):
+            value = default
+        if value is not None:
+            client_options[option] = value_type(value)
+
+    if client_options.get("compressors"):
+        client_options["compressors"] = get_available_compressors(client_options["compressors"])
+    if not client_options.get("compressors"):
+        client_options.pop("compressors", None)
+
+    warm_up = os.environ.get("MONGODB_WARM_UP", mongodb_config.get('warm_up', 'true'))
+    return client_options, str(warm_up).lower() == 'true'
+
+
+def get_analytics_read_preference():
+    """
+    統計情報の読み出しに使う読み取り設定を作る関数
+    既定はセカンダリ優先で、プライマリからmaxStalenessSeconds以上遅れたセカンダリは使わない
+    """
+    config = get_config()
+    mongodb_config = config['MONGODB'] if 'MONGODB' in config else {}
+    mode = os.environ.get("MONGODB_ANALYTICS_READ_PREFERENCE",
+                          mongodb_config.get('analytics_read_preference', 'secondaryPreferred'))
+    max_staleness = int(os.environ.get("MONGODB_ANALYTICS_MAX_STALENESS_SECONDS",
+                                       mongodb_config.get('analytics_max_staleness_seconds', 120)))
+
+    if mode not in READ_PREFERENCES:
+        raise DatabaseError(f"不明な読み取り設定です: {mode}")
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
+class ReadOnlyCollection:
+    """
+    統計情報用の読み出し専用のコレクション。集計がプライマリの書き込みや対話的な読み出しと競合しないよう
+    セカンダリから読み、誤って書き込まないよう読み出しの操作だけを公開する
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    @property
+    def name(self):
+        return self._collection.name
+
+    def find(self, *args, **kwargs):
+        return self._collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        return self._collection.find_one(*args, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        return self._collection.aggregate(*args, **kwargs)
+
+    def count_documents(self, *args, **kwargs):
+        return self._collection.count_documents(*args, **kwargs)
+
+    def estimated_document_count(self, *args, **kwargs):
+        return self._collection.estimated_document_count(*args, **kwargs)
+
 
 class DatabaseManager:
     _instance = None
     _client = None
+    _analytics_client = None
 
     @classmethod
     def get_instance(cls):
@@ -26,21 +143,56 @@ class DatabaseManager:
         if not MONGODB_URI:
             raise DatabaseError("MongoDB接続情報が設定されていません。環境変数または設定ファイルを確認してください。")
 
+        client_options, warm_up = get_mongodb_settings()
         try:
             DatabaseManager._client = MongoClient(
                 MONGODB_URI,
-                serverSelectionTimeoutMS=5000,
-                connectTimeoutMS=5000,
-                socketTimeoutMS=30000,
-                ssl=True
+                ssl=True,
+                event_listeners=[CommandMetricsListener(), PoolMetricsListener(), SlowOperationListener()],
+                **client_options
             )
         except Exception as e:
             raise DatabaseError(f"MongoDBへの接続に失敗しました: {str(e)}")
 
+        if warm_up:
+            self.warm_up()
+
+    @staticmethod
+    def warm_up():
+        """
+        起動時にpingを送り、サーバー選択とTLSハンドシェイクを最初のリクエストより前に済ませる
+        失敗しても起動は続け、実際の操作でエラーを返す
+        """
+        try:
+            DatabaseManager._client.admin.command("ping")
+        except Exception as e:
+            print(f"MongoDBのウォームアップに失敗しました: {str(e)}")
+
     @staticmethod
     def get_client():
         return DatabaseManager._client
 
+    @staticmethod
+    def get_analytics_client():
+        """
+        MONGODB_ANALYTICS_URIが設定されている場合は統計情報用のクラスターに接続し、それ以外は通常の接続を使う
+        """
+        if not MONGODB_ANALYTICS_URI:
+            return DatabaseManager._client
+
+        if DatabaseManager._analytics_client is None:
+            client_options, _ = get_mongodb_settings()
+            try:
+                DatabaseManager._analytics_client = MongoClient(
+                    MONGODB_ANALYTICS_URI,
+                    ssl=True,
+                    event_listeners=[CommandMetricsListener(), PoolMetricsListener(), SlowOperationListener()],
+                    **client_options
+                )
+            except Exception as e:
+                raise DatabaseError(f"統計情報用のMongoDBへの接続に失敗しました: {str(e)}")
+        return DatabaseManager._analytics_client
+
     def get_database(self, db_name=None):
         if db_name is None:
             db_name = os.environ.get("MONGODB_DB_NAME", "discharge_summary_app")
@@ -50,10 +202,27 @@ class DatabaseManager:
         db = self.get_database(db_name)
         return db[collection_name]
 
+    def get_analytics_collection(self, collection_name, db_name=None):
+        if db_name is None:
+            db_name = os.environ.get("MONGODB_DB_NAME", "discharge_summary_app")
+        db = self.get_analytics_client()[db_name]
+        return db.get_collection(collection_name, read_preference=get_analytics_read_preference())
+
+
+def get_database_manager():
+    """
+    STORAGE_BACKENDに応じて、MongoDBまたは組み込みのSQLiteのデータベースを返す関数
+    どちらもget_collectionで、アプリで使用する操作を持つコレクションを返す
+    """
+    if STORAGE_BACKEND == "sqlite":
+        from database.sqlite_store import SQLiteDatabase
+        return SQLiteDatabase.get_instance()
+    return DatabaseManager.get_instance()
+
 
 def get_users_collection():
     try:
-        db_manager = DatabaseManager.get_instance()
+        db_manager = get_database_manager()
         collection_name = os.environ.get("MONGODB_USERS_COLLECTION", "users")
         return db_manager.get_collection(collection_name)
     except Exception as e:
@@ -62,16 +231,92 @@ def get_users_collection():
 
 def get_usage_collection():
     try:
-        db_manager = DatabaseManager.get_instance()
-        collection_name = "summary_usage"
+        db_manager = get_database_manager()
+        collection_name = MONGODB_USAGE_COLLECTION
         return db_manager.get_collection(collection_name)
     except Exception as e:
         raise DatabaseError(f"使用状況コレクションの取得に失敗しました: {str(e)}")
 
+
+def get_usage_analytics_collection():
+    """
+    統計情報の画面とエクスポートで使う、summary_usageの読み出し専用のコレクション
+    アーカイブ済みの期間を含む検索では、アーカイブ(コレクションまたはParquet)もあわせて読む
+    """
+    from database.usage_archive import get_archive_state, TieredUsageCollection
+    try:
+        db_manager = get_database_manager()
+        collection_name = MONGODB_USAGE_COLLECTION
+        usage_collection = ReadOnlyCollection(db_manager.get_analytics_collection(collection_name))
+        archive_state = get_archive_state()
+        if archive_state:
+            return TieredUsageCollection(usage_collection, archive_state)
+        return usage_collection
+    except Exception as e:
+        raise DatabaseError(f"使用状況コレクションの取得に失敗しました: {str(e)}")
+
+
 def get_settings_collection():
     try:
-        db_manager = DatabaseManager.get_instance()
+        db_manager = get_database_manager()
         collection_name = "app_settings"
         return db_manager.get_collection(collection_name)
     except Exception as e:
         raise DatabaseError(f"設定コレクションの取得に失敗しました: {str(e)}")
+
+
+def get_tombstone_collection():
+    try:
+        db_manager = get_database_manager()
+        collection_name = "deleted_documents"
+        return db_manager.get_collection(collection_name)
+    except Exception as e:
+        raise DatabaseError(f"削除記録コレクションの取得に失敗しました: {str(e)}")
+
+
+_timeseries_collections = {}
+_timeseries_lock = threading.Lock()
+
+
+def is_timeseries_collection(collection):
+    """
+    時系列コレクションかどうか。コレクションの種類は起動中に変わらないため、コレクションごとに一度だけ確認する
+    """
+    if STORAGE_BACKEND == "sqlite":
+        return False
+    key = (collection.database.name, collection.name)
+    with _timeseries_lock:
+        if key not in _timeseries_collections:
+            _timeseries_collections[key] = "timeseries" in collection.options()
+        return _timeseries_collections[key]
+
+
+def insert_new_documents(collection, documents):
+    """
+    _idが同じドキュメントはすでに書き込まれたものとして読み飛ばし、残りを挿入する関数。挿入した件数を返す
+    時系列コレクションには_idの一意インデックスがないため、挿入前に同じ期間の既存の_idを確認する
+    通常のコレクションは一意インデックスの重複エラーを書き込み済みとみなす
+    """
+    documents = list({document["_id"]: document for document in documents}.values())
+    if not documents:
+        return 0
+
+    if is_timeseries_collection(collection):
+        query = {"_id": {"$in": [document["_id"] for document in documents]}}
+        dates = [document["date"] for document in documents if document.get("date")]
+        if dates:
+            # 時系列コレクションは期間で絞り込むと、対象のバケットだけを読む
+            query["date"] = {"$gte": min(dates), "$lte": max(dates)}
+        existing_ids = {document["_id"] for document in collection.find(query, {"_id": 1})}
+        documents = [document for document in documents if document["_id"] not in existing_ids]
+        if documents:
+            collection.insert_many(documents, ordered=False)
+        return len(documents)
+
+    try:
+        return len(collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if not all(error.get("code") == DUPLICATE_KEY_ERROR for error in write_errors):
+            raise
+        return e.details.get("nInserted", len(documents) - len(write_errors))
@@ -0,0 +1,106 @@
+import threading
+import weakref
+
+from pymongo import monitoring
+
+from utils.metrics import (
+    MONGO_OPERATION_LATENCY, MONGO_POOL_CHECKOUT_FAILURES, MONGO_POOL_CHECKOUT_WAIT, MONGO_POOL_CONNECTIONS
+)
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    MongoDBコマンドの所要時間をメトリクスに記録するリスナー
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_OPERATION_LATENCY.labels(event.command_name, "succeeded").observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        MONGO_OPERATION_LATENCY.labels(event.command_name, "failed").observe(event.duration_micros / 1_000_000)
+
+
+def format_address(address):
+    host, port = address
+    return f"{host}:{port}"
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    接続プールの接続数と、接続を取り出すまでの待ち時間をメトリクスに記録するリスナー
+    接続数は接続IDごとに数え、プールが閉じた後に届く接続のイベントは数えない (ゲージが負にならないように)
+    同じアドレスに複数のクライアント(統計情報用など)が接続する場合は、その合計を記録する
+    """
+    _listeners = weakref.WeakSet()
+    _lock = threading.Lock()
+
+    def __init__(self):
+        # アドレスごとに、開いている接続と使用中の接続のID
+        self._connections = {}
+        with self._lock:
+            self._listeners.add(self)
+
+    def _update(self, event, state, add):
+        address = format_address(event.address)
+        with self._lock:
+            connections = self._connections.get(address)
+            if connections is None:
+                if not add:
+                    return
+                connections = self._connections[address] = {"open": set(), "checked_out": set()}
+            if add:
+                connections[state].add(event.connection_id)
+            elif event.connection_id in connections[state]:
+                connections[state].discard(event.connection_id)
+            else:
+                return
+            self._set_gauge(address, state)
+
+    def _set_gauge(self, address, state):
+        total = sum(len(listener._connections.get(address, {}).get(state, ())) for listener in self._listeners)
+        MONGO_POOL_CONNECTIONS.labels(address, state).set(total)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        # プールがクリアされると使用中の接続も順に閉じられるため、閉じた時点で減らす
+        pass
+
+    def pool_closed(self, event):
+        address = format_address(event.address)
+        with self._lock:
+            self._connections.pop(address, None)
+            self._set_gauge(address, "open")
+            self._set_gauge(address, "checked_out")
+
+    def connection_created(self, event):
+        self._update(event, "open", add=True)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event, "checked_out", add=False)
+        self._update(event, "open", add=False)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        address = format_address(event.address)
+        MONGO_POOL_CHECKOUT_FAILURES.labels(address, str(event.reason)).inc()
+        MONGO_POOL_CHECKOUT_WAIT.labels(address).observe(event.duration)
+
+    def connection_checked_out(self, event):
+        self._update(event, "checked_out", add=True)
+        MONGO_POOL_CHECKOUT_WAIT.labels(format_address(event.address)).observe(event.duration)
+
+    def connection_checked_in(self, event):
+        self._update(event, "checked_out", add=False)
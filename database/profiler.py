@@ -0,0 +1,193 @@
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import threading
+import time
+
+from pymongo import monitoring
+
+from utils.config import MONGODB_SLOW_OP_THRESHOLD_MS, MONGODB_SLOW_OP_TOP_N, MONGODB_SLOW_OP_WINDOW_MINUTES
+
+# 接続の確認や認証など、アプリの操作ではないコマンドは記録しない
+IGNORED_COMMANDS = {
+    "hello", "ismaster", "ping", "buildinfo", "saslstart", "saslcontinue", "endsessions", "killcursors",
+}
+# コマンド名とクエリの条件が入っている引数
+SHAPE_ARGUMENTS = {
+    "find": ("filter", "sort", "projection"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"),
+}
+# 並び順と射影は値も形の一部なのでそのまま残す
+VERBATIM_ARGUMENTS = {"sort", "projection", "key"}
+MAX_SHAPES = 500
+
+
+def normalize_query_shape(value):
+    """
+    クエリの値を?に置き換え、フィールド名と演算子だけを残す関数
+    "$department"のようなフィールド参照は集計の形を表すためそのまま残す
+    """
+    if isinstance(value, dict):
+        return {key: normalize_query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [normalize_query_shape(item) for item in value]
+        return ["?"] if value else []
+    if isinstance(value, str) and value.startswith("$"):
+        return value
+    return "?"
+
+
+def get_command_shape(command_name, command):
+    """
+    コマンドから対象のコレクション名と、値を除いたクエリの形を取り出す関数
+    """
+    if command_name == "getMore":
+        return command.get("collection"), "getMore"
+
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        collection = None
+
+    if command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes", [])
+        shape = [normalize_query_shape(statement.get("q", {})) for statement in statements[:1]]
+        if len(statements) > 1:
+            shape.append(f"... {len(statements)}件")
+    elif command_name == "insert":
+        shape = f"{len(command.get('documents', []))}件"
+    else:
+        shape = {
+            argument: command[argument] if argument in VERBATIM_ARGUMENTS else normalize_query_shape(command[argument])
+            for argument in SHAPE_ARGUMENTS.get(command_name, ())
+            if argument in command
+        }
+
+    if not isinstance(shape, str):
+        shape = json.dumps(shape, ensure_ascii=False, default=str)
+    return collection, shape
+
+
+class SlowOperationProfiler:
+    """
+    MongoDBコマンドの所要時間をクエリの形ごとに集計し、直近の時間内で遅かった操作を上位N件だけ保持する
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = SlowOperationProfiler()
+        return cls._instance
+
+    def __init__(self, threshold_ms=MONGODB_SLOW_OP_THRESHOLD_MS, top_n=MONGODB_SLOW_OP_TOP_N,
+                 window_minutes=MONGODB_SLOW_OP_WINDOW_MINUTES):
+        self.threshold_ms = threshold_ms
+        self.top_n = top_n
+        self.window_seconds = window_minutes * 60
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.slowest = []
+        self.shapes = collections.OrderedDict()
+
+    def record(self, command_name, collection, shape, duration_ms, status):
+        now = time.time()
+        if duration_ms >= self.threshold_ms:
+            print(f"MongoDBの遅い操作 ({duration_ms:.0f}ms): {command_name} {collection or ''} {shape}")
+
+        with self.lock:
+            key = (command_name, collection, shape)
+            stats = self.shapes.pop(key, None) or {
+                "command": command_name, "collection": collection, "shape": shape,
+                "count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow_count": 0, "failed_count": 0,
+            }
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["slow_count"] += duration_ms >= self.threshold_ms
+            stats["failed_count"] += status == "failed"
+            # 最近使われた形を末尾に移し、上限を超えたら最も長く使われていない形から捨てる
+            self.shapes[key] = stats
+            if len(self.shapes) > MAX_SHAPES:
+                self.shapes.popitem(last=False)
+
+            operation = {
+                "timestamp": now, "command": command_name, "collection": collection, "shape": shape,
+                "duration_ms": duration_ms, "status": status,
+            }
+            self._remove_expired(now)
+            entry = (duration_ms, next(self.sequence), operation)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, entry)
+            elif duration_ms > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def _remove_expired(self, now):
+        cutoff = now - self.window_seconds
+        if self.slowest and any(entry[2]["timestamp"] < cutoff for entry in self.slowest):
+            self.slowest = [entry for entry in self.slowest if entry[2]["timestamp"] >= cutoff]
+            heapq.heapify(self.slowest)
+
+    def get_slowest_operations(self):
+        """
+        直近の時間内で遅かった操作を所要時間の長い順に返す
+        """
+        with self.lock:
+            self._remove_expired(time.time())
+            operations = [dict(entry[2]) for entry in sorted(self.slowest, reverse=True)]
+        for operation in operations:
+            operation["timestamp"] = datetime.datetime.fromtimestamp(operation["timestamp"])
+        return operations
+
+    def get_shape_stats(self):
+        """
+        クエリの形ごとの件数と所要時間を、合計時間の長い順に返す
+        """
+        with self.lock:
+            stats = [dict(item) for item in self.shapes.values()]
+        for item in stats:
+            item["avg_ms"] = item["total_ms"] / item["count"]
+        return sorted(stats, key=lambda item: item["total_ms"], reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.slowest = []
+            self.shapes.clear()
+
+
+class SlowOperationListener(monitoring.CommandListener):
+    """
+    コマンドの開始時にコレクションとクエリの形を控えておき、完了時に所要時間とあわせて記録するリスナー
+    """
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler or SlowOperationProfiler.get_instance()
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def started(self, event):
+        if event.command_name.lower() in IGNORED_COMMANDS:
+            return
+        collection, shape = get_command_shape(event.command_name, event.command)
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = (collection, shape)
+
+    def _finish(self, event, status):
+        with self.lock:
+            command_info = self.pending.pop((event.connection_id, event.request_id), None)
+        if command_info:
+            self.profiler.record(event.command_name, *command_info, event.duration_micros / 1000, status)
+
+    def succeeded(self, event):
+        self._finish(event, "succeeded")
+
+    def failed(self, event):
+        self._finish(event, "failed")
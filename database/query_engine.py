@@ -0,0 +1,289 @@
+import collections
+import datetime
+import re
+import zoneinfo
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+COMPARISON_OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+MISSING = object()
+
+
+def get_field(document, path):
+    """
+    "_id.model_detail"のようなドット区切りのパスで値を取り出す。存在しない場合はMISSINGを返す
+    """
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def to_utc_naive(value):
+    if value.tzinfo:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def sort_key(value):
+    """
+    MongoDBの型ごとの並び順 (null < 数値 < 文字列 < オブジェクト < 配列 < ObjectId < 真偽値 < 日時) に合わせた比較キー
+    """
+    if value is MISSING or value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, str(value))
+    if isinstance(value, list):
+        return (5, str(value))
+    if isinstance(value, ObjectId):
+        return (7, str(value))
+    if isinstance(value, datetime.datetime):
+        return (9, to_utc_naive(value))
+    return (10, str(value))
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compare(value, operand, operator):
+    # MongoDBと同じく、型の異なる値どうしは比較条件に一致しない
+    value_key, operand_key = sort_key(value), sort_key(operand)
+    if value is MISSING or value_key[0] != operand_key[0]:
+        return False
+    return {
+        "$gt": value_key > operand_key,
+        "$gte": value_key >= operand_key,
+        "$lt": value_key < operand_key,
+        "$lte": value_key <= operand_key,
+    }[operator]
+
+
+def values_equal(value, operand):
+    if value is MISSING:
+        return operand is None
+    if isinstance(value, list) and not isinstance(operand, list):
+        return any(values_equal(item, operand) for item in value)
+    if isinstance(value, datetime.datetime) and isinstance(operand, datetime.datetime):
+        return to_utc_naive(value) == to_utc_naive(operand)
+    return value == operand
+
+
+def match_regex(value, pattern, options=""):
+    if not isinstance(value, str):
+        return False
+    flags = re.IGNORECASE if "i" in options else 0
+    if isinstance(pattern, re.Pattern):
+        return bool(pattern.search(value))
+    return bool(re.search(pattern, value, flags))
+
+
+def match_condition(value, condition):
+    """
+    ひとつのフィールドに対する条件 ({"$gte": ..., "$lt": ...} や値そのもの) を判定する関数
+    """
+    if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+        if isinstance(condition, re.Pattern):
+            return match_regex(value, condition)
+        return values_equal(value, condition)
+
+    for operator, operand in condition.items():
+        if operator in COMPARISON_OPERATORS:
+            matched = compare(value, operand, operator)
+        elif operator == "$eq":
+            matched = values_equal(value, operand)
+        elif operator == "$ne":
+            matched = not values_equal(value, operand)
+        elif operator == "$in":
+            matched = any(values_equal(value, item) for item in operand)
+        elif operator == "$nin":
+            matched = not any(values_equal(value, item) for item in operand)
+        elif operator == "$exists":
+            matched = (value is not MISSING) == bool(operand)
+        elif operator == "$regex":
+            matched = match_regex(value, operand, condition.get("$options", ""))
+        elif operator == "$options":
+            continue
+        elif operator == "$not":
+            matched = not match_condition(value, operand)
+        elif operator == "$type":
+            if operand != "number":
+                raise OperationFailure(f"$typeは\"number\"のみ対応しています: {operand}")
+            matched = is_number(value)
+        else:
+            raise OperationFailure(f"対応していない検索条件です: {operator}")
+        if not matched:
+            return False
+    return True
+
+
+def match_document(document, query):
+    """
+    MongoDBの検索条件のうち、アプリで使用している演算子でドキュメントを判定する関数
+    """
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            matched = all(match_document(document, sub_query) for sub_query in condition)
+        elif key == "$or":
+            matched = any(match_document(document, sub_query) for sub_query in condition)
+        elif key.startswith("$"):
+            raise OperationFailure(f"対応していない検索条件です: {key}")
+        else:
+            matched = match_condition(get_field(document, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def evaluate_expression(expression, document):
+    """
+    集計の式 ("$field"、{"$ifNull": ...}、{"$dateTrunc": ...}、オブジェクト) を評価する関数
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_field(document, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate_expression(item, document) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+
+    if len(expression) == 1 and next(iter(expression)).startswith("$"):
+        operator, operand = next(iter(expression.items()))
+        if operator == "$ifNull":
+            for item in operand:
+                value = evaluate_expression(item, document)
+                if value is not MISSING and value is not None:
+                    return value
+            return None
+        if operator == "$dateTrunc":
+            return truncate_date(evaluate_expression(operand["date"], document), operand["unit"],
+                                 operand.get("timezone"))
+        raise OperationFailure(f"対応していない集計式です: {operator}")
+
+    result = {}
+    for key, item in expression.items():
+        value = evaluate_expression(item, document)
+        if value is not MISSING:
+            result[key] = value
+    return result
+
+
+def truncate_date(value, unit, timezone=None):
+    """
+    UTCの日時をタイムゾーンの時・日の区切りで切り捨て、UTCの日時で返す関数
+    """
+    if not isinstance(value, datetime.datetime):
+        return None
+    local_zone = zoneinfo.ZoneInfo(timezone) if timezone else datetime.timezone.utc
+    local_value = to_utc_naive(value).replace(tzinfo=datetime.timezone.utc).astimezone(local_zone)
+    if unit == "hour":
+        local_value = local_value.replace(minute=0, second=0, microsecond=0)
+    elif unit == "day":
+        local_value = local_value.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        raise OperationFailure(f"$dateTruncの単位はhourとdayのみ対応しています: {unit}")
+    return to_utc_naive(local_value)
+
+
+def group_documents(documents, group_stage):
+    """
+    $groupの集計 ($sum, $avg, $max, $min, $push) を行う関数
+    $percentileなどは対応せず、呼び出し側でMongoDBの古いサーバーと同じ代替処理を行う
+    """
+    groups = {}
+    for document in documents:
+        group_id = evaluate_expression(group_stage["_id"], document)
+        group_id = None if group_id is MISSING else group_id
+        key = repr(sort_key(group_id)) + repr(group_id)
+        state = groups.setdefault(key, {"_id": group_id, "values": collections.defaultdict(list)})
+        for field, accumulator in group_stage.items():
+            if field == "_id":
+                continue
+            operator, operand = next(iter(accumulator.items()))
+            if operator not in ("$sum", "$avg", "$max", "$min", "$push"):
+                raise OperationFailure(f"対応していない集計です: {operator}")
+            state["values"][field].append(evaluate_expression(operand, document))
+
+    results = []
+    for state in groups.values():
+        result = {"_id": state["_id"]}
+        for field, accumulator in group_stage.items():
+            if field == "_id":
+                continue
+            operator = next(iter(accumulator))
+            values = [value for value in state["values"][field] if value is not MISSING]
+            numbers = [value for value in values if is_number(value)]
+            present = [value for value in values if value is not None]
+            if operator == "$sum":
+                result[field] = sum(numbers)
+            elif operator == "$avg":
+                result[field] = sum(numbers) / len(numbers) if numbers else None
+            elif operator == "$max":
+                result[field] = max(present, key=sort_key) if present else None
+            elif operator == "$min":
+                result[field] = min(present, key=sort_key) if present else None
+            else:
+                result[field] = values
+        results.append(result)
+    return results
+
+
+def normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def sort_documents(documents, sort_spec):
+    # 安定ソートなので、後ろのキーから順に並べ替える
+    for field, direction in reversed(sort_spec):
+        documents.sort(key=lambda document: sort_key(get_field(document, field)), reverse=direction < 0)
+    return documents
+
+
+def apply_projection(document, projection):
+    if not projection:
+        return document
+    include_id = projection.get("_id", 1)
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    if fields and all(fields.values()):
+        projected = {key: document[key] for key in fields if key in document}
+        if include_id and "_id" in document:
+            projected = {"_id": document["_id"], **projected}
+        return projected
+    projected = {key: value for key, value in document.items() if fields.get(key, 1)}
+    if not include_id:
+        projected.pop("_id", None)
+    return projected
+
+
+def run_pipeline(documents, stages):
+    """
+    $match・$group・$sort・$limitの集計をPythonで行う関数。対応していないステージはOperationFailureにする
+    """
+    documents = list(documents)
+    for stage in stages:
+        operator, operand = next(iter(stage.items()))
+        if operator == "$match":
+            documents = [document for document in documents if match_document(document, operand)]
+        elif operator == "$group":
+            documents = group_documents(documents, operand)
+        elif operator == "$sort":
+            documents = sort_documents(documents, normalize_sort(operand))
+        elif operator == "$limit":
+            documents = documents[:operand]
+        else:
+            raise OperationFailure(f"対応していない集計ステージです: {operator}")
+    return documents
+
@@ -0,0 +1,328 @@
+import collections
+import datetime
+import os
+import re
+import sqlite3
+import threading
+
+from bson import ObjectId, json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo.errors import OperationFailure
+
+from database.query_engine import (
+    COMPARISON_OPERATORS, apply_projection, match_document, normalize_sort, run_pipeline, sort_documents, to_utc_naive
+)
+from utils.config import SQLITE_PATH
+
+JSON_OPTIONS = RELAXED_JSON_OPTIONS.with_options(tz_aware=False)
+# コレクションごとに、検索・並べ替えに使うフィールドを列として持ち、インデックスを作成する
+INDEXED_FIELDS = {
+    "prompts": ("department",),
+    "departments": ("name", "order"),
+    "app_settings": ("setting_id",),
+    "summary_usage": ("date",),
+    "summary_usage_archive": ("date",),
+    "deleted_documents": ("deleted_at",),
+}
+
+InsertOneResult = collections.namedtuple("InsertOneResult", ["inserted_id"])
+InsertManyResult = collections.namedtuple("InsertManyResult", ["inserted_ids"])
+UpdateResult = collections.namedtuple("UpdateResult", ["matched_count", "modified_count", "upserted_id"])
+DeleteResult = collections.namedtuple("DeleteResult", ["deleted_count"])
+
+
+def to_column_value(value):
+    """
+    インデックス列に保存する値。日時はISO形式の文字列にして、SQLiteで大小を比較できるようにする
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return to_utc_naive(value).isoformat()
+    return None
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SQLiteCursor:
+    """
+    find()の結果。pymongoのCursorと同じく、sort・limit・batch_sizeをつないでから反復したときに検索する
+    """
+
+    def __init__(self, collection, query=None, projection=None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self.sort_spec = []
+        self.limit_count = 0
+
+    def sort(self, key_or_list, direction=None):
+        self.sort_spec = normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit_count):
+        self.limit_count = limit_count
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        documents = self.collection.find_documents(self.query, self.sort_spec, self.limit_count)
+        return (apply_projection(document, self.projection) for document in documents)
+
+
+class SQLiteCollection:
+    """
+    ひとつのコレクションをSQLiteのひとつのテーブルに保存し、アプリで使用しているpymongoの操作を提供する
+    ドキュメント本体はExtended JSONで保存し、INDEXED_FIELDSのフィールドだけ列にしてインデックスを作成する
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.table = quote_identifier(name)
+        self.indexed_fields = INDEXED_FIELDS.get(name, ())
+        self._create_table()
+
+    def _column(self, field):
+        return quote_identifier(f"f_{field}")
+
+    def _create_table(self):
+        columns = "".join(f", {self._column(field)}" for field in self.indexed_fields)
+        with self.database.write() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (_id TEXT PRIMARY KEY, doc TEXT NOT NULL{columns})")
+            for field in self.indexed_fields:
+                index_name = quote_identifier(f"idx_{self.name}_{field}")
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.table} ({self._column(field)})")
+
+    def _row_values(self, document):
+        return (
+            str(document["_id"]),
+            json_util.dumps(document, json_options=JSON_OPTIONS, ensure_ascii=False),
+            *[to_column_value(document.get(field)) for field in self.indexed_fields],
+        )
+
+    def _build_where(self, query):
+        """
+        インデックス列で絞り込めるトップレベルの条件だけをSQLにする。残りの条件はmatch_documentで判定する
+        """
+        clauses = []
+        params = []
+        for field, condition in (query or {}).items():
+            if field == "_id" and not isinstance(condition, dict):
+                clauses.append("_id = ?")
+                params.append(str(condition))
+                continue
+            if field == "_id" and list(condition) == ["$in"] and condition["$in"]:
+                clauses.append(f"_id IN ({', '.join('?' * len(condition['$in']))})")
+                params.extend(str(value) for value in condition["$in"])
+                continue
+            if field not in self.indexed_fields:
+                continue
+            if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+                for operator, operand in condition.items():
+                    column_value = to_column_value(operand)
+                    if operator in COMPARISON_OPERATORS and column_value is not None:
+                        clauses.append(f"{self._column(field)} {COMPARISON_OPERATORS[operator]} ?")
+                        params.append(column_value)
+            elif not isinstance(condition, (dict, list, re.Pattern)):
+                column_value = to_column_value(condition)
+                if column_value is not None:
+                    clauses.append(f"{self._column(field)} = ?")
+                    params.append(column_value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def _select(self, query, sort_spec=None):
+        where, params = self._build_where(query)
+        order_by = ""
+        if sort_spec and all(field in self.indexed_fields or field == "_id" for field, _ in sort_spec):
+            order_by = " ORDER BY " + ", ".join(
+                f"{'_id' if field == '_id' else self._column(field)} {'DESC' if direction < 0 else 'ASC'}"
+                for field, direction in sort_spec
+            )
+            sort_spec = None
+        rows = self.database.connection().execute(f"SELECT doc FROM {self.table}{where}{order_by}", params)
+        documents = [document for document in (json_util.loads(row[0], json_options=JSON_OPTIONS) for row in rows)
+                     if match_document(document, query)]
+        return sort_documents(documents, sort_spec) if sort_spec else documents
+
+    def find_documents(self, query=None, sort_spec=None, limit_count=0):
+        documents = self._select(query, sort_spec)
+        return documents[:limit_count] if limit_count else documents
+
+    def find(self, filter=None, projection=None, batch_size=None, sort=None):
+        cursor = SQLiteCursor(self, filter, projection)
+        return cursor.sort(sort) if sort else cursor
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        documents = self.find_documents(filter, normalize_sort(sort) if sort else None, 1)
+        return apply_projection(documents[0], projection) if documents else None
+
+    def count_documents(self, filter=None):
+        if not filter:
+            return self.database.connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return len(self._select(filter))
+
+    def estimated_document_count(self):
+        return self.count_documents({})
+
+    def insert_one(self, document):
+        document.setdefault("_id", ObjectId())
+        with self.database.write() as connection:
+            connection.execute(self._insert_sql("INSERT"), self._row_values(document))
+        return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents, ordered=True):
+        # 同じ_idのドキュメントは、再送時の重複としてMongoDBのordered=Falseと同様に読み飛ばす
+        # inserted_idsには実際に挿入したドキュメントの_idだけを返す
+        inserted_ids = []
+        insert_sql = self._insert_sql("INSERT OR IGNORE")
+        with self.database.write() as connection:
+            for document in documents:
+                document.setdefault("_id", ObjectId())
+                if connection.execute(insert_sql, self._row_values(document)).rowcount:
+                    inserted_ids.append(document["_id"])
+        return InsertManyResult(inserted_ids)
+
+    def _insert_sql(self, verb):
+        placeholders = ", ".join("?" * (2 + len(self.indexed_fields)))
+        columns = "".join(f", {self._column(field)}" for field in self.indexed_fields)
+        return f"{verb} INTO {self.table} (_id, doc{columns}) VALUES ({placeholders})"
+
+    def _update(self, filter, update, upsert, multi):
+        for operator in update:
+            if operator not in ("$set", "$inc"):
+                raise OperationFailure(f"対応していない更新です: {operator}")
+
+        with self.database.write() as connection:
+            documents = self._select(filter)
+            if not multi:
+                documents = documents[:1]
+
+            if not documents and upsert:
+                document = {key: value for key, value in filter.items()
+                            if not key.startswith("$") and not isinstance(value, dict)}
+                document.setdefault("_id", ObjectId())
+                document.update(update.get("$set", {}))
+                for field, amount in update.get("$inc", {}).items():
+                    document[field] = document.get(field, 0) + amount
+                connection.execute(self._insert_sql("INSERT"), self._row_values(document))
+                return UpdateResult(0, 0, document["_id"])
+
+            for document in documents:
+                document.update(update.get("$set", {}))
+                for field, amount in update.get("$inc", {}).items():
+                    document[field] = document.get(field, 0) + amount
+            connection.executemany(self._insert_sql("REPLACE"), [self._row_values(document)
+                                                                 for document in documents])
+        return UpdateResult(len(documents), len(documents), None)
+
+    def update_one(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False):
+        return self._update(filter, update, upsert, multi=True)
+
+    def _delete(self, filter, multi):
+        with self.database.write() as connection:
+            documents = self._select(filter)
+            if not multi:
+                documents = documents[:1]
+            connection.executemany(f"DELETE FROM {self.table} WHERE _id = ?",
+                                   [(str(document["_id"]),) for document in documents])
+        return DeleteResult(len(documents))
+
+    def delete_one(self, filter):
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter):
+        return self._delete(filter, multi=True)
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        $match・$group・$sort・$limitに対応した集計。先頭の$matchはインデックス列での絞り込みに使う
+        """
+        stages = list(pipeline)
+        query = stages.pop(0)["$match"] if stages and "$match" in stages[0] else {}
+        return iter(run_pipeline(self._select(query), stages))
+
+
+class SQLiteDatabase:
+    """
+    単一サーバーやオフラインで使用する、SQLiteファイルに保存する組み込みのストレージ
+    接続はスレッドごとに作成し、書き込みはプロセス内でひとつずつ行う
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = SQLiteDatabase()
+        return cls._instance
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.local = threading.local()
+        self.write_lock = threading.RLock()
+        self.collections = {}
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def write(self):
+        return _WriteTransaction(self)
+
+    def get_collection(self, collection_name, db_name=None):
+        with self._instance_lock:
+            if collection_name not in self.collections:
+                self.collections[collection_name] = SQLiteCollection(self, collection_name)
+            return self.collections[collection_name]
+
+    def get_analytics_collection(self, collection_name, db_name=None):
+        # 複製がないため、統計情報も同じファイルから読む
+        return self.get_collection(collection_name, db_name)
+
+
+class _WriteTransaction:
+    """
+    読み出しから書き込みまでをひとつのトランザクションで行い、失敗した場合はロールバックする
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        self.database.write_lock.acquire()
+        self.connection = self.database.connection()
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.database.write_lock.release()
+        return False
@@ -0,0 +1,373 @@
+import datetime
+import heapq
+import itertools
+import os
+from pathlib import Path
+
+from pymongo.errors import CollectionInvalid
+
+from database.db import get_database_manager, get_settings_collection, get_usage_collection, insert_new_documents
+from database.query_engine import (
+    apply_projection, get_field, match_document, normalize_sort, run_pipeline, sort_documents, sort_key, to_utc_naive
+)
+from utils.config import STORAGE_BACKEND, get_config
+
+ARCHIVE_SETTING_ID = "usage_archive"
+
+
+def load_archive_config():
+    """
+    config.iniの[USAGE_ARCHIVE]からアーカイブの設定を読み込む関数
+    """
+    config = get_config()
+    archive_config = config['USAGE_ARCHIVE'] if 'USAGE_ARCHIVE' in config else {}
+
+    parquet_dir = archive_config.get('parquet_dir', 'archive/summary_usage')
+    if not os.path.isabs(parquet_dir):
+        parquet_dir = os.path.join(Path(__file__).parent.parent, parquet_dir)
+
+    return {
+        "months": int(archive_config.get('months', 12)),
+        "tier": archive_config.get('tier', 'collection'),
+        "collection": archive_config.get('collection', 'summary_usage_archive'),
+        "parquet_dir": parquet_dir,
+        "batch_size": int(archive_config.get('batch_size', 1000)),
+    }
+
+
+def get_archive_state():
+    """
+    アーカイブ済みの期間(archived_before より前)と保存先を返す。アーカイブしていない場合はNone
+    """
+    state = get_settings_collection().find_one({"setting_id": ARCHIVE_SETTING_ID})
+    return state if state and state.get("archived_before") else None
+
+
+def get_month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    month_index = value.year * 12 + value.month - 1 + months
+    return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_archive_cutoff(months, now=None):
+    """
+    months か月前の月初(UTC)。Parquetのファイルが月単位になるよう、月の途中では区切らない
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return add_months(get_month_start(now), -months)
+
+
+def get_parquet_path(parquet_dir, month_start):
+    return os.path.join(parquet_dir, f"summary_usage_{month_start:%Y%m}.parquet")
+
+
+def create_archive_collection(collection_name):
+    """
+    アーカイブ用のコレクションを作成する関数。MongoDBではzstdのブロック圧縮を指定し、日付のインデックスを作成する
+    """
+    db_manager = get_database_manager()
+    if STORAGE_BACKEND != "sqlite":
+        try:
+            db_manager.get_database().create_collection(
+                collection_name,
+                storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+            )
+        except CollectionInvalid:
+            pass
+        db_manager.get_collection(collection_name).create_index("date")
+    return db_manager.get_collection(collection_name)
+
+
+def get_archive_collection():
+    return get_database_manager().get_collection(load_archive_config()["collection"])
+
+
+def write_archive_collection(documents, collection):
+    # 前回途中で止まった場合は、コピー済みで元から削除していないドキュメントが重複するため_idで読み飛ばす
+    # 増分バックアップで新たにアーカイブした分を判定できるよう、移した日時を記録する
+    archived_at = datetime.datetime.now()
+    insert_new_documents(collection, [{**document, "archived_at": archived_at} for document in documents])
+
+
+def to_parquet_columns(documents):
+    """
+    フィールドがドキュメントごとに異なるため、すべてのフィールドを列にして、ないものはnullにする
+    """
+    fields = list(dict.fromkeys(field for document in documents for field in document))
+    columns = {}
+    for field in fields:
+        values = [document.get(field) for document in documents]
+        if field == "_id":
+            values = [str(value) for value in values]
+        columns[field] = values
+    return columns
+
+
+def write_archive_parquet(documents, path):
+    """
+    ひと月分のドキュメントをzstdで圧縮したParquetファイルに書き出す関数
+    前回途中で止まった月は、既存のファイルと_idで重複を除いてまとめる
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if os.path.exists(path):
+        written_ids = {str(document["_id"]) for document in documents}
+        existing = [row for row in read_parquet_documents(path) if row["_id"] not in written_ids]
+        documents = existing + documents
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    pq.write_table(pa.table(to_parquet_columns(documents)), temp_path, compression="zstd")
+    os.replace(temp_path, path)
+
+
+def read_parquet_documents(path):
+    import pyarrow.parquet as pq
+
+    # Parquetでは存在しないフィールドもnullになるため、MongoDBと同じく$existsで判定できるよう取り除く
+    return [
+        {field: value for field, value in row.items() if value is not None}
+        for row in pq.read_table(path).to_pylist()
+    ]
+
+
+def iter_parquet_documents(parquet_dir, lower=None, upper=None):
+    """
+    検索する期間と重なる月のParquetファイルだけを読み、ドキュメントを順に返す
+    """
+    if not os.path.isdir(parquet_dir):
+        return
+    for file_name in sorted(os.listdir(parquet_dir)):
+        if not (file_name.startswith("summary_usage_") and file_name.endswith(".parquet")):
+            continue
+        month_start = datetime.datetime.strptime(file_name[len("summary_usage_"):-len(".parquet")], "%Y%m")
+        if lower and add_months(month_start, 1) <= lower:
+            continue
+        if upper and month_start > upper:
+            continue
+        yield from read_parquet_documents(os.path.join(parquet_dir, file_name))
+
+
+def archive_usage(months=None, tier=None, dry_run=False):
+    """
+    作成日がmonthsか月より前の利用状況を、古い月から順にアーカイブへ移す関数
+    アーカイブへの書き込みが済んだ月だけ元のコレクションから削除するため、途中で止まっても再実行できる
+    時系列コレクションから_idを指定して削除するには、MongoDB 7.0以降が必要
+    """
+    config = load_archive_config()
+    months = config["months"] if months is None else months
+    tier = tier or config["tier"]
+    if months <= 0:
+        print("アーカイブの月数が0のため、アーカイブしません")
+        return 0
+    if tier not in ("collection", "parquet"):
+        raise ValueError(f"不明なアーカイブ先です: {tier}")
+
+    cutoff = get_archive_cutoff(months)
+    usage_collection = get_usage_collection()
+    archive_collection = create_archive_collection(config["collection"]) if tier == "collection" and not dry_run else None
+    archived_count = 0
+    search_from = None
+
+    while True:
+        date_query = {"$lt": cutoff}
+        if search_from:
+            # ドライランでは削除しないため、前の月の続きから探す
+            date_query["$gte"] = search_from
+        oldest = usage_collection.find_one({"date": date_query}, sort=[("date", 1)])
+        if not oldest:
+            break
+
+        month_start = get_month_start(to_utc_naive(oldest["date"]))
+        month_end = min(add_months(month_start, 1), cutoff)
+        month_query = {"date": {"$gte": month_start, "$lt": month_end}}
+        search_from = month_end
+
+        if dry_run:
+            count = usage_collection.count_documents(month_query)
+            print(f"{month_start:%Y-%m}: {count}件 (ドライラン)")
+            archived_count += count
+            continue
+
+        documents = list(usage_collection.find(month_query).sort("date", 1))
+        if tier == "parquet":
+            write_archive_parquet(documents, get_parquet_path(config["parquet_dir"], month_start))
+        else:
+            for start in range(0, len(documents), config["batch_size"]):
+                write_archive_collection(documents[start:start + config["batch_size"]], archive_collection)
+
+        # 統計情報はarchived_beforeより前をアーカイブだけから読むため、コピーが済んだ月ごとに境界を進めてから削除する
+        save_archive_state(month_end, tier, config)
+        for start in range(0, len(documents), config["batch_size"]):
+            ids = [document["_id"] for document in documents[start:start + config["batch_size"]]]
+            usage_collection.delete_many({"_id": {"$in": ids}})
+
+        archived_count += len(documents)
+        print(f"{month_start:%Y-%m}: {len(documents)}件をアーカイブしました")
+
+    if not dry_run:
+        save_archive_state(cutoff, tier, config)
+    return archived_count
+
+
+def save_archive_state(archived_before, tier, config):
+    state = get_archive_state() or {}
+    get_settings_collection().update_one(
+        {"setting_id": ARCHIVE_SETTING_ID},
+        {"$set": {
+            "archived_before": max(filter(None, [state.get("archived_before"), archived_before])),
+            "tier": tier,
+            "collection": config["collection"],
+            "parquet_dir": config["parquet_dir"],
+            "updated_at": datetime.datetime.now(),
+        }},
+        upsert=True
+    )
+
+
+def get_date_bounds(query):
+    """
+    検索条件のdateから期間の下限と上限を取り出す。指定がない側はNone
+    """
+    condition = (query or {}).get("date")
+    if isinstance(condition, datetime.datetime):
+        return to_utc_naive(condition), to_utc_naive(condition)
+    if not isinstance(condition, dict):
+        return None, None
+    lower = condition.get("$gte", condition.get("$gt"))
+    upper = condition.get("$lte", condition.get("$lt"))
+    return (
+        to_utc_naive(lower) if isinstance(lower, datetime.datetime) else None,
+        to_utc_naive(upper) if isinstance(upper, datetime.datetime) else None,
+    )
+
+
+def restrict_date(query, operator, value):
+    """
+    検索条件のdateに「operator value」の条件を加える。同じ演算子の条件がある場合は範囲の狭い方を使う
+    """
+    query = dict(query or {})
+    condition = query.get("date")
+    if condition is None:
+        query["date"] = {operator: value}
+    elif isinstance(condition, dict) and all(key.startswith("$") for key in condition) \
+            and isinstance(condition.get(operator, value), datetime.datetime):
+        condition = dict(condition)
+        current = to_utc_naive(condition.get(operator, value))
+        narrower = max if operator == "$gte" else min
+        condition[operator] = narrower(current, to_utc_naive(value))
+        query["date"] = condition
+    else:
+        query = {"$and": [query, {"date": {operator: value}}]}
+    return query
+
+
+class TieredCursor:
+    """
+    利用状況のコレクションとアーカイブの検索結果をまとめるカーソル。並べ替えを指定した場合は両方を並べてから順に合わせる
+    """
+
+    def __init__(self, usage_cursor, archive_documents):
+        self.usage_cursor = usage_cursor
+        self.archive_documents = archive_documents
+        self.sort_spec = []
+
+    def sort(self, key_or_list, direction=None):
+        self.sort_spec = normalize_sort(key_or_list, direction)
+        self.usage_cursor.sort(self.sort_spec)
+        return self
+
+    def batch_size(self, batch_size):
+        self.usage_cursor.batch_size(batch_size)
+        return self
+
+    def close(self):
+        self.usage_cursor.close()
+
+    def __iter__(self):
+        archive_documents = list(self.archive_documents)
+        if not self.sort_spec:
+            return itertools.chain(archive_documents, self.usage_cursor)
+
+        directions = {direction for _, direction in self.sort_spec}
+        if len(directions) > 1:
+            return iter(sort_documents(archive_documents + list(self.usage_cursor), self.sort_spec))
+
+        sort_documents(archive_documents, self.sort_spec)
+        return heapq.merge(
+            archive_documents, self.usage_cursor,
+            key=lambda document: [sort_key(get_field(document, field)) for field, _ in self.sort_spec],
+            reverse=directions.pop() < 0
+        )
+
+
+class TieredUsageCollection:
+    """
+    統計情報の読み出しで、アーカイブ済みの期間を含む検索だけアーカイブもあわせて読む読み出し専用のコレクション
+    MongoDBのアーカイブ用コレクションは$unionWithでサーバー側で集計し、Parquetは読み込んでPythonで集計する
+    archived_beforeより前はアーカイブだけから、それ以降は元のコレクションだけから読む
+    アーカイブ前のバックアップを復元して元のコレクションに同じ利用状況が戻っても、二重に集計しない
+    """
+
+    def __init__(self, usage_collection, archive_state):
+        self.usage_collection = usage_collection
+        self.archive_state = archive_state
+        self.archived_before = to_utc_naive(archive_state["archived_before"])
+
+    def reaches_archive(self, query):
+        lower, _ = get_date_bounds(query)
+        return lower is None or lower < self.archived_before
+
+    def usage_query(self, query):
+        return restrict_date(query, "$gte", self.archived_before)
+
+    def archive_query(self, query):
+        return restrict_date(query, "$lt", self.archived_before)
+
+    def iter_archive_documents(self, query, projection=None):
+        query = self.archive_query(query)
+        if self.archive_state["tier"] == "parquet":
+            lower, upper = get_date_bounds(query)
+            documents = (
+                document for document in iter_parquet_documents(self.archive_state["parquet_dir"], lower, upper)
+                if match_document(document, query)
+            )
+        else:
+            archive_collection = get_database_manager().get_analytics_collection(self.archive_state["collection"])
+            documents = archive_collection.find(query)
+        return (apply_projection(document, projection) for document in documents)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        if not self.reaches_archive(filter):
+            return self.usage_collection.find(filter, projection, **kwargs)
+        usage_cursor = self.usage_collection.find(self.usage_query(filter), projection, **kwargs)
+        return TieredCursor(usage_cursor, self.iter_archive_documents(filter, projection))
+
+    def aggregate(self, pipeline, **kwargs):
+        stages = list(pipeline)
+        query = stages[0]["$match"] if stages and "$match" in stages[0] else {}
+        if not self.reaches_archive(query):
+            return self.usage_collection.aggregate(stages, **kwargs)
+
+        rest = stages[1:] if query else stages
+        if self.archive_state["tier"] == "collection" and STORAGE_BACKEND != "sqlite":
+            union_stage = {"$unionWith": {"coll": self.archive_state["collection"],
+                                          "pipeline": [{"$match": self.archive_query(query)}]}}
+            return self.usage_collection.aggregate([{"$match": self.usage_query(query)}, union_stage] + rest, **kwargs)
+
+        documents = itertools.chain(self.usage_collection.find(self.usage_query(query)),
+                                    self.iter_archive_documents(query))
+        return iter(run_pipeline(documents, rest))
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self.usage_collection.find_one(filter, *args, **kwargs)
+
+    def count_documents(self, filter=None):
+        if not self.reaches_archive(filter):
+            return self.usage_collection.count_documents(filter or {})
+        count = self.usage_collection.count_documents(self.usage_query(filter))
+        return count + sum(1 for _ in self.iter_archive_documents(filter))
@@ -1,12 +1,20 @@
+import json
 import os
+import time
 
 import anthropic
 from anthropic import Anthropic
 
 from utils.config import CLAUDE_API_KEY, CLAUDE_MODEL, get_config
-from utils.constants import MESSAGES
-from utils.exceptions import APIError
+from utils.constants import MESSAGES, STRUCTURED_OUTPUT_INSTRUCTION
+from utils.exceptions import APIError, GenerationCancelledError
+from utils.metrics import record_provider_error, record_time_to_first_token
 from utils.prompt_manager import get_prompt_by_department
+from utils.text_processor import build_summary_json_schema
+from utils.tracing import start_span
+
+
+SUMMARY_TOOL_NAME = "record_discharge_summary"
 
 
 def initialize_claude():
@@ -20,36 +28,85 @@ def initialize_claude():
 
 
 def create_summary_prompt(medical_text, additional_info="", department="default"):
-    prompt_data = get_prompt_by_department(department)
+    with start_span("prompt_lookup", department=department):
+        prompt_data = get_prompt_by_department(department)
 
-    if not prompt_data:
-        config = get_config()
-        prompt_template = config['PROMPTS']['discharge_summary']
-    else:
-        prompt_template = prompt_data['content']
+    with start_span("prompt_assembly"):
+        if not prompt_data:
+            config = get_config()
+            prompt_template = config['PROMPTS']['discharge_summary']
+        else:
+            prompt_template = prompt_data['content']
 
-    prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
+        prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
     return prompt
 
 
-def claude_generate_summary(medical_text, additional_info="", department="default"):
+def claude_generate_summary(medical_text, additional_info="", department="default", cancel_token=None, on_chunk=None,
+                            response_sections=None, prompt=None, max_tokens=None):
     try:
         initialize_claude()
         model_name = CLAUDE_MODEL
         client = Anthropic(api_key=CLAUDE_API_KEY)
 
-        prompt = create_summary_prompt(medical_text, additional_info, department)
-
-        response = client.messages.create(
-            model=model_name,
-            max_tokens=5000,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-
-        if response.content:
-            summary_text = response.content[0].text
+        if prompt is None:
+            prompt = create_summary_prompt(medical_text, additional_info, department)
+
+        request_options = {}
+        if response_sections:
+            # ツール入力のスキーマで見出しごとのJSONを強制する
+            prompt = f"{prompt}\n\n{STRUCTURED_OUTPUT_INSTRUCTION}"
+            request_options = {
+                "tools": [{
+                    "name": SUMMARY_TOOL_NAME,
+                    "description": "退院時サマリを見出しごとに記録する",
+                    "input_schema": build_summary_json_schema(response_sections),
+                }],
+                "tool_choice": {"type": "tool", "name": SUMMARY_TOOL_NAME},
+            }
+
+        summary_parts = []
+        stream = None
+        request_start = time.perf_counter()
+        try:
+            with client.messages.stream(
+                model=model_name,
+                max_tokens=max_tokens or 5000,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                **request_options
+            ) as stream:
+                if cancel_token:
+                    # キャンセル時にHTTPストリームを閉じて生成を打ち切る
+                    cancel_token.register(stream.close)
+
+                for text in stream.text_stream:
+                    if not summary_parts:
+                        record_time_to_first_token(model_name, time.perf_counter() - request_start)
+                    summary_parts.append(text)
+                    if on_chunk:
+                        on_chunk(text)
+
+                if cancel_token and cancel_token.is_cancelled():
+                    raise GenerationCancelledError()
+
+                response = stream.get_final_message()
+        except Exception:
+            if cancel_token and cancel_token.is_cancelled():
+                input_tokens, output_tokens = get_partial_usage(stream)
+                raise GenerationCancelledError(
+                    partial_text="".join(summary_parts),
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens
+                )
+            raise
+
+        tool_inputs = [block.input for block in response.content if block.type == "tool_use"]
+        if response_sections and tool_inputs:
+            summary_text = json.dumps(tool_inputs[0], ensure_ascii=False)
+        elif response.content:
+            summary_text = "".join(summary_parts)
         else:
             summary_text = "レスポンスが空でした"
 
@@ -58,7 +115,16 @@ def claude_generate_summary(medical_text, additional_info="", department="defaul
 
         return summary_text, input_tokens, output_tokens
 
-    except APIError as e:
+    except (APIError, GenerationCancelledError) as e:
         raise e
     except Exception as e:
+        record_provider_error("claude", e)
         raise APIError(f"Claude APIでエラーが発生しました: {str(e)}")
+
+
+def get_partial_usage(stream):
+    try:
+        usage = stream.current_message_snapshot.usage
+        return usage.input_tokens, usage.output_tokens
+    except Exception:
+        return None, None
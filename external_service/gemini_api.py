@@ -1,13 +1,16 @@
 import json
 import os
+import time
 
 from google import genai
 from google.genai import types
 
 from utils.config import GEMINI_CREDENTIALS, GEMINI_MODEL, GEMINI_THINKING_BUDGET, get_config
-from utils.constants import MESSAGES
-from utils.exceptions import APIError
+from utils.constants import MESSAGES, STRUCTURED_OUTPUT_INSTRUCTION
+from utils.exceptions import APIError, GenerationCancelledError
+from utils.metrics import record_provider_error, record_time_to_first_token
 from utils.prompt_manager import get_prompt_by_department
+from utils.tracing import start_span
 
 
 def initialize_gemini():
@@ -23,57 +26,98 @@ def initialize_gemini():
 
 
 def create_summary_prompt(medical_text, additional_info="", department="default"):
-    prompt_data = get_prompt_by_department(department)
+    with start_span("prompt_lookup", department=department):
+        prompt_data = get_prompt_by_department(department)
 
-    if not prompt_data:
-        config = get_config()
-        prompt_template = config['PROMPTS']['discharge_summary']
-    else:
-        prompt_template = prompt_data['content']
+    with start_span("prompt_assembly"):
+        if not prompt_data:
+            config = get_config()
+            prompt_template = config['PROMPTS']['discharge_summary']
+        else:
+            prompt_template = prompt_data['content']
 
-    prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
+        prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
     return prompt
 
 
-def gemini_generate_summary(medical_text, additional_info="", department="default", model_name=None):
+def build_summary_schema(section_names):
+    """
+    Geminiのresponse_schemaはJSON Schemaの一部しか受け付けないため、専用のSchemaで見出しの順序も指定する
+    """
+    return types.Schema(
+        type=types.Type.OBJECT,
+        properties={section: types.Schema(type=types.Type.STRING) for section in section_names},
+        required=list(section_names),
+        property_ordering=list(section_names),
+    )
+
+
+def gemini_generate_summary(medical_text, additional_info="", department="default", model_name=None, cancel_token=None, on_chunk=None,
+                            response_sections=None, prompt=None, max_tokens=None):
     try:
         client = initialize_gemini()
         if not model_name:
             model_name = GEMINI_MODEL
 
-        prompt = create_summary_prompt(medical_text, additional_info, department)
+        if prompt is None:
+            prompt = create_summary_prompt(medical_text, additional_info, department)
 
+        config_options = {}
         if GEMINI_THINKING_BUDGET:
-            response = client.models.generate_content(
+            config_options["thinking_config"] = types.ThinkingConfig(
+                thinking_budget=GEMINI_THINKING_BUDGET
+            )
+        if max_tokens:
+            config_options["max_output_tokens"] = max_tokens
+        if response_sections:
+            prompt = f"{prompt}\n\n{STRUCTURED_OUTPUT_INSTRUCTION}"
+            config_options["response_mime_type"] = "application/json"
+            config_options["response_schema"] = build_summary_schema(response_sections)
+
+        request_start = time.perf_counter()
+        if config_options:
+            response_stream = client.models.generate_content_stream(
                 model=model_name,
                 contents=prompt,
-                config=types.GenerateContentConfig(
-                    thinking_config=types.ThinkingConfig(
-                        thinking_budget=GEMINI_THINKING_BUDGET
-                    )
-                )
+                config=types.GenerateContentConfig(**config_options)
             )
         else:
-            response = client.models.generate_content(
+            response_stream = client.models.generate_content_stream(
                 model=model_name,
                 contents=prompt
             )
 
-        if hasattr(response, 'text'):
-            summary_text = response.text
-        else:
-            summary_text = str(response)
-
+        summary_parts = []
         input_tokens = 0
         output_tokens = 0
 
-        if hasattr(response, 'usage_metadata'):
-            input_tokens = response.usage_metadata.prompt_token_count
-            output_tokens = response.usage_metadata.candidates_token_count
+        for chunk in response_stream:
+            if getattr(chunk, 'text', None):
+                if not summary_parts:
+                    record_time_to_first_token(model_name, time.perf_counter() - request_start)
+                summary_parts.append(chunk.text)
+                if on_chunk:
+                    on_chunk(chunk.text)
+
+            if getattr(chunk, 'usage_metadata', None):
+                input_tokens = chunk.usage_metadata.prompt_token_count or input_tokens
+                output_tokens = chunk.usage_metadata.candidates_token_count or output_tokens
+
+            # Geminiのストリームは外部から閉じられないため、チャンクごとにキャンセルを確認する
+            if cancel_token and cancel_token.is_cancelled():
+                response_stream.close()
+                raise GenerationCancelledError(
+                    partial_text="".join(summary_parts),
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens
+                )
+
+        summary_text = "".join(summary_parts)
 
         return summary_text, input_tokens, output_tokens
 
-    except APIError as e:
+    except (APIError, GenerationCancelledError) as e:
         raise e
     except Exception as e:
+        record_provider_error("gemini", e)
         raise APIError(f"Gemini APIでエラーが発生しました: {str(e)}")
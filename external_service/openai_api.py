@@ -1,11 +1,15 @@
 import os
+import time
 
 from openai import OpenAI
 
 from utils.config import OPENAI_API_KEY, OPENAI_MODEL, get_config
-from utils.constants import MESSAGES
-from utils.exceptions import APIError
+from utils.constants import MESSAGES, STRUCTURED_OUTPUT_INSTRUCTION
+from utils.exceptions import APIError, GenerationCancelledError
+from utils.metrics import record_provider_error, record_time_to_first_token
 from utils.prompt_manager import get_prompt_by_department
+from utils.text_processor import build_summary_json_schema
+from utils.tracing import start_span
 
 
 def initialize_openai():
@@ -19,46 +23,91 @@ def initialize_openai():
 
 
 def create_summary_prompt(medical_text, additional_info="", department="default"):
-    prompt_data = get_prompt_by_department(department)
+    with start_span("prompt_lookup", department=department):
+        prompt_data = get_prompt_by_department(department)
 
-    if not prompt_data:
-        config = get_config()
-        prompt_template = config['PROMPTS']['discharge_summary']
-    else:
-        prompt_template = prompt_data['content']
+    with start_span("prompt_assembly"):
+        if not prompt_data:
+            config = get_config()
+            prompt_template = config['PROMPTS']['discharge_summary']
+        else:
+            prompt_template = prompt_data['content']
 
-    prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
+        prompt = f"{prompt_template}\n\n【カルテ情報】\n{additional_info}\n{medical_text}"
     return prompt
 
 
-def openai_generate_summary(medical_text, additional_info="", department="default"):
+def openai_generate_summary(medical_text, additional_info="", department="default", cancel_token=None, on_chunk=None,
+                            response_sections=None, prompt=None, max_tokens=None):
     try:
         initialize_openai()
         model_name = OPENAI_MODEL
         client = OpenAI(api_key=OPENAI_API_KEY)
 
-        prompt = create_summary_prompt(medical_text, additional_info, department)
-
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": "あなたは経験豊富な医療文書作成の専門家です。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_completion_tokens=30000,
-        )
-
-        if response.choices and response.choices[0].message.content:
-            summary_text = response.choices[0].message.content
+        if prompt is None:
+            prompt = create_summary_prompt(medical_text, additional_info, department)
+
+        request_options = {}
+        if response_sections:
+            prompt = f"{prompt}\n\n{STRUCTURED_OUTPUT_INSTRUCTION}"
+            request_options["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "discharge_summary",
+                    "schema": build_summary_json_schema(response_sections),
+                    "strict": True,
+                },
+            }
+
+        summary_parts = []
+        usage = None
+        request_start = time.perf_counter()
+        try:
+            stream = client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {"role": "system", "content": "あなたは経験豊富な医療文書作成の専門家です。"},
+                    {"role": "user", "content": prompt}
+                ],
+                max_completion_tokens=max_tokens or 30000,
+                stream=True,
+                stream_options={"include_usage": True},
+                **request_options
+            )
+            if cancel_token:
+                # キャンセル時にHTTPストリームを閉じて生成を打ち切る
+                cancel_token.register(stream.close)
+
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not summary_parts:
+                        record_time_to_first_token(model_name, time.perf_counter() - request_start)
+                    summary_parts.append(chunk.choices[0].delta.content)
+                    if on_chunk:
+                        on_chunk(chunk.choices[0].delta.content)
+                if chunk.usage:
+                    usage = chunk.usage
+
+            if cancel_token and cancel_token.is_cancelled():
+                raise GenerationCancelledError()
+        except Exception:
+            if cancel_token and cancel_token.is_cancelled():
+                # OpenAIは使用トークン数を最終チャンクでしか返さない
+                raise GenerationCancelledError(partial_text="".join(summary_parts))
+            raise
+
+        if summary_parts:
+            summary_text = "".join(summary_parts)
         else:
             summary_text = "レスポンスが空でした"
 
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
+        input_tokens = usage.prompt_tokens if usage else 0
+        output_tokens = usage.completion_tokens if usage else 0
 
         return summary_text, input_tokens, output_tokens
 
-    except APIError as e:
+    except (APIError, GenerationCancelledError) as e:
         raise e
     except Exception as e:
+        record_provider_error("openai", e)
         raise APIError(f"OpenAI APIでエラーが発生しました: {str(e)}")
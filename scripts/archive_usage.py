@@ -0,0 +1,29 @@
+import argparse
+import time
+
+from database.usage_archive import archive_usage
+from utils.env_loader import load_environment_variables
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="一定期間より古いsummary_usageを圧縮したコレクションまたはParquetファイルに移します"
+    )
+    parser.add_argument("--months", type=int, help="この月数より前の利用状況を移す (省略時はconfig.iniの[USAGE_ARCHIVE])")
+    parser.add_argument("--tier", choices=["collection", "parquet"], help="アーカイブ先")
+    parser.add_argument("--dry-run", action="store_true", help="移さずに月ごとの件数だけを表示する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_environment_variables()
+
+    start_time = time.perf_counter()
+    archived_count = archive_usage(args.months, args.tier, args.dry_run)
+    print(f"{archived_count}件{'が対象です' if args.dry_run else 'をアーカイブしました'} "
+          f"({time.perf_counter() - start_time:.1f}秒)")
+
+
+if __name__ == "__main__":
+    main()
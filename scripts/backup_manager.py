@@ -1,18 +1,101 @@
+import argparse
+import collections
 import datetime
+import gzip
+import hashlib
+import io
 import json
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from database.db import DatabaseManager
+from bson import json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo import DeleteMany, ReplaceOne
+
+from database.db import (
+    DatabaseManager, get_settings_collection, get_tombstone_collection, get_usage_collection, insert_new_documents,
+    is_timeseries_collection
+)
+from database.usage_archive import get_archive_collection, get_archive_state
 from utils.env_loader import load_environment_variables
 from utils.config import get_config
-from utils.prompt_manager import get_all_departments, get_all_prompts, get_department_collection, get_prompt_collection
+from utils.prompt_manager import get_department_collection, get_prompt_collection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BACKUP_COLLECTIONS = {
+    "prompts": get_prompt_collection,
+    "departments": get_department_collection,
+    "app_settings": get_settings_collection,
+    "summary_usage": get_usage_collection,
+    "summary_usage_archive": get_archive_collection,
+}
+# manifestにpartialを記録する前は、アーカイブ用のコレクションをバックアップしていなかった
+LEGACY_BACKUP_COLLECTIONS = {"prompts", "departments", "app_settings", "summary_usage"}
+# 復元時に既存のドキュメントと突き合わせるキー
+RESTORE_KEYS = {
+    "prompts": ("department",),
+    "departments": ("name",),
+    "app_settings": ("setting_id",),
+    "summary_usage": ("_id",),
+    "summary_usage_archive": ("_id",),
+}
+TRANSACTIONAL_COLLECTIONS = {"prompts", "departments", "app_settings"}
+# 増分バックアップで前回以降の変更を判定する日時のフィールド
+WATERMARK_FIELDS = {
+    "prompts": "updated_at",
+    "departments": "updated_at",
+    "app_settings": "updated_at",
+    # 作成日時(date)は退避して後から再送した分が古くなるため、書き込んだ日時で判定する
+    "summary_usage": "inserted_at",
+    # アーカイブには古い日付の利用状況が後から追加されるため、移した日時で判定する
+    "summary_usage_archive": "archived_at",
+}
+# 書き込んだ日時を記録する前のドキュメントは、作成日時で判定する
+LEGACY_WATERMARK_FIELDS = {
+    "summary_usage": "date",
+}
+TOMBSTONES_NAME = "tombstones"
+MANIFEST_JSON_OPTIONS = RELAXED_JSON_OPTIONS.with_options(tz_aware=False)
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+MANIFEST_FILENAME = "manifest.json"
+DEFAULT_BATCH_SIZE = 1000
 
 
 def get_mongodb_connection():
     return DatabaseManager.get_instance().get_client()
 
 
+def get_backup_settings():
+    """
+    config.iniの[BACKUP]からバックアップ先・圧縮形式・バッチサイズを読み込む関数
+    """
+    config = get_config()
+    backup_config = config['BACKUP'] if 'BACKUP' in config else {}
+
+    root_dir = backup_config.get('root_dir', 'backups')
+    if not os.path.isabs(root_dir):
+        root_dir = os.path.join(Path(__file__).parent.parent, root_dir)
+
+    return {
+        "root_dir": root_dir,
+        "compression": backup_config.get('compression', 'gzip'),
+        "batch_size": int(backup_config.get('batch_size', DEFAULT_BATCH_SIZE)),
+        "overlap_minutes": int(backup_config.get('incremental_overlap_minutes', 10)),
+        "keep_daily": int(backup_config.get('keep_daily', 7)),
+        "keep_weekly": int(backup_config.get('keep_weekly', 4)),
+        "workers": int(backup_config.get('workers', 4)),
+        "partitions": int(backup_config.get('partitions', 4)),
+        "partition_min_documents": int(backup_config.get('partition_min_documents', 100000)),
+    }
+
+
 def get_backup_dir(backup_type):
     config = get_config()
     root_dir = Path(__file__).parent.parent
@@ -34,45 +117,661 @@ def get_backup_dir(backup_type):
     return default_dir
 
 
-def backup_data(data_type, backup_dir=None):
+class HashingWriter:
     """
-    データベースに保存されているデータをJSONファイルにバックアップする関数
+    書き込んだバイト列のsha256とサイズを記録しながらファイルに書き込む
     """
-    if backup_dir is None:
-        backup_dir = get_backup_dir(data_type)
 
-    os.makedirs(backup_dir, exist_ok=True)
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.size = 0
 
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{data_type}_backup_{timestamp}.json"
-    backup_path = os.path.join(backup_dir, filename)
-
-    # データタイプに応じたコレクション取得
-    if data_type == 'prompts':
-        collection = get_prompt_collection()
-        success_message = "プロンプトのバックアップが完了しました"
-    elif data_type == 'departments':
-        collection = get_department_collection()
-        success_message = "診療科のバックアップが完了しました"
-    else:
-        raise ValueError(f"不明なデータタイプ: {data_type}")
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.raw.write(data)
 
-    data = list(collection.find({}, {'_id': False}))
+    def flush(self):
+        self.raw.flush()
 
-    # データをJSONファイルに書き込む
-    with open(backup_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    def close(self):
+        self.flush()
 
-    print(f"{success_message}: {backup_path}")
-    return backup_path
+
+def open_compressed_writer(fileobj, compression):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd圧縮にはzstandardパッケージが必要です")
+        return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+    if compression == "none":
+        return fileobj
+    raise ValueError(f"不明な圧縮形式: {compression}")
+
+
+def open_backup_reader(path):
+    """
+    拡張子から圧縮形式を判定して、バックアップファイルをバイナリで読み込む
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("zstd圧縮のバックアップの読み込みにはzstandardパッケージが必要です")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
+def iter_backup_documents(path):
+    """
+    バックアップファイルから1件ずつドキュメントを読み込む
+    NDJSON形式に加えて、以前のJSON配列形式のバックアップも読み込める
+    """
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    with open_backup_reader(path) as f:
+        for line in f:
+            if line.strip():
+                yield json_util.loads(line)
+
+
+def write_backup_file(documents, path, compression="gzip", watermark_field=None):
+    """
+    ドキュメントを1行ずつ圧縮したNDJSONに書き出し、件数・チェックサム・watermark_fieldの最大値を返す関数
+    """
+    start_time = time.perf_counter()
+    count = 0
+    watermark = None
+    with open(path, "wb") as raw:
+        hashing_writer = HashingWriter(raw)
+        writer = open_compressed_writer(hashing_writer, compression)
+        try:
+            for document in documents:
+                writer.write(json_util.dumps(document, ensure_ascii=False).encode("utf-8") + b"\n")
+                count += 1
+                value = document.get(watermark_field) if watermark_field else None
+                if isinstance(value, datetime.datetime) and (watermark is None or value > watermark):
+                    watermark = value
+        finally:
+            writer.close()
+
+    return {
+        "file": os.path.basename(path),
+        "count": count,
+        "sha256": hashing_writer.sha256.hexdigest(),
+        "bytes": hashing_writer.size,
+        "elapsed_seconds": round(time.perf_counter() - start_time, 3),
+        "watermark": watermark,
+    }
+
+
+def build_backup_query(collection_name, since=None):
+    if not since:
+        return {}
+    watermark_field = WATERMARK_FIELDS[collection_name]
+    legacy_field = LEGACY_WATERMARK_FIELDS.get(collection_name)
+    if not legacy_field:
+        return {watermark_field: {"$gte": since}}
+    return {"$or": [
+        {watermark_field: {"$gte": since}},
+        {watermark_field: {"$exists": False}, legacy_field: {"$gte": since}},
+    ]}
+
+
+def get_id_partitions(collection_name, query, partitions, min_documents):
+    """
+    件数がmin_documents以上のコレクションを、$bucketAutoで_idの範囲ごとにほぼ同じ件数へ分割する関数
+    分割しない場合は範囲なし(None)のひとつだけを返す
+    """
+    collection = BACKUP_COLLECTIONS[collection_name]()
+    # 設定系のコレクションは復元をひとつのトランザクションにまとめるため分割しない
+    if collection_name in TRANSACTIONAL_COLLECTIONS or partitions <= 1 \
+            or collection.estimated_document_count() < min_documents:
+        return [None]
+
+    buckets = list(collection.aggregate(
+        [{"$match": query}, {"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}}],
+        allowDiskUse=True
+    ))
+    if len(buckets) <= 1:
+        return [None]
+
+    # 各範囲は下限を含み上限を含まない。最後の範囲だけ上限を含める
+    id_ranges = [{"$gte": bucket["_id"]["min"], "$lt": bucket["_id"]["max"]} for bucket in buckets[:-1]]
+    id_ranges.append({"$gte": buckets[-1]["_id"]["min"], "$lte": buckets[-1]["_id"]["max"]})
+    return id_ranges
+
+
+def backup_collection(collection_name, backup_dir, compression="gzip", batch_size=DEFAULT_BATCH_SIZE, since=None,
+                      id_range=None, part=None):
+    """
+    コレクションをバッチ単位でカーソルから読み出し、圧縮したNDJSONに書き出す関数
+    全件をメモリに載せないため、summary_usageのような大きいコレクションでも使用メモリは一定
+    sinceを指定した場合は、更新日時(summary_usageは作成日時)がそれ以降のドキュメントだけを書き出す
+    id_rangeを指定した場合は、その_idの範囲だけをpart番号付きのファイルに書き出す
+    """
+    collection = BACKUP_COLLECTIONS[collection_name]()
+    query = build_backup_query(collection_name, since)
+    if id_range:
+        query["_id"] = id_range
+    part_suffix = f".part{part:03d}" if part is not None else ""
+    path = os.path.join(backup_dir, f"{collection_name}{part_suffix}.ndjson{COMPRESSION_EXTENSIONS[compression]}")
+
+    documents = collection.find(query, batch_size=batch_size).sort("_id", 1)
+    return write_backup_file(documents, path, compression, WATERMARK_FIELDS[collection_name])
+
+
+def get_entry_files(entry):
+    """
+    manifestのコレクションごとのエントリからファイルの一覧を返す。分割していないバックアップはファイルがひとつ
+    """
+    return entry.get("files") or [entry]
+
+
+def summarize_parts(parts, started_at, finished_at):
+    count = sum(part["count"] for part in parts)
+    elapsed = finished_at - started_at
+    return {
+        "files": [{key: part[key] for key in ("file", "count", "sha256", "bytes")} for part in parts],
+        "count": count,
+        "bytes": sum(part["bytes"] for part in parts),
+        "elapsed_seconds": round(elapsed, 3),
+        "documents_per_second": round(count / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def backup_tombstones(backup_dir, compression="gzip", since=None):
+    """
+    前回のバックアップ以降に記録された削除(トゥームストーン)を書き出す関数
+    """
+    query = {"deleted_at": {"$gte": since}} if since else {}
+    documents = get_tombstone_collection().find(query).sort("deleted_at", 1)
+    path = os.path.join(backup_dir, f"{TOMBSTONES_NAME}.ndjson{COMPRESSION_EXTENSIONS[compression]}")
+    return write_backup_file(documents, path, compression, "deleted_at")
+
+
+def write_manifest(backup_dir, manifest):
+    manifest_path = os.path.join(backup_dir, MANIFEST_FILENAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        f.write(json_util.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest_path
+
+
+def read_manifest(backup_dir):
+    # pymongoが返す日時と比較できるよう、watermarkはタイムゾーンなし(UTC)で読み込む
+    with open(os.path.join(backup_dir, MANIFEST_FILENAME), "r", encoding="utf-8") as f:
+        return json_util.loads(f.read(), json_options=MANIFEST_JSON_OPTIONS)
+
+
+def list_backups(root_dir=None):
+    """
+    manifest.jsonを持つバックアップを作成日時の古い順に返す関数
+    """
+    root_dir = root_dir or get_backup_settings()["root_dir"]
+    if not os.path.exists(root_dir):
+        return []
+
+    backups = []
+    for name in os.listdir(root_dir):
+        backup_dir = os.path.join(root_dir, name)
+        if os.path.exists(os.path.join(backup_dir, MANIFEST_FILENAME)):
+            backups.append((backup_dir, read_manifest(backup_dir)))
+    return sorted(backups, key=lambda backup: backup[1]["created_at"])
+
+
+def is_partial_backup(manifest):
+    """
+    一部のコレクションだけのバックアップかどうか。partialを記録していないmanifestはコレクションの一覧で判定する
+    """
+    return manifest.get("partial", not LEGACY_BACKUP_COLLECTIONS <= set(manifest["collections"]))
+
+
+def covers_collections(manifest, collection_names=None):
+    """
+    バックアップが指定したコレクションをすべて含むかどうか。省略時はすべてのコレクションを含むものだけを対象とする
+    """
+    if collection_names is None:
+        return not is_partial_backup(manifest)
+    return set(collection_names) <= set(manifest["collections"])
+
+
+def subtract_overlap(watermark, overlap_minutes):
+    # watermarkは書き込んだ日時の最大値だが、バックアップの読み出し中に確定した書き込みや
+    # サーバー間の時刻のずれで、それより前の日時のドキュメントが後から見えることがあるため、少し前から読み直す
+    return watermark - datetime.timedelta(minutes=overlap_minutes) if watermark else None
+
+
+def backup_all(collection_names=None, compression=None, batch_size=None, root_dir=None, incremental=False,
+               workers=None):
+    """
+    指定したコレクション(省略時はすべて)をひとつのバックアップとして書き出し、
+    件数とチェックサムを記録したmanifest.jsonを作成する関数
+    incrementalの場合は直前のバックアップのwatermark以降に更新されたドキュメントと削除だけを書き出す
+    """
+    settings = get_backup_settings()
+    compression = compression or settings["compression"]
+    batch_size = batch_size or settings["batch_size"]
+    root_dir = root_dir or settings["root_dir"]
+
+    parent = None
+    if incremental:
+        # 一部のコレクションだけのバックアップ(backup_promptsなど)は、対象を含まない場合は基準にしない
+        backups = [backup for backup in list_backups(root_dir) if covers_collections(backup[1], collection_names)]
+        if backups:
+            parent = backups[-1]
+        else:
+            print("基準となるバックアップがないため、フルバックアップを作成します")
+
+    partial = collection_names is not None and not set(BACKUP_COLLECTIONS) <= set(collection_names)
+    collection_names = collection_names or list(BACKUP_COLLECTIONS)
+
+    created_at = datetime.datetime.now()
+    backup_type = "incremental" if parent else "full"
+    backup_dir = os.path.join(root_dir, f"{'incr' if parent else 'full'}_{created_at:%Y%m%d_%H%M%S}")
+    os.makedirs(backup_dir, exist_ok=True)
+
+    manifest = {
+        "type": backup_type,
+        "created_at": created_at.isoformat(),
+        "compression": compression,
+        "partial": partial,
+        "collections": {},
+        "watermarks": {},
+    }
+    if parent:
+        parent_dir, parent_manifest = parent
+        manifest["parent"] = os.path.basename(parent_dir)
+        manifest["base"] = parent_manifest.get("base", os.path.basename(parent_dir))
+
+    parent_watermarks = parent[1].get("watermarks", {}) if parent else {}
+    workers = workers or settings["workers"]
+
+    # コレクションと_idの範囲の組をひとつの作業として、指定した並列数で同時に書き出す
+    tasks = []
+    for collection_name in collection_names:
+        since = subtract_overlap(parent_watermarks.get(collection_name), settings["overlap_minutes"])
+        id_ranges = get_id_partitions(collection_name, build_backup_query(collection_name, since),
+                                      settings["partitions"], settings["partition_min_documents"])
+        for part, id_range in enumerate(id_ranges):
+            tasks.append((collection_name, since, id_range, part if id_range else None))
+
+    def run_backup_task(task):
+        collection_name, since, id_range, part = task
+        task_started_at = time.perf_counter()
+        result = backup_collection(collection_name, backup_dir, compression, batch_size, since, id_range, part)
+        return collection_name, result, task_started_at, time.perf_counter()
+
+    results = collections.defaultdict(list)
+    timings = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for collection_name, result, task_started_at, task_finished_at in executor.map(run_backup_task, tasks):
+            results[collection_name].append(result)
+            started_at, finished_at = timings.get(collection_name, (task_started_at, task_finished_at))
+            timings[collection_name] = (min(started_at, task_started_at), max(finished_at, task_finished_at))
+
+    for collection_name in collection_names:
+        parts = results[collection_name]
+        watermarks = [part["watermark"] for part in parts if part["watermark"]]
+        manifest["watermarks"][collection_name] = max(watermarks) if watermarks else parent_watermarks.get(collection_name)
+        summary = summarize_parts(parts, *timings[collection_name])
+        manifest["collections"][collection_name] = summary
+        print(f"{collection_name}: {summary['count']}件 / {len(parts)}ファイル ({summary['bytes'] // 1024}KB, "
+              f"{summary['elapsed_seconds']:.1f}秒, {summary['documents_per_second'] or 0:.0f}件/秒)")
+
+    since = subtract_overlap(parent_watermarks.get(TOMBSTONES_NAME), settings["overlap_minutes"])
+    result = backup_tombstones(backup_dir, compression, since)
+    manifest["watermarks"][TOMBSTONES_NAME] = result.pop("watermark") or parent_watermarks.get(TOMBSTONES_NAME)
+    manifest[TOMBSTONES_NAME] = result
+
+    write_manifest(backup_dir, manifest)
+    print(f"バックアップが完了しました: {backup_dir}")
+    return backup_dir
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def verify_backup(backup_dir):
+    """
+    manifest.jsonのチェックサムと件数でバックアップファイルを検証する関数
+    """
+    manifest = read_manifest(backup_dir)
+    valid = True
+    entries = dict(manifest["collections"])
+    if TOMBSTONES_NAME in manifest:
+        entries[TOMBSTONES_NAME] = manifest[TOMBSTONES_NAME]
+    for collection_name, entry in entries.items():
+        for file_entry in get_entry_files(entry):
+            path = os.path.join(backup_dir, file_entry["file"])
+            count = sum(1 for _ in iter_backup_documents(path))
+            if file_sha256(path) != file_entry["sha256"] or count != file_entry["count"]:
+                print(f"{file_entry['file']}: 不一致 (件数 {count}/{file_entry['count']})")
+                valid = False
+            else:
+                print(f"{file_entry['file']}: OK ({count}件)")
+    return valid
 
 
 def backup_prompts(backup_dir=None):
-    return backup_data('prompts', backup_dir)
+    return backup_all(["prompts"], root_dir=backup_dir)
 
 
 def backup_departments(backup_dir=None):
-    return backup_data('departments', backup_dir)
+    return backup_all(["departments"], root_dir=backup_dir)
+
+
+def supports_transactions():
+    """
+    レプリカセットまたはシャードクラスタであればトランザクションを使用できる
+    """
+    try:
+        hello = get_mongodb_connection().admin.command("hello")
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
+    except Exception:
+        return False
+
+
+def build_replace_operation(collection_name, document):
+    key_fields = RESTORE_KEYS[collection_name]
+    if key_fields != ("_id",):
+        # 業務キーで置き換えるため、既存ドキュメントの_idは変更しない
+        document.pop("_id", None)
+
+    for field in ("created_at", "updated_at"):
+        # 旧形式のバックアップでは日時が文字列で保存されている
+        if isinstance(document.get(field), str):
+            document[field] = datetime.datetime.fromisoformat(document[field].replace('Z', '+00:00'))
+
+    missing = [field for field in key_fields if field not in document]
+    if missing:
+        raise ValueError(f"{collection_name}のドキュメントにキー({', '.join(missing)})がありません")
+
+    return ReplaceOne({field: document[field] for field in key_fields}, document, upsert=True)
+
+
+def restore_collection(collection_name, backup_file, batch_size=DEFAULT_BATCH_SIZE, dry_run=False, drop=False,
+                       session=None, show_progress=True):
+    """
+    バックアップファイルを読み進めながら、ReplaceOne(upsert)をバッチ単位でbulk_writeする関数
+    時系列コレクションはReplaceOneのupsertを使えず、_idの一意インデックスもないため、
+    既存の_idを読み飛ばして挿入する(既存のドキュメントは更新しない)
+    dry_runの場合は書き込まずに件数とキーの検証だけを行う
+    """
+    collection = BACKUP_COLLECTIONS[collection_name]()
+    timeseries = not dry_run and is_timeseries_collection(collection)
+    stats = {"count": 0, "upserted": 0, "modified": 0, "matched": 0}
+    start_time = time.perf_counter()
+
+    if drop and not dry_run:
+        collection.delete_many({}, session=session)
+
+    def write_batch(documents, operations):
+        stats["count"] += len(operations)
+        if timeseries:
+            inserted = insert_new_documents(collection, documents)
+            stats["upserted"] += inserted
+            stats["matched"] += len(documents) - inserted
+        elif not dry_run:
+            result = collection.bulk_write(operations, ordered=False, session=session)
+            stats["upserted"] += result.upserted_count
+            stats["modified"] += result.modified_count
+            stats["matched"] += result.matched_count
+
+        if show_progress:
+            elapsed = time.perf_counter() - start_time
+            print(f"\r{collection_name}: {stats['count']}件 ({stats['count'] / max(elapsed, 1e-6):.0f}件/秒)", end="",
+                  flush=True)
+
+    documents = []
+    operations = []
+    for document in iter_backup_documents(backup_file):
+        # キーの検証と日時の変換はbuild_replace_operationがドキュメントに対して行う
+        operations.append(build_replace_operation(collection_name, document))
+        documents.append(document)
+        if len(operations) >= batch_size:
+            write_batch(documents, operations)
+            documents = []
+            operations = []
+    if operations:
+        write_batch(documents, operations)
+
+    stats["elapsed_seconds"] = round(time.perf_counter() - start_time, 3)
+    print(f"\r{os.path.basename(backup_file)}: {stats['count']}件 / 新規 {stats['upserted']}件 / "
+          f"更新 {stats['modified']}件 ({stats['elapsed_seconds']:.1f}秒{', ドライラン' if dry_run else ''})")
+    return stats
+
+
+def restore_collection_with_transaction(collection_name, backup_file, batch_size=DEFAULT_BATCH_SIZE, dry_run=False,
+                                        drop=False, use_transaction=True, show_progress=True):
+    """
+    設定系の小さいコレクションは、使用できる場合はトランザクション内で復元し、途中で失敗しても元の状態に戻す
+    summary_usageは_idで冪等に上書きするため、トランザクションの上限を避けてバッチごとに確定させる
+    """
+    if dry_run or not use_transaction or collection_name not in TRANSACTIONAL_COLLECTIONS or not supports_transactions():
+        return restore_collection(collection_name, backup_file, batch_size, dry_run, drop, show_progress=show_progress)
+
+    with get_mongodb_connection().start_session() as session:
+        return session.with_transaction(
+            lambda s: restore_collection(collection_name, backup_file, batch_size, dry_run, drop, s, show_progress)
+        )
+
+
+def warn_archived_usage(collection_names):
+    """
+    アーカイブより前に作成したバックアップを復元すると、アーカイブ済みの利用状況が元のコレクションに戻る
+    統計情報はarchived_beforeより前をアーカイブだけから読むため二重には集計しないが、戻った分は
+    archive_usageを再実行してアーカイブへ移す(アーカイブにある分は_idで読み飛ばす)
+    """
+    if "summary_usage" not in collection_names:
+        return
+    archive_state = get_archive_state()
+    if not archive_state:
+        return
+    count = get_usage_collection().count_documents({"date": {"$lt": archive_state["archived_before"]}})
+    if count:
+        print(f"注意: アーカイブ済みの期間({archive_state['archived_before']:%Y-%m-%d}より前)の利用状況が{count}件あります。"
+              f"統計情報には含まれません。python -m scripts.archive_usage を実行してアーカイブへ移してください")
+
+
+def restore_backup(backup_dir, collection_names=None, batch_size=None, dry_run=False, drop=False,
+                   use_transaction=True, workers=None, check_archive=True):
+    """
+    manifest.jsonのチェックサムを確認してから、バックアップに含まれるコレクションを復元する関数
+    コレクションと分割したファイルごとに、指定した並列数で同時に書き込む
+    """
+    manifest = read_manifest(backup_dir)
+    settings = get_backup_settings()
+    batch_size = batch_size or settings["batch_size"]
+    workers = workers or settings["workers"]
+    collection_names = collection_names or list(manifest["collections"])
+
+    # どれかのファイルが壊れている場合に一部のコレクションだけ削除されないよう、先にすべてのファイルを検証する
+    file_entries_by_collection = {}
+    for collection_name in collection_names:
+        entry = manifest["collections"].get(collection_name)
+        if not entry:
+            print(f"{collection_name}: バックアップに含まれていません")
+            continue
+
+        file_entries = get_entry_files(entry)
+        for file_entry in file_entries:
+            path = os.path.join(backup_dir, file_entry["file"])
+            if file_sha256(path) != file_entry["sha256"]:
+                raise ValueError(f"{collection_name}のバックアップファイルのチェックサムが一致しません: {path}")
+        file_entries_by_collection[collection_name] = file_entries
+
+    tasks = []
+    for collection_name, file_entries in file_entries_by_collection.items():
+        if len(file_entries) == 1:
+            # ひとつのファイルはトランザクションを使える場合、削除と復元をまとめて行う
+            tasks.append((collection_name, os.path.join(backup_dir, file_entries[0]["file"]), drop))
+            continue
+
+        if drop and not dry_run:
+            BACKUP_COLLECTIONS[collection_name]().delete_many({})
+        tasks.extend((collection_name, os.path.join(backup_dir, file_entry["file"]), False)
+                     for file_entry in file_entries)
+
+    # 並列に書き込む場合は進捗表示が混ざるため、ファイルごとの完了時だけ表示する
+    show_progress = workers <= 1 or len(tasks) <= 1
+
+    def run_restore_task(task):
+        collection_name, path, drop_existing = task
+        task_started_at = time.perf_counter()
+        stats = restore_collection_with_transaction(collection_name, path, batch_size, dry_run, drop_existing,
+                                                    use_transaction, show_progress)
+        return collection_name, stats, task_started_at, time.perf_counter()
+
+    results = {}
+    timings = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for collection_name, stats, task_started_at, task_finished_at in executor.map(run_restore_task, tasks):
+            total = results.setdefault(collection_name, {"count": 0, "upserted": 0, "modified": 0, "matched": 0})
+            for key in total:
+                total[key] += stats[key]
+            started_at, finished_at = timings.get(collection_name, (task_started_at, task_finished_at))
+            timings[collection_name] = (min(started_at, task_started_at), max(finished_at, task_finished_at))
+
+    for collection_name, total in results.items():
+        started_at, finished_at = timings[collection_name]
+        total["elapsed_seconds"] = round(finished_at - started_at, 3)
+        print(f"{collection_name}: {total['count']}件 ({total['elapsed_seconds']:.1f}秒, "
+              f"{total['count'] / max(total['elapsed_seconds'], 1e-6):.0f}件/秒)")
+
+    if check_archive and not dry_run:
+        warn_archived_usage(results)
+    return results
+
+
+def apply_tombstones(tombstones_file, collection_names, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """
+    増分バックアップに記録された削除を、対象のコレクションにDeleteManyで反映する関数
+    """
+    operations = {}
+    for tombstone in iter_backup_documents(tombstones_file):
+        if tombstone["collection"] in collection_names:
+            operations.setdefault(tombstone["collection"], []).append(DeleteMany(tombstone["key"]))
+
+    for collection_name, collection_operations in operations.items():
+        deleted = 0
+        if not dry_run:
+            collection = BACKUP_COLLECTIONS[collection_name]()
+            for i in range(0, len(collection_operations), batch_size):
+                deleted += collection.bulk_write(collection_operations[i:i + batch_size], ordered=True).deleted_count
+        print(f"{collection_name}: 削除 {deleted}件 (記録 {len(collection_operations)}件)")
+
+
+def find_restore_chain(target_time=None, root_dir=None, collection_names=None):
+    """
+    指定日時(省略時は最新)の時点を復元するための、フルバックアップとそれに続く増分バックアップの並びを返す関数
+    復元するコレクションをすべて含むバックアップだけを対象とする
+    """
+    backups = list_backups(root_dir)
+    if target_time:
+        backups = [backup for backup in backups
+                   if datetime.datetime.fromisoformat(backup[1]["created_at"]) <= target_time]
+    backups_by_name = {os.path.basename(backup_dir): (backup_dir, manifest) for backup_dir, manifest in backups}
+    backups = [backup for backup in backups if covers_collections(backup[1], collection_names)]
+    if not backups:
+        raise ValueError("指定した日時以前に、対象のコレクションをすべて含むバックアップが見つかりません")
+
+    chain = [backups[-1]]
+    while chain[0][1]["type"] != "full":
+        parent_name = chain[0][1].get("parent")
+        if parent_name not in backups_by_name:
+            raise ValueError(f"増分バックアップの基準が見つかりません: {parent_name}")
+        chain.insert(0, backups_by_name[parent_name])
+    return chain
+
+
+def restore_point_in_time(target_time=None, collection_names=None, batch_size=None, dry_run=False,
+                          use_transaction=True, root_dir=None, workers=None):
+    """
+    フルバックアップを削除付きで復元した後、増分バックアップを順に適用して指定日時の状態を再現する関数
+    増分ごとに削除を先に反映し、その後に同じ期間で作成・更新されたドキュメントを上書きする
+    """
+    chain = find_restore_chain(target_time, root_dir, collection_names)
+    batch_size = batch_size or get_backup_settings()["batch_size"]
+    collection_names = collection_names or list(chain[0][1]["collections"])
+    print(f"復元に使用するバックアップ: {' → '.join(os.path.basename(backup_dir) for backup_dir, _ in chain)}")
+
+    full_dir, _ = chain[0]
+    restore_backup(full_dir, collection_names, batch_size, dry_run, drop=True, use_transaction=use_transaction,
+                   workers=workers, check_archive=False)
+
+    for backup_dir, manifest in chain[1:]:
+        if TOMBSTONES_NAME in manifest:
+            apply_tombstones(os.path.join(backup_dir, manifest[TOMBSTONES_NAME]["file"]), collection_names,
+                             batch_size, dry_run)
+        restore_backup(backup_dir, [name for name in collection_names if name in manifest["collections"]],
+                       batch_size, dry_run, drop=False, use_transaction=use_transaction, workers=workers,
+                       check_archive=False)
+
+    if not dry_run:
+        # アーカイブで元のコレクションから削除した分はトゥームストーンに記録されないため、増分の適用後も残る
+        warn_archived_usage(collection_names)
+
+
+def prune_backups(keep_daily=None, keep_weekly=None, root_dir=None, dry_run=False):
+    """
+    日ごと・週ごとに最新のフルバックアップを指定数だけ残し、それ以外のフルバックアップと
+    その増分バックアップを削除する関数。最新のフルバックアップは常に残す
+    残す数の判定にはすべてのコレクションを含むフルバックアップだけを使い、
+    一部のコレクションだけのバックアップは、残したうち最も古いものより新しければ残す
+    """
+    settings = get_backup_settings()
+    keep_daily = settings["keep_daily"] if keep_daily is None else keep_daily
+    keep_weekly = settings["keep_weekly"] if keep_weekly is None else keep_weekly
+
+    backups = list_backups(root_dir)
+    full_backups = [backup for backup in reversed(backups)
+                    if backup[1]["type"] == "full" and not is_partial_backup(backup[1])]
+    if not full_backups:
+        print("すべてのコレクションを含むフルバックアップがないため、削除しません")
+        return []
+
+    kept = set()
+    daily_seen = set()
+    weekly_seen = set()
+    for index, (backup_dir, manifest) in enumerate(full_backups):
+        created_at = datetime.datetime.fromisoformat(manifest["created_at"])
+        day = created_at.date()
+        week = created_at.isocalendar()[:2]
+        if index == 0:
+            kept.add(backup_dir)
+        if day not in daily_seen and len(daily_seen) < keep_daily:
+            kept.add(backup_dir)
+        if week not in weekly_seen and len(weekly_seen) < keep_weekly:
+            kept.add(backup_dir)
+        daily_seen.add(day)
+        weekly_seen.add(week)
+
+    oldest_kept_at = min(manifest["created_at"] for backup_dir, manifest in full_backups if backup_dir in kept)
+    kept.update(backup_dir for backup_dir, manifest in backups
+                if manifest["type"] == "full" and is_partial_backup(manifest) and manifest["created_at"] >= oldest_kept_at)
+
+    kept_names = {os.path.basename(backup_dir) for backup_dir in kept}
+    removed = []
+    for backup_dir, manifest in backups:
+        base_name = os.path.basename(backup_dir) if manifest["type"] == "full" else manifest.get("base")
+        if base_name in kept_names:
+            continue
+        removed.append(backup_dir)
+        if not dry_run:
+            shutil.rmtree(backup_dir)
+        print(f"{'削除対象' if dry_run else '削除しました'}: {os.path.basename(backup_dir)}")
+
+    return removed
 
 
 def restore_data(backup_file, data_type):
@@ -83,47 +782,18 @@ def restore_data(backup_file, data_type):
         print(f"エラー: バックアップファイルが見つかりません: {backup_file}")
         return False
 
-    success_message = "データ"
+    labels = {"prompts": "プロンプト", "departments": "診療科"}
+    success_message = labels.get(data_type, "データ")
 
     try:
-        with open(backup_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        # データタイプに応じたコレクション取得とメッセージ設定
-        if data_type == 'prompts':
-            collection = get_prompt_collection()
-            id_field = "department"
-            success_message = "プロンプト"
-        elif data_type == 'departments':
-            collection = get_department_collection()
-            id_field = "name"
-            success_message = "診療科"
-        else:
+        if data_type not in labels:
             raise ValueError(f"不明なデータタイプ: {data_type}")
 
         # 既存のデータをすべて削除（この操作は取り消せません)
-        if input(f"既存の{success_message}をすべて削除しますか？ (y/n): ").lower() == 'y':
-            collection.delete_many({})
-            print(f"既存の{success_message}をすべて削除しました")
-
-        # バックアップデータを挿入
-        for item in data:
-            if 'created_at' in item and isinstance(item['created_at'], str):
-                item['created_at'] = datetime.datetime.fromisoformat(item['created_at'].replace('Z', '+00:00'))
-            if 'updated_at' in item and isinstance(item['updated_at'], str):
-                item['updated_at'] = datetime.datetime.fromisoformat(item['updated_at'].replace('Z', '+00:00'))
-
-            existing = collection.find_one({id_field: item[id_field]})
-
-            if existing:
-                collection.update_one(
-                    {id_field: item[id_field]},
-                    {"$set": item}
-                )
-            else:
-                collection.insert_one(item)
+        drop = input(f"既存の{success_message}をすべて削除しますか？ (y/n): ").lower() == 'y'
 
-        print(f"{len(data)}件の{success_message}を正常に復元しました")
+        stats = restore_collection_with_transaction(data_type, backup_file, drop=drop)
+        print(f"{stats['count']}件の{success_message}を正常に復元しました")
         return True
 
     except Exception as e:
@@ -139,46 +809,41 @@ def restore_departments(backup_file):
     return restore_data(backup_file, 'departments')
 
 
+def print_backup_dir_files(title, dir_path):
+    print(f"\n=== {title} ===")
+    if not os.path.exists(dir_path):
+        print("バックアップディレクトリが見つかりません")
+        return
+
+    files = os.listdir(dir_path)
+    if not files:
+        print("バックアップファイルが見つかりません")
+        return
+
+    for idx, file in enumerate(sorted(files, reverse=True)):
+        full_path = os.path.join(dir_path, file)
+        size = os.path.getsize(full_path) // 1024  # KB単位
+        mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
+        print(f"{idx + 1}. {file} ({size}KB) - {mod_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+
 def list_backup_files():
     """
     バックアップファイルの一覧を表示する関数
     """
-    prompts_dir = get_backup_dir('prompts')
-    departments_dir = get_backup_dir('departments')
-
-    print("\n=== プロンプトバックアップファイル ===")
-    if os.path.exists(prompts_dir):
-        files = os.listdir(prompts_dir)
-        if files:
-            for idx, file in enumerate(sorted(files, reverse=True)):
-                full_path = os.path.join(prompts_dir, file)
-                size = os.path.getsize(full_path) // 1024  # KB単位
-                mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
-                print(f"{idx + 1}. {file} ({size}KB) - {mod_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        else:
-            print("バックアップファイルが見つかりません")
-    else:
-        print("バックアップディレクトリが見つかりません")
+    print("\n=== バックアップ ===")
+    backups = list(reversed(list_backups()))
+    if not backups:
+        print("バックアップが見つかりません")
+    for idx, (backup_dir, manifest) in enumerate(backups):
+        counts = ", ".join(f"{collection}: {entry['count']}件" for collection, entry in manifest["collections"].items())
+        print(f"{idx + 1}. {os.path.basename(backup_dir)} ({manifest['compression']}) - {counts}")
 
-    print("\n=== 診療科バックアップファイル ===")
-    if os.path.exists(departments_dir):
-        files = os.listdir(departments_dir)
-        if files:
-            for idx, file in enumerate(sorted(files, reverse=True)):
-                full_path = os.path.join(departments_dir, file)
-                size = os.path.getsize(full_path) // 1024  # KB単位
-                mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
-                print(f"{idx + 1}. {file} ({size}KB) - {mod_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        else:
-            print("バックアップファイルが見つかりません")
-    else:
-        print("バックアップディレクトリが見つかりません")
+    print_backup_dir_files("プロンプトバックアップファイル(旧形式)", get_backup_dir('prompts'))
+    print_backup_dir_files("診療科バックアップファイル(旧形式)", get_backup_dir('departments'))
 
 
-if __name__ == "__main__":
-    # 環境変数の読み込み
-    load_environment_variables()
-
+def run_interactive():
     print("データベースバックアップユーティリティ")
     print("1. バックアップの作成")
     print("2. バックアップの復元")
@@ -189,15 +854,17 @@ if __name__ == "__main__":
 
     if action == "1":
         print("バックアップを作成します...")
-        prompt_file = backup_prompts()
-        dept_file = backup_departments()
-        print(f"\nバックアップが完了しました。")
-        print(f"プロンプト: {prompt_file}")
-        print(f"診療科: {dept_file}")
+        backup_all()
 
     elif action == "2":
         list_backup_files()
 
+        backup_dir = input("\n復元するバックアップのディレクトリを入力 (旧形式のファイルから復元する場合は空欄): ")
+        if backup_dir:
+            drop = input("既存のデータをすべて削除してから復元しますか？ (y/n): ").lower() == 'y'
+            restore_backup(backup_dir, drop=drop)
+            return
+
         print("\n--- プロンプトの復元 ---")
         prompt_file = input("プロンプトバックアップファイルのパスを入力: ")
         if prompt_file:
@@ -215,3 +882,81 @@ if __name__ == "__main__":
         print("プログラムを終了します。")
     else:
         print("無効な選択です。")
+
+
+def parse_datetime(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="データベースのバックアップを作成・復元します。引数なしで対話モードになります")
+    subparsers = parser.add_subparsers(dest="command")
+
+    backup_parser = subparsers.add_parser("backup", help="バックアップを作成する")
+    backup_parser.add_argument("--collections", nargs="+", choices=list(BACKUP_COLLECTIONS),
+                               help="対象のコレクション (省略時はすべて)")
+    backup_parser.add_argument("--compression", choices=list(COMPRESSION_EXTENSIONS), help="圧縮形式")
+    backup_parser.add_argument("--batch-size", type=int, help="カーソルのバッチサイズ")
+    backup_parser.add_argument("--output-dir", help="バックアップの保存先")
+    backup_parser.add_argument("--incremental", action="store_true",
+                               help="直前のバックアップ以降の変更と削除だけを書き出す")
+    backup_parser.add_argument("--prune", action="store_true", help="作成後に保持期間を過ぎたバックアップを削除する")
+    backup_parser.add_argument("--workers", type=int, help="同時に書き出すコレクション・分割の数")
+
+    verify_parser = subparsers.add_parser("verify", help="manifest.jsonでバックアップを検証する")
+    verify_parser.add_argument("backup_dir", help="バックアップのディレクトリ")
+
+    restore_parser = subparsers.add_parser("restore", help="バックアップから復元する")
+    restore_parser.add_argument("backup_dir", nargs="?", help="バックアップのディレクトリ")
+    restore_parser.add_argument("--point-in-time", type=parse_datetime,
+                                help="フルバックアップと増分バックアップからこの日時(YYYY-MM-DD HH:MM)の状態を復元する")
+    restore_parser.add_argument("--collections", nargs="+", choices=list(BACKUP_COLLECTIONS),
+                                help="対象のコレクション (省略時はバックアップに含まれるすべて)")
+    restore_parser.add_argument("--batch-size", type=int, help="bulk_writeのバッチサイズ")
+    restore_parser.add_argument("--dry-run", action="store_true", help="書き込まずに件数とキーだけを確認する")
+    restore_parser.add_argument("--drop", action="store_true", help="復元前に既存のドキュメントを削除する")
+    restore_parser.add_argument("--no-transaction", action="store_true", help="トランザクションを使用しない")
+    restore_parser.add_argument("--workers", type=int, help="同時に復元するコレクション・分割の数")
+
+    prune_parser = subparsers.add_parser("prune", help="保持期間を過ぎたバックアップを削除する")
+    prune_parser.add_argument("--keep-daily", type=int, help="残す日次のフルバックアップ数")
+    prune_parser.add_argument("--keep-weekly", type=int, help="残す週次のフルバックアップ数")
+    prune_parser.add_argument("--dry-run", action="store_true", help="削除せずに対象だけを表示する")
+
+    subparsers.add_parser("list", help="バックアップの一覧を表示する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # 環境変数の読み込み
+    load_environment_variables()
+
+    match args.command:
+        case "backup":
+            backup_all(args.collections, args.compression, args.batch_size, args.output_dir, args.incremental,
+                       args.workers)
+            if args.prune:
+                prune_backups(root_dir=args.output_dir)
+        case "restore":
+            if args.backup_dir:
+                restore_backup(args.backup_dir, args.collections, args.batch_size, args.dry_run, args.drop,
+                               not args.no_transaction, args.workers)
+            elif args.point_in_time:
+                restore_point_in_time(args.point_in_time, args.collections, args.batch_size, args.dry_run,
+                                      not args.no_transaction, workers=args.workers)
+            else:
+                print("バックアップのディレクトリまたは--point-in-timeを指定してください")
+        case "prune":
+            prune_backups(args.keep_daily, args.keep_weekly, dry_run=args.dry_run)
+        case "verify":
+            if not verify_backup(args.backup_dir):
+                raise SystemExit(1)
+        case "list":
+            list_backup_files()
+        case _:
+            run_interactive()
+
+
+if __name__ == "__main__":
+    main()
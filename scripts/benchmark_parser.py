@@ -0,0 +1,73 @@
+import argparse
+import time
+
+from utils.constants import DEFAULT_SECTION_NAMES
+from utils.text_processor import format_discharge_summary, parse_discharge_summary
+
+SAMPLE_SECTION = """・{name}
+{name}に関する記載です。症状は安定しており、特記すべき変化はありません。
+検査値: WBC 6800 / CRP 0.3 / Hb 12.1
+"""
+
+
+def legacy_parse_discharge_summary(summary_text):
+    """
+    比較用: 一行ごとに全見出しを部分一致で探していた以前の実装
+    """
+    sections = {section: "" for section in DEFAULT_SECTION_NAMES}
+    section_aliases = {"禁忌・アレルギー": "禁忌/アレルギー"}
+
+    current_section = None
+    for line in summary_text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+
+        found_section = False
+        for section in list(sections.keys()) + list(section_aliases.keys()):
+            if section in line:
+                current_section = section_aliases.get(section, section)
+                line = line.replace(section, "").replace(":", "").strip()
+                found_section = True
+                break
+
+        if current_section and line and not found_section:
+            sections.setdefault(current_section, "")
+            if sections[current_section]:
+                sections[current_section] += "\n" + line
+            else:
+                sections[current_section] = line
+        elif current_section and line and found_section:
+            sections[current_section] = line
+
+    return sections
+
+
+def build_sample_output(repeat):
+    body = "".join(SAMPLE_SECTION.format(name=name) for name in DEFAULT_SECTION_NAMES)
+    filler = "経過観察を継続した。\n" * 20
+    return format_discharge_summary((body + filler) * repeat)
+
+
+def measure(func, text, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(text)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parse_discharge_summaryのベンチマーク")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'行数':>8} {'以前(ms)':>10} {'現在(ms)':>10} {'倍率':>6}")
+    for repeat in [1, 10, 100, 1000]:
+        text = build_sample_output(repeat)
+        legacy_ms = measure(legacy_parse_discharge_summary, text, args.iterations)
+        current_ms = measure(parse_discharge_summary, text, args.iterations)
+        print(f"{text.count(chr(10)):>8} {legacy_ms:>10.2f} {current_ms:>10.2f} {legacy_ms / current_ms:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+from database.sqlite_store import SQLiteDatabase
+from utils.config import MONGODB_URI
+from utils.constants import DEFAULT_DEPARTMENTS
+
+COLLECTION_PREFIX = "benchmark_"
+
+
+def prepare_collections(database):
+    """
+    ベンチマーク用のコレクションに、実際の運用に近い件数の診療科・プロンプト・設定を作成する
+    """
+    collections = {
+        name: database.get_collection(f"{COLLECTION_PREFIX}{name}")
+        for name in ["prompts", "departments", "app_settings", "summary_usage"]
+    }
+    for collection in collections.values():
+        collection.delete_many({})
+
+    now = datetime.datetime.now()
+    for order, department in enumerate(DEFAULT_DEPARTMENTS):
+        collections["departments"].insert_one({"name": department, "order": order, "updated_at": now})
+        collections["prompts"].insert_one({"department": department, "name": "退院時サマリ", "content": "プロンプト" * 200,
+                                           "is_default": False, "updated_at": now})
+    collections["app_settings"].insert_one({"setting_id": "user_preferences", "selected_department": "内科"})
+    return collections
+
+
+def run_request(collections):
+    """
+    ひとつのサマリ作成で行う読み書き (設定・診療科一覧・診療科・プロンプトの読み出しと利用状況の記録) を再現する
+    """
+    collections["app_settings"].find_one({"setting_id": "user_preferences"})
+    [department["name"] for department in collections["departments"].find().sort("order")]
+    collections["departments"].find_one({"name": "内科"})
+    collections["prompts"].find_one({"department": "内科"})
+    collections["summary_usage"].insert_one({
+        "date": datetime.datetime.now(), "department": "内科", "input_tokens": 1000, "output_tokens": 500,
+    })
+
+
+def measure(collections, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run_request(collections)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95) - 1],
+        "max": timings[-1],
+    }
+
+
+def cleanup(collections):
+    for collection in collections.values():
+        collection.delete_many({})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MongoDBとSQLiteの1リクエストあたりの読み書き時間を比較します")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    backends = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backends.append(("sqlite", SQLiteDatabase(os.path.join(temp_dir, "benchmark.db"))))
+        if MONGODB_URI:
+            from database.db import DatabaseManager
+            backends.append(("mongodb", DatabaseManager.get_instance()))
+        else:
+            print("MONGODB_URIが設定されていないため、SQLiteのみ計測します")
+
+        print(f"{'ストレージ':<10} {'p50(ms)':>10} {'p95(ms)':>10} {'最大(ms)':>10}")
+        for backend_name, database in backends:
+            collections = prepare_collections(database)
+            try:
+                # 接続の確立やテーブル作成を計測に含めないよう、先に数回実行しておく
+                measure(collections, 5)
+                result = measure(collections, args.iterations)
+            finally:
+                cleanup(collections)
+            print(f"{backend_name:<10} {result['p50']:>10.2f} {result['p95']:>10.2f} {result['max']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import datetime
+import os
+import time
+
+from services.export_service import DEFAULT_BATCH_SIZE, DEFAULT_ROW_GROUP_SIZE, EXPORT_FORMATS, export_usage
+from utils.env_loader import load_environment_variables
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="summary_usageを期間指定でCSV/Parquetにエクスポートします")
+    parser.add_argument("--start", required=True, type=parse_date, help="開始日 (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, type=parse_date, help="終了日 (YYYY-MM-DD)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv", help="出力形式")
+    parser.add_argument("--output", help="出力ファイルのパス (省略時は自動で命名)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="カーソルのバッチサイズ")
+    parser.add_argument("--row-group-size", type=int, default=DEFAULT_ROW_GROUP_SIZE,
+                        help="Parquetの行グループサイズ")
+    parser.add_argument("--with-cost", action="store_true", help="config.iniの[COST]を使って料金列を追加する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_environment_variables()
+
+    start_datetime = datetime.datetime.combine(args.start, datetime.time.min)
+    end_datetime = datetime.datetime.combine(args.end, datetime.time.max)
+    output_path = args.output or f"summary_usage_{args.start:%Y%m%d}_{args.end:%Y%m%d}.{args.format}"
+
+    start_time = time.perf_counter()
+    if args.format == "csv":
+        with open(output_path, "w", encoding="utf-8-sig", newline="") as f:
+            row_count = export_usage(f, start_datetime, end_datetime, "csv", args.batch_size,
+                                     with_cost=args.with_cost)
+    else:
+        with open(output_path, "wb") as f:
+            row_count = export_usage(f, start_datetime, end_datetime, "parquet", args.batch_size,
+                                     args.row_group_size, with_cost=args.with_cost)
+    elapsed = time.perf_counter() - start_time
+
+    size = os.path.getsize(output_path) // 1024
+    print(f"{row_count}件をエクスポートしました: {output_path} ({size}KB, {elapsed:.1f}秒)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import time
+
+from pymongo.errors import BulkWriteError
+
+from database.db import DatabaseManager
+from utils.config import MONGODB_USAGE_COLLECTION
+from utils.env_loader import load_environment_variables
+
+DEFAULT_TARGET = "summary_usage_ts"
+DEFAULT_BATCH_SIZE = 1000
+
+
+def create_timeseries_collection(database, collection_name, granularity):
+    """
+    dateをtimeField、診療科とモデル(meta)をmetaFieldとする時系列コレクションを作成する関数
+    """
+    if collection_name in database.list_collection_names():
+        options = database[collection_name].options()
+        if "timeseries" not in options:
+            raise ValueError(f"{collection_name}は時系列コレクションではありません")
+        return database[collection_name]
+
+    return database.create_collection(
+        collection_name,
+        timeseries={"timeField": "date", "metaField": "meta", "granularity": granularity}
+    )
+
+
+def to_timeseries_document(document):
+    document.setdefault("meta", {
+        "department": document.get("department"),
+        "model_detail": document.get("model_detail"),
+    })
+    return document
+
+
+def insert_batch(target, batch):
+    try:
+        target.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        print(f"書き込みに失敗したドキュメントがあります: {len(e.details.get('writeErrors', []))}件")
+        raise
+
+
+def migrate(source_name, target_name, granularity="minutes", batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """
+    summary_usageを時系列コレクションへ日付順にコピーする関数
+    時系列コレクションは_idの重複を防がないため、再実行時は移行先の最新の日付から続きをコピーし、
+    同じ日付ですでにコピーしたドキュメントは_idで読み飛ばす
+    """
+    database = DatabaseManager.get_instance().get_database()
+    source = database[source_name]
+    if dry_run:
+        print(f"{source_name}: {source.estimated_document_count()}件 (ドライラン)")
+        return 0
+
+    target = create_timeseries_collection(database, target_name, granularity)
+
+    query = {"date": {"$type": "date"}}
+    copied_ids = set()
+    latest = target.find_one(sort=[("date", -1)])
+    if latest:
+        query["date"]["$gte"] = latest["date"]
+        copied_ids = {document["_id"] for document in target.find({"date": latest["date"]}, {"_id": 1})}
+        print(f"{latest['date']}以降から再開します")
+
+    start_time = time.perf_counter()
+    copied_count = 0
+    batch = []
+    for document in source.find(query).sort("date", 1).batch_size(batch_size):
+        if document["_id"] in copied_ids:
+            continue
+        batch.append(to_timeseries_document(document))
+        if len(batch) >= batch_size:
+            insert_batch(target, batch)
+            copied_count += len(batch)
+            batch = []
+            print(f"\r{copied_count}件", end="", flush=True)
+    if batch:
+        insert_batch(target, batch)
+        copied_count += len(batch)
+
+    skipped = source.count_documents({"date": {"$not": {"$type": "date"}}})
+    print(f"\r{copied_count}件をコピーしました ({time.perf_counter() - start_time:.1f}秒)")
+    if skipped:
+        print(f"dateが日時でない{skipped}件は時系列コレクションに保存できないためコピーしていません")
+    print(f"移行元 {source.estimated_document_count()}件 / 移行先 {target.count_documents({})}件")
+    print(f"アプリを切り替えるには、環境変数MONGODB_USAGE_COLLECTION={target_name}を設定して再起動してください")
+    return copied_count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="summary_usageを時系列コレクションへ移行します")
+    parser.add_argument("--source", default=MONGODB_USAGE_COLLECTION, help="移行元のコレクション")
+    parser.add_argument("--target", default=DEFAULT_TARGET, help="移行先の時系列コレクション")
+    parser.add_argument("--granularity", choices=["seconds", "minutes", "hours"], default="minutes",
+                        help="時系列コレクションのgranularity")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="insert_manyのバッチサイズ")
+    parser.add_argument("--dry-run", action="store_true", help="移行せずに件数だけを表示する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_environment_variables()
+    migrate(args.source, args.target, args.granularity, args.batch_size, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import csv
+import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+
+from database.db import get_usage_analytics_collection
+from utils.config import get_config
+from utils.exceptions import AppError
+
+JST = pytz.timezone('Asia/Tokyo')
+
+EXPORT_FORMATS = ["csv", "parquet"]
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_ROW_GROUP_SIZE = 50000
+
+USAGE_EXPORT_FIELDS = [
+    "date",
+    "app_type",
+    "document_name",
+    "model_detail",
+    "department",
+    "input_tokens",
+    "output_tokens",
+    "total_tokens",
+    "processing_time",
+    "api_processing_time",
+    "queue_wait_time",
+    "priority",
+    "status",
+    "generation_type",
+    "section",
+    "output_mode",
+    "compaction_chars_saved",
+]
+
+COST_FIELDS = ["input_cost", "output_cost", "total_cost"]
+
+USAGE_EXPORT_SCHEMA = pa.schema([
+    ("date", pa.timestamp("ms", tz="Asia/Tokyo")),
+    ("app_type", pa.string()),
+    ("document_name", pa.string()),
+    ("model_detail", pa.string()),
+    ("department", pa.string()),
+    ("input_tokens", pa.int64()),
+    ("output_tokens", pa.int64()),
+    ("total_tokens", pa.int64()),
+    ("processing_time", pa.float64()),
+    ("api_processing_time", pa.float64()),
+    ("queue_wait_time", pa.float64()),
+    ("priority", pa.string()),
+    ("status", pa.string()),
+    ("generation_type", pa.string()),
+    ("section", pa.string()),
+    ("output_mode", pa.string()),
+    ("compaction_chars_saved", pa.int64()),
+])
+
+COST_SCHEMA_FIELDS = [pa.field(name, pa.float64()) for name in COST_FIELDS]
+
+
+def load_cost_rates():
+    """
+    config.iniの[COST]セクションからモデルごとの単価(USD/100万トークン)を読み込む関数
+    """
+    config = get_config()
+    if 'COST' not in config:
+        return {}
+
+    cost_rates = {}
+    for pattern, value in config['COST'].items():
+        try:
+            input_rate, output_rate = [float(rate.strip()) for rate in value.split(',')]
+        except ValueError:
+            raise AppError(f"料金設定の形式が不正です: {pattern} = {value}")
+        cost_rates[pattern.lower()] = (input_rate, output_rate)
+
+    return cost_rates
+
+
+def find_cost_rate(model_detail, cost_rates):
+    model_detail = str(model_detail or "").lower()
+    for pattern, rates in cost_rates.items():
+        if pattern in model_detail:
+            return rates
+    return None
+
+
+def build_usage_export_query(start_datetime, end_datetime):
+    return {
+        "date": {
+            "$gte": start_datetime,
+            "$lte": end_datetime
+        }
+    }
+
+
+def to_jst(date_value):
+    if not isinstance(date_value, datetime.datetime):
+        return date_value
+    return date_value.astimezone(JST) if date_value.tzinfo else JST.localize(date_value)
+
+
+def normalize_usage_record(record, cost_rates=None):
+    row = {field: record.get(field) for field in USAGE_EXPORT_FIELDS}
+    row["date"] = to_jst(row["date"])
+
+    if cost_rates is not None:
+        rates = find_cost_rate(row["model_detail"], cost_rates)
+        if rates:
+            input_cost = (row["input_tokens"] or 0) * rates[0] / 1_000_000
+            output_cost = (row["output_tokens"] or 0) * rates[1] / 1_000_000
+            row.update({
+                "input_cost": round(input_cost, 6),
+                "output_cost": round(output_cost, 6),
+                "total_cost": round(input_cost + output_cost, 6),
+            })
+        else:
+            row.update({field: None for field in COST_FIELDS})
+
+    return row
+
+
+def iter_usage_batches(start_datetime, end_datetime, batch_size=DEFAULT_BATCH_SIZE, cost_rates=None):
+    """
+    summary_usageをカーソルのバッチ単位で読み出し、正規化済みの行リストを順に返すジェネレータ
+    """
+    usage_collection = get_usage_analytics_collection()
+    projection = {field: 1 for field in USAGE_EXPORT_FIELDS}
+    projection["_id"] = 0
+
+    cursor = usage_collection.find(
+        build_usage_export_query(start_datetime, end_datetime),
+        projection
+    ).sort("date", 1).batch_size(batch_size)
+
+    batch = []
+    try:
+        for record in cursor:
+            batch.append(normalize_usage_record(record, cost_rates))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        cursor.close()
+
+
+def get_export_columns(with_cost=False):
+    return USAGE_EXPORT_FIELDS + (COST_FIELDS if with_cost else [])
+
+
+def export_usage_csv(output, start_datetime, end_datetime, batch_size=DEFAULT_BATCH_SIZE, cost_rates=None):
+    """
+    利用状況をCSVとしてストリーム出力する関数
+    outputはテキストモードのファイルオブジェクト
+    """
+    columns = get_export_columns(cost_rates is not None)
+    writer = csv.DictWriter(output, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+
+    row_count = 0
+    for batch in iter_usage_batches(start_datetime, end_datetime, batch_size, cost_rates):
+        for row in batch:
+            if isinstance(row["date"], datetime.datetime):
+                row["date"] = row["date"].strftime("%Y-%m-%d %H:%M:%S")
+        writer.writerows(batch)
+        row_count += len(batch)
+
+    return row_count
+
+
+def export_usage_parquet(output, start_datetime, end_datetime, batch_size=DEFAULT_BATCH_SIZE,
+                         row_group_size=DEFAULT_ROW_GROUP_SIZE, cost_rates=None):
+    """
+    利用状況をParquetとしてストリーム出力する関数
+    row_group_size件ごとに行グループを書き出すため、保持する行数はrow_group_sizeまでに抑えられる
+    """
+    schema = USAGE_EXPORT_SCHEMA
+    if cost_rates is not None:
+        schema = pa.schema(list(USAGE_EXPORT_SCHEMA) + COST_SCHEMA_FIELDS)
+
+    row_count = 0
+    pending_rows = []
+
+    with pq.ParquetWriter(output, schema, compression="zstd") as writer:
+        for batch in iter_usage_batches(start_datetime, end_datetime, batch_size, cost_rates):
+            pending_rows.extend(batch)
+            while len(pending_rows) >= row_group_size:
+                group, pending_rows = pending_rows[:row_group_size], pending_rows[row_group_size:]
+                writer.write_table(pa.Table.from_pylist(group, schema=schema), row_group_size=row_group_size)
+                row_count += len(group)
+
+        if pending_rows:
+            writer.write_table(pa.Table.from_pylist(pending_rows, schema=schema), row_group_size=row_group_size)
+            row_count += len(pending_rows)
+
+    return row_count
+
+
+def export_usage(output, start_datetime, end_datetime, export_format="csv", batch_size=DEFAULT_BATCH_SIZE,
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE, with_cost=False):
+    if export_format not in EXPORT_FORMATS:
+        raise AppError(f"不明なエクスポート形式: {export_format}")
+
+    cost_rates = load_cost_rates() if with_cost else None
+
+    if export_format == "csv":
+        return export_usage_csv(output, start_datetime, end_datetime, batch_size, cost_rates)
+
+    return export_usage_parquet(output, start_datetime, end_datetime, batch_size, row_group_size, cost_rates)
@@ -0,0 +1,330 @@
+import collections
+import contextvars
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config import get_config, GENERATION_MAX_IN_FLIGHT, GENERATION_MAX_IN_FLIGHT_BY_PROVIDER, GENERATION_MAX_QUEUE_SIZE
+from utils.constants import MESSAGES, MODEL_PROVIDERS
+from utils.cancellation import CancellationToken
+from utils.exceptions import GenerationCancelledError, QueueFullError
+from utils.metrics import IN_FLIGHT, QUEUE_DEPTH, record_cache_request
+
+DURATION_HISTORY_SIZE = 20
+
+PRIORITY_URGENT = "urgent"
+PRIORITY_ROUTINE = "routine"
+PRIORITY_LEVELS = {PRIORITY_URGENT: 0, PRIORITY_ROUTINE: 1}
+PRIORITY_LABELS = {PRIORITY_ROUTINE: "通常", PRIORITY_URGENT: "至急(当日退院)"}
+
+
+def load_department_scheduling_config():
+    """
+    config.iniから診療科ごとの重みと同時実行数の上限を読み込む関数
+    """
+    config = get_config()
+    scheduler_config = config['SCHEDULER'] if 'SCHEDULER' in config else {}
+
+    default_weight = float(scheduler_config.get('default_department_weight', 1))
+    default_max_in_flight = int(scheduler_config.get('default_department_max_in_flight', 0))
+
+    weights = {}
+    if 'DEPARTMENT_WEIGHTS' in config:
+        weights = {dept: float(value) for dept, value in config['DEPARTMENT_WEIGHTS'].items()}
+
+    max_in_flight = {}
+    if 'DEPARTMENT_MAX_IN_FLIGHT' in config:
+        max_in_flight = {dept: int(value) for dept, value in config['DEPARTMENT_MAX_IN_FLIGHT'].items()}
+
+    return default_weight, default_max_in_flight, weights, max_in_flight
+
+
+class GenerationWork:
+    """
+    プロバイダへの1回の呼び出しに対応する実行単位。同一内容の要求はひとつのGenerationWorkを共有する
+    """
+
+    def __init__(self, provider, func, args, kwargs, department="default", priority=PRIORITY_ROUTINE,
+                 cancel_token=None, coalesce_key=None, progress=None):
+        self.work_id = uuid.uuid4().hex
+        self.provider = provider
+        self.department = department
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        # 生成途中の結果。同一要求をまとめた受付票からも参照できるよう実行単位に持たせる
+        self.progress = progress
+        self.virtual_finish = 0.0
+        self.cancel_token = cancel_token or CancellationToken()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # 実行スレッドでも要求元のトレースを引き継ぐため、投入時のコンテキストを保持する
+        self.context = contextvars.copy_context()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.tickets = []
+
+
+class GenerationTicket:
+    """
+    要求元のセッションが保持する受付票。coalescedがTrueの場合は先行する同一要求の結果を待っている
+    billedがTrueの受付票だけがプロバイダの使用トークン数を計上する
+    """
+
+    def __init__(self, work, coalesced=False):
+        self.ticket_id = uuid.uuid4().hex
+        self.work = work
+        self.coalesced = coalesced
+        self.billed = False
+        self.enqueued_at = time.monotonic()
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def provider(self):
+        return self.work.provider
+
+    @property
+    def department(self):
+        return self.work.department
+
+    @property
+    def priority(self):
+        return self.work.priority
+
+    @property
+    def cancel_token(self):
+        return self.work.cancel_token
+
+    @property
+    def started_at(self):
+        return self.work.started_at
+
+    @property
+    def progress(self):
+        return self.work.progress
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, result=None, error=None, finished_at=None):
+        self.result = result
+        self.error = error
+        self.finished_at = finished_at or time.monotonic()
+        self._done.set()
+
+    @property
+    def queue_wait_time(self):
+        if self.started_at is None:
+            return (self.finished_at or time.monotonic()) - self.enqueued_at
+        return max(self.started_at - self.enqueued_at, 0.0)
+
+
+class GenerationScheduler:
+    """
+    プロセス全体で共有するサマリ作成用のワーカープール
+    プロバイダごとに同時実行数を制限し、待ち行列が上限に達した場合は即座に受付を拒否する
+    待ち行列は優先度ごとに、診療科単位の重み付き公平キューイングで実行順を決める
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = GenerationScheduler()
+        return cls._instance
+
+    def __init__(self, default_max_in_flight=GENERATION_MAX_IN_FLIGHT,
+                 max_in_flight_by_provider=GENERATION_MAX_IN_FLIGHT_BY_PROVIDER,
+                 max_queue_size=GENERATION_MAX_QUEUE_SIZE):
+        self.default_max_in_flight = default_max_in_flight
+        self.max_in_flight_by_provider = dict(max_in_flight_by_provider)
+        self.max_queue_size = max_queue_size
+
+        (self.default_department_weight, self.default_department_max_in_flight,
+         self.department_weights, self.department_max_in_flight) = load_department_scheduling_config()
+
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._active_works = {}
+        self._in_flight = collections.Counter()
+        self._department_in_flight = collections.Counter()
+        self._virtual_time = 0.0
+        self._last_virtual_finish = collections.defaultdict(float)
+        self._durations = collections.defaultdict(lambda: collections.deque(maxlen=DURATION_HISTORY_SIZE))
+
+        max_workers = sum(self.get_max_in_flight(provider) for provider in set(MODEL_PROVIDERS.values()))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+
+        QUEUE_DEPTH.set_function(self.get_queue_depth)
+
+    def get_max_in_flight(self, provider):
+        return self.max_in_flight_by_provider.get(provider, self.default_max_in_flight)
+
+    def get_department_weight(self, department):
+        return max(self.department_weights.get(department, self.default_department_weight), 0.01)
+
+    def get_department_max_in_flight(self, department):
+        return self.department_max_in_flight.get(department, self.default_department_max_in_flight)
+
+    def submit(self, provider, func, *args, department="default", priority=PRIORITY_ROUTINE, cancel_token=None,
+               coalesce_key=None, progress=None, **kwargs):
+        """
+        coalesce_keyが同じ要求が実行中または待機中であれば、新たにプロバイダを呼び出さずにその結果を共有する
+        """
+        with self._lock:
+            work = self._active_works.get(coalesce_key) if coalesce_key else None
+            if work and not work.cancel_token.is_cancelled():
+                record_cache_request("single_flight", True)
+                ticket = GenerationTicket(work, coalesced=True)
+                work.tickets.append(ticket)
+                return ticket
+
+            if len(self._waiting) >= self.max_queue_size:
+                raise QueueFullError(MESSAGES["GENERATION_QUEUE_FULL"])
+
+            work = GenerationWork(provider, func, args, kwargs, department, priority, cancel_token, coalesce_key,
+                                  progress)
+            ticket = GenerationTicket(work)
+            work.tickets.append(ticket)
+            if coalesce_key:
+                self._active_works[coalesce_key] = work
+
+            # 診療科ごとの仮想終了時刻。重みが大きい診療科ほど進みが遅く、先に順番が回ってくる
+            virtual_start = max(self._virtual_time, self._last_virtual_finish[department])
+            work.virtual_finish = virtual_start + 1.0 / self.get_department_weight(department)
+            self._last_virtual_finish[department] = work.virtual_finish
+
+            self._waiting.append(work)
+            if coalesce_key:
+                # 取り消し済みの要求が見つかった場合も、新たに投入したため共有できなかったものとして数える
+                record_cache_request("single_flight", False)
+            self._dispatch_locked()
+
+        return ticket
+
+    @staticmethod
+    def _dispatch_order(work):
+        return PRIORITY_LEVELS.get(work.priority, PRIORITY_LEVELS[PRIORITY_ROUTINE]), work.virtual_finish, work.enqueued_at
+
+    def _can_start_locked(self, work):
+        if self._in_flight[work.provider] >= self.get_max_in_flight(work.provider):
+            return False
+        department_limit = self.get_department_max_in_flight(work.department)
+        return not department_limit or self._department_in_flight[work.department] < department_limit
+
+    def _dispatch_locked(self):
+        for work in sorted(self._waiting, key=self._dispatch_order):
+            if not self._can_start_locked(work):
+                continue
+            self._waiting.remove(work)
+            self._in_flight[work.provider] += 1
+            IN_FLIGHT.labels(str(work.provider)).inc()
+            self._department_in_flight[work.department] += 1
+            self._virtual_time = max(self._virtual_time, work.virtual_finish - 1.0 / self.get_department_weight(work.department))
+            work.started_at = time.monotonic()
+            self._executor.submit(self._run, work)
+
+    def _run(self, work):
+        try:
+            work.result = work.context.run(work.func, *work.args, **work.kwargs)
+        except Exception as e:
+            work.error = e
+        finally:
+            work.finished_at = time.monotonic()
+            with self._lock:
+                self._in_flight[work.provider] -= 1
+                IN_FLIGHT.labels(str(work.provider)).dec()
+                self._department_in_flight[work.department] -= 1
+                self._durations[work.provider].append(work.finished_at - work.started_at)
+                self._complete_work_locked(work)
+                self._dispatch_locked()
+
+    def _complete_work_locked(self, work):
+        if work.coalesce_key and self._active_works.get(work.coalesce_key) is work:
+            del self._active_works[work.coalesce_key]
+
+        waiting_tickets = [ticket for ticket in work.tickets if not ticket.done()]
+        if waiting_tickets:
+            waiting_tickets[0].billed = True
+        for ticket in waiting_tickets:
+            ticket._finish(work.result, work.error, work.finished_at)
+
+    def cancel(self, ticket):
+        """
+        受付票をキャンセルする
+        同じ結果を待つ受付票が他に残っている場合はこの受付票だけを切り離し、
+        最後の受付票であれば、待ち行列中ならその場で取り除き、実行中ならキャンセルトークン経由でプロバイダへの要求を中断する
+        実行枠は中断したワーカーの終了時に解放される
+        """
+        work = ticket.work
+        with self._lock:
+            if ticket.done():
+                return
+
+            others = [other for other in work.tickets if other is not ticket and not other.done()]
+            if others:
+                ticket._finish(error=GenerationCancelledError())
+                return
+
+            # ロックを外した後に同じcoalesce_keyの要求がこの処理に合流しないよう、ロック内でキャンセル済みにして切り離す
+            callbacks = work.cancel_token.mark_cancelled()
+            if work.coalesce_key and self._active_works.get(work.coalesce_key) is work:
+                del self._active_works[work.coalesce_key]
+
+            if work in self._waiting:
+                self._waiting.remove(work)
+                work.error = GenerationCancelledError()
+                work.finished_at = time.monotonic()
+                self._complete_work_locked(work)
+
+        work.cancel_token.run_callbacks(callbacks)
+
+    def get_queue_position(self, ticket):
+        """
+        同じプロバイダの待ち行列における順番(1始まり)を返す。実行中または完了済みの場合は0
+        """
+        with self._lock:
+            position = 0
+            for work in sorted(self._waiting, key=self._dispatch_order):
+                if work.provider == ticket.provider:
+                    position += 1
+                if work is ticket.work:
+                    return position
+        return 0
+
+    def estimate_wait_time(self, ticket):
+        position = self.get_queue_position(ticket)
+        if position == 0:
+            return 0.0
+
+        with self._lock:
+            durations = self._durations[ticket.provider]
+            average_duration = sum(durations) / len(durations) if durations else 30.0
+
+        rounds = (position - 1) // self.get_max_in_flight(ticket.provider) + 1
+        return rounds * average_duration
+
+    def get_queue_depth(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def get_queue_depth_by_department(self):
+        with self._lock:
+            return dict(collections.Counter(work.department for work in self._waiting))
+
+    def get_in_flight(self):
+        with self._lock:
+            return dict(self._in_flight)
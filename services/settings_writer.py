@@ -0,0 +1,154 @@
+import atexit
+import collections
+import datetime
+import threading
+import time
+
+from database.db import get_settings_collection
+from utils.config import USER_SETTINGS_DEBOUNCE_SECONDS, USER_SETTINGS_MAX_DELAY_SECONDS
+from utils.metrics import record_cache_request
+
+LEGACY_SETTING_ID = "user_preferences"
+MAX_CACHED_USERS = 1000
+RETRY_INTERVAL = 10
+
+
+def get_setting_id(user_id):
+    return f"{LEGACY_SETTING_ID}:{user_id}"
+
+
+class UserSettingsWriter:
+    """
+    利用者ごとの設定をメモリに保持し、変更をまとめて書き込むバックグラウンドライター
+    続けて変更された場合は最後の変更からdebounce秒待ち、ひとつのupsertにまとめる
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = UserSettingsWriter()
+                    cls._instance.start()
+        return cls._instance
+
+    def __init__(self, debounce=USER_SETTINGS_DEBOUNCE_SECONDS, max_delay=USER_SETTINGS_MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._cache = collections.OrderedDict()
+        # setting_id -> (未書き込みの項目, 最初の変更時刻, 最後の変更時刻)
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="settings-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get(self, setting_id):
+        """
+        設定を返す。メモリにない場合だけデータベースから読み、見つからない場合はNoneを返す
+        """
+        with self._condition:
+            if setting_id in self._cache:
+                self._cache.move_to_end(setting_id)
+                record_cache_request("user_settings", True)
+                return self._cache[setting_id]
+
+        record_cache_request("user_settings", False)
+        settings = get_settings_collection().find_one({"setting_id": setting_id})
+
+        with self._condition:
+            # 読み出し中に変更された場合は、変更後の内容を優先する
+            if setting_id not in self._cache:
+                self._store(setting_id, settings)
+            return self._cache[setting_id]
+
+    def _store(self, setting_id, settings):
+        self._cache[setting_id] = settings
+        self._cache.move_to_end(setting_id)
+        while len(self._cache) > MAX_CACHED_USERS:
+            oldest_id = next(iter(self._cache))
+            if oldest_id in self._pending:
+                # 未書き込みの設定はメモリから捨てない
+                self._cache.move_to_end(oldest_id)
+                break
+            self._cache.popitem(last=False)
+
+    def update(self, setting_id, fields):
+        now = time.monotonic()
+        with self._condition:
+            cached = dict(self._cache.get(setting_id) or {"setting_id": setting_id})
+            cached.update(fields)
+            self._store(setting_id, cached)
+
+            pending_fields, first_changed_at, _ = self._pending.get(setting_id, ({}, now, now))
+            self._pending[setting_id] = ({**pending_fields, **fields}, first_changed_at, now)
+            self._condition.notify()
+
+    def _due_at(self, first_changed_at, last_changed_at):
+        # 変更が続いても、最初の変更からmax_delay秒以内には書き込む
+        return min(last_changed_at + self.debounce, first_changed_at + self.max_delay)
+
+    def _take_due(self, force=False):
+        now = time.monotonic()
+        with self._condition:
+            due = {
+                setting_id: pending for setting_id, pending in self._pending.items()
+                if force or self._due_at(pending[1], pending[2]) <= now
+            }
+            for setting_id in due:
+                del self._pending[setting_id]
+            return due
+
+    def _next_wait(self):
+        if not self._pending:
+            return None
+        now = time.monotonic()
+        return max(min(self._due_at(first, last) for _, first, last in self._pending.values()) - now, 0)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                wait = self._next_wait()
+                if wait is None or wait > 0:
+                    self._condition.wait(timeout=wait)
+                    continue
+
+            if not self.flush(force=False):
+                self._stopped.wait(RETRY_INTERVAL)
+
+    def flush(self, force=True):
+        """
+        未書き込みの設定を書き込む。forceがFalseの場合は待ち時間を過ぎたものだけを書き込む
+        書き込みに失敗した設定は、その後の変更とまとめて再度書き込む
+        """
+        success = True
+        for setting_id, (fields, first_changed_at, last_changed_at) in self._take_due(force).items():
+            try:
+                get_settings_collection().update_one(
+                    {"setting_id": setting_id},
+                    {"$set": {**fields, "updated_at": datetime.datetime.now()}},
+                    upsert=True
+                )
+            except Exception as e:
+                print(f"設定の保存に失敗しました: {str(e)}")
+                success = False
+                with self._condition:
+                    newer_fields, _, newer_changed_at = self._pending.get(setting_id, ({}, None, last_changed_at))
+                    self._pending[setting_id] = ({**fields, **newer_fields}, first_changed_at, newer_changed_at)
+        return success
+
+    def get_pending_count(self):
+        with self._condition:
+            return len(self._pending)
+
+    def close(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+        self.flush()
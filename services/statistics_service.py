@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from pymongo.errors import OperationFailure
+
+LATENCY_PERCENTILES = [0.5, 0.95]
+TIME_BUCKET_UNITS = {"時間": "hour", "日": "day"}
+
+
+def build_latency_pipeline(query, group_id, use_percentile_operator=True, field="processing_time"):
+    group_stage = {
+        "_id": group_id,
+        "count": {"$sum": 1},
+        "avg_time": {"$avg": f"${field}"},
+        "max_time": {"$max": f"${field}"},
+    }
+
+    if use_percentile_operator:
+        # $percentileはMongoDB 7.0以降のみ対応
+        group_stage["percentiles"] = {
+            "$percentile": {
+                "input": f"${field}",
+                "p": LATENCY_PERCENTILES,
+                "method": "approximate"
+            }
+        }
+    else:
+        group_stage["times"] = {"$push": f"${field}"}
+
+    return [
+        {"$match": {**query, field: {"$type": "number"}}},
+        {"$group": group_stage},
+    ]
+
+
+def aggregate_latency(usage_collection, query, group_id, field="processing_time"):
+    """
+    処理時間(既定はprocessing_time)の件数・平均・p50/p95を集計する関数
+    $percentileが使えないサーバーでは処理時間を集めてnumpyで計算する
+    """
+    try:
+        results = list(usage_collection.aggregate(build_latency_pipeline(query, group_id, field=field)))
+    except OperationFailure:
+        results = list(usage_collection.aggregate(build_latency_pipeline(query, group_id, False, field)))
+        for result in results:
+            times = result.pop("times", [])
+            result["percentiles"] = list(np.quantile(times, LATENCY_PERCENTILES)) if times else [None, None]
+
+    rows = []
+    for result in results:
+        p50, p95 = result.get("percentiles") or [None, None]
+        rows.append({
+            **result["_id"],
+            "count": result["count"],
+            "avg_time": result["avg_time"],
+            "p50_time": p50,
+            "p95_time": p95,
+            "max_time": result["max_time"],
+        })
+
+    return pd.DataFrame(rows)
+
+
+def get_latency_by_model_and_department(usage_collection, query):
+    return aggregate_latency(
+        usage_collection,
+        query,
+        {"model_detail": "$model_detail", "department": "$department"}
+    )
+
+
+def get_latency_time_series(usage_collection, query, unit="hour"):
+    df = aggregate_latency(
+        usage_collection,
+        query,
+        {
+            "bucket": {"$dateTrunc": {"date": "$date", "unit": unit, "timezone": "Asia/Tokyo"}},
+            "model_detail": "$model_detail",
+        }
+    )
+    if not df.empty:
+        df = df.sort_values("bucket")
+    return df
+
+
+def get_queue_wait_by_department(usage_collection, query):
+    return aggregate_latency(
+        usage_collection,
+        query,
+        {"department": "$department", "priority": "$priority"},
+        field="queue_wait_time"
+    )
+
+
+def get_output_tokens_by_output_mode(usage_collection, query):
+    """
+    出力形式(テキスト/JSON)ごとの平均トークン数を集計する関数
+    共有結果やキャンセルはトークン数が実際の出力と一致しないため除く
+    """
+    pipeline = [
+        {"$match": {**query, "status": "completed", "generation_type": "fresh"}},
+        {"$group": {
+            "_id": {"model_detail": "$model_detail", "output_mode": {"$ifNull": ["$output_mode", "text"]}},
+            "count": {"$sum": 1},
+            "avg_input_tokens": {"$avg": "$input_tokens"},
+            "avg_output_tokens": {"$avg": "$output_tokens"},
+        }},
+        {"$sort": {"_id.model_detail": 1, "_id.output_mode": 1}},
+    ]
+    rows = [
+        {**result["_id"], **{key: value for key, value in result.items() if key != "_id"}}
+        for result in usage_collection.aggregate(pipeline)
+    ]
+    return pd.DataFrame(rows)
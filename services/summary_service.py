@@ -1,86 +1,321 @@
 import datetime
-import queue
+import hashlib
 import threading
 import time
 
 import pytz
 import streamlit as st
 
-from database.db import get_usage_collection
 from external_service.claude_api import claude_generate_summary
 from external_service.gemini_api import gemini_generate_summary
 from external_service.openai_api import openai_generate_summary
-from utils.config import CLAUDE_API_KEY, GEMINI_CREDENTIALS, GEMINI_FLASH_MODEL, GEMINI_MODEL, MAX_INPUT_TOKENS, MIN_INPUT_TOKENS, OPENAI_API_KEY, OPENAI_MODEL
-from utils.constants import APP_TYPE, DOCUMENT_NAME, MESSAGES
-from utils.error_handlers import handle_error
-from utils.exceptions import APIError
-from utils.text_processor import format_discharge_summary, parse_discharge_summary
+from services.generation_scheduler import GenerationScheduler, PRIORITY_ROUTINE
+from services.usage_writer import UsageWriter
+from utils.config import CLAUDE_API_KEY, GEMINI_CREDENTIALS, GEMINI_FLASH_MODEL, GEMINI_MODEL, MAX_INPUT_TOKENS, MIN_INPUT_TOKENS, OPENAI_API_KEY, OPENAI_MODEL, SECTION_REGENERATION_MAX_TOKENS, SUMMARY_OUTPUT_MODE, get_config
+from utils.constants import APP_TYPE, DOCUMENT_NAME, MESSAGES, MODEL_PROVIDERS
+from utils.error_handlers import get_error_message, handle_error
+from utils.cancellation import CancellationToken
+from utils.exceptions import APIError, GenerationCancelledError, QueueFullError
+from utils.input_compaction import compact_input_text, extract_new_lines, get_line_fingerprint, load_compaction_config
+from utils.metrics import record_generation
+from utils.prompt_manager import get_department_by_name, get_department_section_names
+from utils.text_processor import format_discharge_summary, get_section_names, IncrementalSectionParser, join_summary_sections, parse_discharge_summary, parse_structured_summary, strip_section_header
+from utils.tracing import start_span
 
 JST = pytz.timezone('Asia/Tokyo')
 
 
-def generate_summary_task(input_text, selected_department, selected_model, result_queue, additional_info=""):
-    try:
-        match selected_model:
-            case "Claude" if CLAUDE_API_KEY:
-                discharge_summary, input_tokens, output_tokens = claude_generate_summary(
+def get_model_detail(selected_model):
+    match selected_model:
+        case "Gemini_Pro":
+            return GEMINI_MODEL
+        case "Gemini_Flash":
+            return GEMINI_FLASH_MODEL
+        case _:
+            return selected_model
+
+
+def call_provider(input_text, selected_department, selected_model, additional_info="", cancel_token=None,
+                  on_chunk=None, response_sections=None, prompt=None, max_tokens=None):
+    match selected_model:
+        case "Claude" if CLAUDE_API_KEY:
+            discharge_summary, input_tokens, output_tokens = claude_generate_summary(
+                input_text,
+                additional_info,
+                selected_department,
+                cancel_token=cancel_token,
+                on_chunk=on_chunk,
+                response_sections=response_sections,
+                prompt=prompt,
+                max_tokens=max_tokens,
+            )
+            model_detail = selected_model
+
+        case "Gemini_Pro" if GEMINI_MODEL and GEMINI_CREDENTIALS:
+            discharge_summary, input_tokens, output_tokens = gemini_generate_summary(
+                input_text,
+                additional_info,
+                selected_department,
+                GEMINI_MODEL,
+                cancel_token=cancel_token,
+                on_chunk=on_chunk,
+                response_sections=response_sections,
+                prompt=prompt,
+                max_tokens=max_tokens,
+            )
+            model_detail = GEMINI_MODEL
+
+        case "Gemini_Flash" if GEMINI_FLASH_MODEL and GEMINI_CREDENTIALS:
+            discharge_summary, input_tokens, output_tokens = gemini_generate_summary(
+                input_text,
+                additional_info,
+                selected_department,
+                GEMINI_FLASH_MODEL,
+                cancel_token=cancel_token,
+                on_chunk=on_chunk,
+                response_sections=response_sections,
+                prompt=prompt,
+                max_tokens=max_tokens,
+            )
+            model_detail = GEMINI_FLASH_MODEL
+
+        case "GPT4.1" if OPENAI_API_KEY:
+            try:
+                discharge_summary, input_tokens, output_tokens = openai_generate_summary(
                     input_text,
                     additional_info,
                     selected_department,
+                    cancel_token=cancel_token,
+                    on_chunk=on_chunk,
+                    response_sections=response_sections,
+                    prompt=prompt,
+                    max_tokens=max_tokens,
                 )
                 model_detail = selected_model
+            except GenerationCancelledError:
+                raise
+            except Exception as e:
+                error_str = str(e)
+                if "insufficient_quota" in error_str or "exceeded your current quota" in error_str:
+                    raise APIError(
+                        "OpenAI APIのクォータを超過しています。請求情報を確認するか、管理者に連絡してください。")
+                else:
+                    raise e
+
+        case _:
+            raise APIError(MESSAGES["NO_API_CREDENTIALS"])
+
+    return discharge_summary, input_tokens, output_tokens, model_detail
+
+
+def get_extra_sections(selected_department):
+    try:
+        return get_department_section_names(selected_department)
+    except Exception as e:
+        print(f"見出し名の取得に失敗しました: {str(e)}")
+        return None
+
+
+def is_input_compaction_enabled(selected_department):
+    if selected_department == "default":
+        return True
+    try:
+        department = get_department_by_name(selected_department)
+        return department.get("input_compaction", True) if department else True
+    except Exception as e:
+        print(f"診療科の設定の取得に失敗しました: {str(e)}")
+        return True
+
+
+def compact_input(input_text, selected_department):
+    """
+    診療科の設定で無効にされていなければ、カルテ記載の重複や空白を除く
+    除いた量はトークン数ではなく文字数で返す
+    """
+    compaction_config = load_compaction_config()
+    if not compaction_config.pop("enabled") or not is_input_compaction_enabled(selected_department):
+        return input_text, 0
+    return compact_input_text(input_text, **compaction_config)
+
+
+class SummaryProgress:
+    """
+    生成途中のサマリを見出しごとに保持する。ワーカースレッドが追記し、画面側が随時読み取る
+    """
+
+    def __init__(self, extra_sections=None):
+        self._parser = IncrementalSectionParser(extra_sections)
+        self._lock = threading.Lock()
+
+    def append(self, chunk):
+        with self._lock:
+            self._parser.feed(format_discharge_summary(chunk))
+
+    def get_sections(self):
+        with self._lock:
+            return self._parser.get_sections()
+
+
+def generate_summary_task(input_text, selected_department, selected_model, additional_info="", cancel_token=None,
+                          on_chunk=None, previous_summary=None):
+    """
+    previous_summaryを渡した場合は、input_textを追加分のカルテ記載としてサマリを更新する
+    """
+    try:
+        with start_span("generate_summary_task", department=selected_department, model=selected_model,
+                        output_mode=SUMMARY_OUTPUT_MODE):
+            extra_sections = get_extra_sections(selected_department)
+            response_sections = get_section_names(extra_sections) if SUMMARY_OUTPUT_MODE == "json" else None
+
+            with start_span("input_compaction") as span:
+                input_text, compaction_chars_saved = compact_input(input_text, selected_department)
+                span.set_attribute("chars_saved", compaction_chars_saved)
 
-            case "Gemini_Pro" if GEMINI_MODEL and GEMINI_CREDENTIALS:
-                discharge_summary, input_tokens, output_tokens = gemini_generate_summary(
+            prompt = create_update_prompt(previous_summary, input_text, additional_info) if previous_summary else None
+
+            api_start_time = time.perf_counter()
+            with start_span("provider_call", model=selected_model) as span:
+                discharge_summary, input_tokens, output_tokens, model_detail = call_provider(
                     input_text,
-                    additional_info,
                     selected_department,
-                    GEMINI_MODEL,
+                    selected_model,
+                    additional_info,
+                    cancel_token,
+                    # JSONは見出し単位で区切れないため、生成途中の表示はテキスト出力の場合のみ行う
+                    None if response_sections else on_chunk,
+                    response_sections,
+                    prompt
                 )
-                model_detail = GEMINI_MODEL
+                span.set_attribute("input_tokens", input_tokens)
+                span.set_attribute("output_tokens", output_tokens)
+            api_processing_time = time.perf_counter() - api_start_time
+
+            output_mode = "text"
+            parsed_summary = None
+            if response_sections:
+                with start_span("parse_structured_summary") as span:
+                    try:
+                        parsed_summary = parse_structured_summary(discharge_summary, response_sections)
+                        discharge_summary = join_summary_sections(parsed_summary)
+                        output_mode = "json"
+                    except ValueError as e:
+                        print(f"構造化出力の検証に失敗したため、テキストとして解析します: {str(e)}")
+                        span.set_attribute("fallback", True)
+                        output_mode = "json_fallback"
+
+            if parsed_summary is None:
+                with start_span("format_discharge_summary"):
+                    discharge_summary = format_discharge_summary(discharge_summary)
+                with start_span("parse_discharge_summary"):
+                    parsed_summary = parse_discharge_summary(discharge_summary, extra_sections)
+
+        return {
+            "success": True,
+            "discharge_summary": discharge_summary,
+            "parsed_summary": parsed_summary,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "model_detail": model_detail,
+            "api_processing_time": api_processing_time,
+            "output_mode": output_mode,
+            "compaction_chars_saved": compaction_chars_saved
+        }
+
+    except Exception as e:
+        return {"success": False, "error": e}
+
+
+def create_section_prompt(section, parsed_summary, input_text, additional_info=""):
+    """
+    1項目だけを書き直すためのプロンプト。診療科のフォーマット指定は含めず、現在のサマリを文脈として渡す
+    """
+    current_summary = join_summary_sections(parsed_summary)
+    prompt_template = get_config()['PROMPTS']['section_regeneration']
+    instruction = prompt_template.format(section=section, current_summary=current_summary)
+    return f"{instruction}\n\n【カルテ情報】\n{additional_info}\n{input_text}"
+
+
+def create_update_prompt(previous_summary, new_input_text, additional_info=""):
+    """
+    前回のサマリと、前回以降に追加されたカルテ記載だけで更新を依頼するプロンプト
+    """
+    prompt_template = get_config()['PROMPTS']['summary_update']
+    instruction = prompt_template.format(current_summary=join_summary_sections(previous_summary))
+    return f"{instruction}\n\n【追加されたカルテ情報】\n{additional_info}\n{new_input_text}"
 
-            case "Gemini_Flash" if GEMINI_FLASH_MODEL and GEMINI_CREDENTIALS:
-                discharge_summary, input_tokens, output_tokens = gemini_generate_summary(
+
+def generate_section_task(input_text, selected_department, selected_model, section, parsed_summary,
+                          additional_info="", cancel_token=None):
+    try:
+        with start_span("generate_section_task", department=selected_department, model=selected_model,
+                        section=section):
+            with start_span("input_compaction") as span:
+                input_text, compaction_chars_saved = compact_input(input_text, selected_department)
+                span.set_attribute("chars_saved", compaction_chars_saved)
+
+            prompt = create_section_prompt(section, parsed_summary, input_text, additional_info)
+
+            api_start_time = time.perf_counter()
+            with start_span("provider_call", model=selected_model) as span:
+                section_text, input_tokens, output_tokens, model_detail = call_provider(
                     input_text,
-                    additional_info,
                     selected_department,
-                    GEMINI_FLASH_MODEL,
+                    selected_model,
+                    additional_info,
+                    cancel_token,
+                    prompt=prompt,
+                    max_tokens=SECTION_REGENERATION_MAX_TOKENS
                 )
-                model_detail = GEMINI_FLASH_MODEL
-
-            case "GPT4.1" if OPENAI_API_KEY:
-                try:
-                    discharge_summary, input_tokens, output_tokens = openai_generate_summary(
-                        input_text,
-                        additional_info,
-                        selected_department,
-                    )
-                    model_detail = selected_model
-                except Exception as e:
-                    error_str = str(e)
-                    if "insufficient_quota" in error_str or "exceeded your current quota" in error_str:
-                        raise APIError(
-                            "OpenAI APIのクォータを超過しています。請求情報を確認するか、管理者に連絡してください。")
-                    else:
-                        raise e
-
-            case _:
-                raise APIError(MESSAGES["NO_API_CREDENTIALS"])
-
-        discharge_summary = format_discharge_summary(discharge_summary)
-        parsed_summary = parse_discharge_summary(discharge_summary)
-
-        result_queue.put({
+                span.set_attribute("input_tokens", input_tokens)
+                span.set_attribute("output_tokens", output_tokens)
+            api_processing_time = time.perf_counter() - api_start_time
+
+        return {
             "success": True,
-            "discharge_summary": discharge_summary,
-            "parsed_summary": parsed_summary,
+            "section": section,
+            "section_text": strip_section_header(section_text, section),
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
-            "model_detail": model_detail
-        })
+            "model_detail": model_detail,
+            "api_processing_time": api_processing_time,
+            "output_mode": "text",
+            "compaction_chars_saved": compaction_chars_saved
+        }
 
     except Exception as e:
-        result_queue.put({"success": False, "error": e})
+        return {"success": False, "error": e}
+
+
+def submit_generation(span_name, task, task_args, cancel_token, selected_department, selected_model, coalesce_key,
+                      progress=None, **job_fields):
+    """
+    サマリ作成の処理をスケジューラに投入し、画面側で状況を追跡するための情報をセッションに保存する
+    """
+    priority = st.session_state.get("generation_priority", PRIORITY_ROUTINE)
+
+    with start_span(span_name, department=selected_department, model=selected_model) as span:
+        ticket = GenerationScheduler.get_instance().submit(
+            MODEL_PROVIDERS.get(selected_model),
+            task,
+            *task_args,
+            department=selected_department,
+            priority=priority,
+            cancel_token=cancel_token,
+            coalesce_key=coalesce_key,
+            progress=progress
+        )
+        span.set_attribute("coalesced", ticket.coalesced)
+
+    st.session_state.generation_job = {
+        "ticket": ticket,
+        "start_time": datetime.datetime.now(),
+        "selected_model": selected_model,
+        "selected_department": selected_department,
+        "priority": priority,
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        **job_fields,
+    }
 
 
 @handle_error
@@ -102,70 +337,289 @@ def process_summary(input_text, additional_info=""):
         return
 
     try:
-        start_time = datetime.datetime.now()
-        status_placeholder = st.empty()
-        result_queue = queue.Queue()
-
         available_models = getattr(st.session_state, "available_models", [])
         selected_model = getattr(st.session_state, "selected_model",
                                  available_models[0] if available_models else None)
         selected_department = getattr(st.session_state, "selected_department", "default")
 
-        summary_thread = threading.Thread(
-            target=generate_summary_task,
-            args=(
-                input_text,
-                selected_department,
-                selected_model,
-                result_queue,
-                additional_info
-            ),
+        cancel_token = CancellationToken()
+        progress = SummaryProgress(get_extra_sections(selected_department))
+
+        submit_generation(
+            "process_summary",
+            generate_summary_task,
+            (input_text, selected_department, selected_model, additional_info, cancel_token, progress.append),
+            cancel_token,
+            selected_department,
+            selected_model,
+            create_coalesce_key(input_text, additional_info, selected_department, selected_model),
+            progress,
+            input_text=input_text,
+            additional_info=additional_info
         )
-        summary_thread.start()
-        elapsed_time = 0
 
-        with st.spinner("サマリ作成中..."):
-            status_placeholder.text(f"⏱️ 経過時間: {elapsed_time}秒")
-            while summary_thread.is_alive():
-                time.sleep(1)
-                elapsed_time = int((datetime.datetime.now() - start_time).total_seconds())
-                status_placeholder.text(f"⏱️ 経過時間: {elapsed_time}秒")
+    except QueueFullError as e:
+        st.warning(str(e))
+    except Exception as e:
+        raise APIError(f"退院時サマリの作成中にエラーが発生しました: {str(e)}")
 
-        summary_thread.join()
-        status_placeholder.empty()
-        result = result_queue.get()
 
-        if result["success"]:
-            st.session_state.discharge_summary = result["discharge_summary"]
-            st.session_state.parsed_summary = result["parsed_summary"]
+@handle_error
+def update_summary(input_text, additional_info=""):
+    """
+    前回作成したサマリに、前回以降に追記されたカルテ記載だけを反映させる
+    """
+    if not GEMINI_CREDENTIALS and not CLAUDE_API_KEY and not OPENAI_API_KEY:
+        raise APIError(MESSAGES["NO_API_CREDENTIALS"])
 
-            input_tokens = result["input_tokens"]
-            output_tokens = result["output_tokens"]
-            model_detail = result["model_detail"]
-            end_time = datetime.datetime.now()
-            processing_time = (end_time - start_time).total_seconds()
-            st.session_state.summary_generation_time = processing_time
+    source = st.session_state.get("summary_source")
+    if not source or not st.session_state.parsed_summary:
+        st.warning(MESSAGES["NO_SUMMARY_TO_UPDATE"])
+        return
 
-            try:
-                usage_collection = get_usage_collection()
-                now_jst = datetime.datetime.now().astimezone(JST)
-                usage_data = {
-                    "date": now_jst,
-                    "app_type": APP_TYPE,
-                    "document_name": DOCUMENT_NAME,
-                    "model_detail": model_detail,
-                    "department": selected_department,
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": input_tokens + output_tokens,
-                    "processing_time": round(processing_time)
-                }
-                usage_collection.insert_one(usage_data)
-            except Exception as db_error:
-                st.warning(f"利用状況のDB保存中にエラーが発生しました: {str(db_error)}")
+    if len(input_text.strip()) > MAX_INPUT_TOKENS:
+        st.warning(f"{MESSAGES['INPUT_TOO_LONG']}")
+        return
 
-        else:
-            raise result['error']
+    new_input_text = extract_new_lines(input_text, source["fingerprint"])
+    if not new_input_text:
+        st.warning(MESSAGES["NO_NEW_INPUT"])
+        return
+
+    try:
+        # 元のサマリと同じプロンプト・モデルで更新するため、作成時の診療科とモデルを使う
+        selected_model = get_source_model(source)
+        selected_department = source["selected_department"]
+        previous_summary = dict(st.session_state.parsed_summary)
+
+        cancel_token = CancellationToken()
+        progress = SummaryProgress(get_extra_sections(selected_department))
 
+        submit_generation(
+            "update_summary",
+            generate_summary_task,
+            (new_input_text, selected_department, selected_model, additional_info, cancel_token, progress.append,
+             previous_summary),
+            cancel_token,
+            selected_department,
+            selected_model,
+            create_coalesce_key(new_input_text, additional_info, selected_department, selected_model,
+                                join_summary_sections(previous_summary)),
+            progress,
+            input_text=input_text,
+            additional_info=additional_info,
+            generation_type="update"
+        )
+
+    except QueueFullError as e:
+        st.warning(str(e))
     except Exception as e:
-        raise APIError(f"退院時サマリの作成中にエラーが発生しました: {str(e)}")
+        raise APIError(f"退院時サマリの更新中にエラーが発生しました: {str(e)}")
+
+
+def get_source_model(source):
+    """
+    表示中のサマリを作成したモデル。記録がない場合は現在選択しているモデルを使う
+    """
+    if source.get("selected_model"):
+        return source["selected_model"]
+    available_models = getattr(st.session_state, "available_models", [])
+    return getattr(st.session_state, "selected_model", available_models[0] if available_models else None)
+
+
+@handle_error
+def regenerate_section(section):
+    """
+    表示中のサマリのうち1項目だけを再作成する
+    """
+    source = st.session_state.get("summary_source")
+    if not source or not st.session_state.parsed_summary:
+        st.warning(MESSAGES["NO_SUMMARY_TO_REGENERATE"])
+        return
+
+    try:
+        selected_model = get_source_model(source)
+        selected_department = source["selected_department"]
+        parsed_summary = dict(st.session_state.parsed_summary)
+
+        cancel_token = CancellationToken()
+        submit_generation(
+            "regenerate_section",
+            generate_section_task,
+            (source["input_text"], selected_department, selected_model, section, parsed_summary,
+             source["additional_info"], cancel_token),
+            cancel_token,
+            selected_department,
+            selected_model,
+            create_coalesce_key(source["input_text"], source["additional_info"], selected_department, selected_model,
+                                section, join_summary_sections(parsed_summary)),
+            section=section,
+            generation_type="section"
+        )
+
+    except QueueFullError as e:
+        st.warning(str(e))
+    except Exception as e:
+        raise APIError(f"{section}の再作成中にエラーが発生しました: {str(e)}")
+
+
+def create_coalesce_key(input_text, additional_info, selected_department, selected_model, *extra_parts):
+    """
+    同一内容の同時要求をまとめるためのキー
+    プロンプトは診療科のテンプレートと入力から決まるため、診療科・モデル・入力のハッシュをキーとする
+    項目の再作成では、対象の項目と現在のサマリもキーに含める
+    """
+    key_source = "\0".join([str(selected_model), selected_department, additional_info or "", input_text, *extra_parts])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def get_generation_status(job):
+    """
+    実行中のサマリ作成の状況を表示用の文字列で返す
+    """
+    scheduler = GenerationScheduler.get_instance()
+    ticket = job["ticket"]
+    elapsed_time = int((datetime.datetime.now() - job["start_time"]).total_seconds())
+
+    queue_position = scheduler.get_queue_position(ticket)
+    if queue_position:
+        expected_wait = scheduler.estimate_wait_time(ticket)
+        return f"⏳ 順番待ち: {queue_position}番目 (予想待ち時間: 約{expected_wait:.0f}秒) / 経過時間: {elapsed_time}秒"
+
+    if ticket.cancel_token.is_cancelled():
+        return f"⏹️ キャンセル中... / 経過時間: {elapsed_time}秒"
+
+    if ticket.coalesced:
+        return f"⏱️ 同じ内容のサマリを作成中のため、その結果を待っています... 経過時間: {elapsed_time}秒"
+
+    if job.get("section"):
+        return f"⏱️ {job['section']}を再作成中... 経過時間: {elapsed_time}秒"
+
+    return f"⏱️ サマリ作成中... 経過時間: {elapsed_time}秒"
+
+
+def cancel_summary():
+    job = st.session_state.get("generation_job")
+    if job:
+        GenerationScheduler.get_instance().cancel(job["ticket"])
+
+
+def build_usage_data(job, model_detail, input_tokens, output_tokens, processing_time, status, **extra_fields):
+    now_jst = datetime.datetime.now().astimezone(JST)
+    ticket = job["ticket"]
+    if not ticket.billed:
+        # 先行する同一要求の結果を共有した場合、トークンは先行要求の側で計上する
+        input_tokens = output_tokens = 0
+    input_tokens = input_tokens or 0
+    output_tokens = output_tokens or 0
+    usage_data = {
+        "date": now_jst,
+        "app_type": APP_TYPE,
+        "document_name": DOCUMENT_NAME,
+        "model_detail": model_detail,
+        "department": job["selected_department"],
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens,
+        "processing_time": round(processing_time, 3),
+        "queue_wait_time": round(ticket.queue_wait_time, 3),
+        "priority": job["priority"],
+        "status": status,
+        # 種類は既存の処理に合流したかどうかで決める。トークンの計上(billed)とは独立している
+        "generation_type": "coalesced" if ticket.coalesced else job.get("generation_type", "fresh"),
+        "work_id": ticket.work.work_id,
+        "trace_id": job["trace_id"],
+        # 時系列コレクションのmetaField。診療科とモデルごとにまとめて保存される
+        "meta": {"department": job["selected_department"], "model_detail": model_detail},
+    }
+    if job.get("section"):
+        usage_data["section"] = job["section"]
+    usage_data.update(extra_fields)
+    return usage_data
+
+
+def save_usage(usage_data):
+    record_generation(
+        usage_data["model_detail"],
+        usage_data["department"],
+        usage_data["status"],
+        usage_data["generation_type"],
+        usage_data["processing_time"],
+        usage_data["input_tokens"],
+        usage_data["output_tokens"]
+    )
+
+    try:
+        with start_span("usage_enqueue"):
+            UsageWriter.get_instance().enqueue(usage_data)
+    except Exception as db_error:
+        st.warning(f"利用状況のDB保存中にエラーが発生しました: {str(db_error)}")
+
+
+def finalize_summary():
+    """
+    完了したサマリ作成の結果をセッションに反映し、利用状況を記録する
+    呼び出し後すぐに再描画するため、エラーはst.errorで表示せずerror_messageに保存し、再描画後に表示する
+    """
+    job = st.session_state.pop("generation_job", None)
+    if not job:
+        return
+
+    try:
+        with start_span("finalize_summary", trace_id=job["trace_id"], parent_id=job["span_id"]):
+            apply_summary_result(job)
+    except Exception as e:
+        st.session_state.error_message = get_error_message(e)
+
+
+def apply_summary_result(job):
+    ticket = job["ticket"]
+    processing_time = (ticket.finished_at or time.monotonic()) - ticket.enqueued_at
+
+    result = ticket.result or {"success": False, "error": ticket.error or GenerationCancelledError()}
+
+    if result["success"]:
+        if job.get("section"):
+            parsed_summary = dict(st.session_state.parsed_summary)
+            parsed_summary[result["section"]] = result["section_text"]
+            st.session_state.parsed_summary = parsed_summary
+            st.session_state.discharge_summary = join_summary_sections(parsed_summary)
+        else:
+            st.session_state.discharge_summary = result["discharge_summary"]
+            st.session_state.parsed_summary = result["parsed_summary"]
+            st.session_state.summary_source = {
+                "input_text": job["input_text"],
+                "additional_info": job["additional_info"],
+                "selected_department": job["selected_department"],
+                "selected_model": job["selected_model"],
+                "fingerprint": get_line_fingerprint(job["input_text"]),
+            }
+        st.session_state.summary_generation_time = processing_time
+
+        save_usage(build_usage_data(
+            job,
+            result["model_detail"],
+            result["input_tokens"],
+            result["output_tokens"],
+            processing_time,
+            "completed",
+            api_processing_time=round(result["api_processing_time"], 3),
+            output_mode=result["output_mode"],
+            compaction_chars_saved=result["compaction_chars_saved"] if job["ticket"].billed else 0
+        ))
+        return
+
+    error = result["error"]
+    if isinstance(error, GenerationCancelledError):
+        save_usage(build_usage_data(
+            job,
+            get_model_detail(job["selected_model"]),
+            error.input_tokens,
+            error.output_tokens,
+            processing_time,
+            "cancelled"
+        ))
+        st.session_state.success_message = str(error)
+        return
+
+    raise APIError(f"退院時サマリの作成中にエラーが発生しました: {str(error)}")
@@ -0,0 +1,204 @@
+import atexit
+import collections
+import datetime
+import os
+import threading
+import time
+
+from bson import ObjectId, json_util
+
+from database.db import get_usage_collection, insert_new_documents
+from utils.config import USAGE_SPOOL_PATH, USAGE_WRITER_BATCH_SIZE, USAGE_WRITER_FLUSH_INTERVAL, USAGE_WRITER_MAX_BUFFER
+from utils.metrics import USAGE_WRITER_BUFFERED, USAGE_WRITER_DROPPED
+from utils.tracing import start_span
+
+
+class UsageWriter:
+    """
+    summary_usageへの書き込みをリクエスト処理から切り離すバックグラウンドライター
+    件数または時間間隔でinsert_manyし、MongoDBに接続できない間はローカルファイルに退避して後で再送する
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = UsageWriter()
+                    cls._instance.start()
+        return cls._instance
+
+    def __init__(self, batch_size=USAGE_WRITER_BATCH_SIZE, flush_interval=USAGE_WRITER_FLUSH_INTERVAL,
+                 max_buffer=USAGE_WRITER_MAX_BUFFER, spool_path=USAGE_SPOOL_PATH):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spool_path = spool_path
+
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._spool_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "spooled": 0,
+            "replayed": 0,
+            "dropped": 0,
+            "flush_errors": 0,
+            "last_flush_lag": 0.0,
+            "last_flush_at": None,
+        }
+
+    def start(self):
+        USAGE_WRITER_BUFFERED.set_function(lambda: len(self._buffer))
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, usage_data):
+        # 再送時に重複挿入を判定できるよう、_idはここで確定させる
+        usage_data.setdefault("_id", ObjectId())
+
+        with self._condition:
+            self._stats["enqueued"] += 1
+            buffer_full = len(self._buffer) >= self.max_buffer
+            if not buffer_full:
+                self._buffer.append((time.monotonic(), usage_data))
+                if len(self._buffer) >= self.batch_size:
+                    self._condition.notify()
+
+        if buffer_full:
+            self._spool([usage_data])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                if len(self._buffer) < self.batch_size:
+                    self._condition.wait(timeout=self.flush_interval)
+
+            flushed = self.flush()
+            if flushed:
+                self.replay_spool()
+
+    def _take_batch(self):
+        with self._condition:
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            return batch
+
+    def flush(self):
+        """
+        バッファの内容をすべて書き込む
+        書き込みに失敗した分はスプールファイルに退避し、Falseを返す
+        """
+        success = True
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return success
+
+            oldest_enqueued_at = batch[0][0]
+            records = [record for _, record in batch]
+
+            if self._insert_many(records):
+                with self._condition:
+                    self._stats["written"] += len(records)
+                    self._stats["last_flush_lag"] = time.monotonic() - oldest_enqueued_at
+                    self._stats["last_flush_at"] = time.time()
+            else:
+                self._spool(records)
+                success = False
+
+    def _insert_many(self, records):
+        # 書き込み済みか判定できなかったバッチを再送しても重複しないよう、同じ_idは読み飛ばす
+        # 増分バックアップは作成日時ではなく書き込んだ日時で判定するため、再送のたびに記録し直す
+        inserted_at = datetime.datetime.now()
+        for record in records:
+            record["inserted_at"] = inserted_at
+        try:
+            with start_span("usage_insert_many", count=len(records)):
+                insert_new_documents(get_usage_collection(), records)
+            return True
+        except Exception as e:
+            print(f"利用状況の書き込みに失敗しました: {str(e)}")
+            with self._condition:
+                self._stats["flush_errors"] += 1
+            return False
+
+    def _spool(self, records):
+        try:
+            with self._spool_lock:
+                os.makedirs(os.path.dirname(self.spool_path), exist_ok=True)
+                with open(self.spool_path, "a", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json_util.dumps(record, ensure_ascii=False) + "\n")
+            with self._condition:
+                self._stats["spooled"] += len(records)
+        except Exception as e:
+            print(f"利用状況の退避に失敗しました: {str(e)}")
+            with self._condition:
+                self._stats["dropped"] += len(records)
+            USAGE_WRITER_DROPPED.inc(len(records))
+
+    def replay_spool(self):
+        """
+        スプールファイルに退避した利用状況を再送する
+        """
+        replay_path = f"{self.spool_path}.replaying"
+        with self._spool_lock:
+            # 前回の再送途中で停止した場合は残ったファイルから再開する
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spool_path) or os.path.getsize(self.spool_path) == 0:
+                    return
+                os.replace(self.spool_path, replay_path)
+
+        pending = []
+        failed = False
+        with open(replay_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                pending.append(json_util.loads(line))
+                if len(pending) >= self.batch_size:
+                    if not self._replay_batch(pending):
+                        failed = True
+                        break
+                    pending = []
+            if failed:
+                pending.extend(json_util.loads(line) for line in f if line.strip())
+
+        if pending and (failed or not self._replay_batch(pending)):
+            self._spool(pending)
+            with self._condition:
+                self._stats["spooled"] -= len(pending)
+
+        os.remove(replay_path)
+
+    def _replay_batch(self, records):
+        if self._insert_many(records):
+            with self._condition:
+                self._stats["replayed"] += len(records)
+            return True
+        return False
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._buffer)
+            stats["flush_lag"] = time.monotonic() - self._buffer[0][0] if self._buffer else 0.0
+
+        with self._spool_lock:
+            stats["spool_bytes"] = os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0
+
+        return stats
+
+    def close(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+        self.flush()
@@ -0,0 +1,53 @@
+import pytest
+
+from tests.test_text_processor import GOLDEN_CASES, load_golden
+from utils.text_processor import IncrementalSectionParser, parse_discharge_summary
+
+
+def test_header_split_across_chunks():
+    parser = IncrementalSectionParser()
+    assert parser.feed("・入院期間\n2024年4月1日〜\n・入院中の治") == {"入院期間": "2024年4月1日〜"}
+    assert parser.feed("療経過\n抗菌薬で加療した。\n") == {"入院中の治療経過": "抗菌薬で加療した。"}
+    parser.finish()
+
+    sections = parser.get_sections()
+    assert sections["入院期間"] == "2024年4月1日〜"
+    assert sections["入院中の治療経過"] == "抗菌薬で加療した。"
+    assert "入院中の治" not in sections["入院期間"]
+
+
+def test_chunk_without_trailing_newline_is_held_until_finish():
+    parser = IncrementalSectionParser()
+    assert parser.feed("・備考\n特記事項な") == {}
+    assert parser.get_sections()["備考"] == ""
+    assert parser.feed("し") == {}
+    assert parser.finish() == {"備考": "特記事項なし"}
+    assert parser.get_sections()["備考"] == "特記事項なし"
+
+
+def test_header_with_body_replaces_earlier_content():
+    parser = IncrementalSectionParser()
+    parser.feed("・現病歴\n発熱\n")
+    assert parser.feed("現病歴：咳嗽\n") == {"現病歴": "咳嗽"}
+    parser.finish()
+    assert parser.get_sections()["現病歴"] == "咳嗽"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+@pytest.mark.parametrize("name", GOLDEN_CASES)
+def test_feed_and_finish_match_parse_discharge_summary(name, chunk_size):
+    text, extra_sections, _ = load_golden(name)
+    parser = IncrementalSectionParser(extra_sections)
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+    parser.finish()
+    assert parser.get_sections() == parse_discharge_summary(text, extra_sections)
+
+
+def test_text_without_trailing_newline_matches_parse_discharge_summary():
+    text = "・入院期間\n2024年4月1日〜2024年4月14日\n・備考\n特になし"
+    parser = IncrementalSectionParser()
+    for chunk in ["・入院期", "間\n2024年4月1日〜", "2024年4月14日\n・備考\n特に", "なし"]:
+        parser.feed(chunk)
+    parser.finish()
+    assert parser.get_sections() == parse_discharge_summary(text)
@@ -0,0 +1,55 @@
+import pytest
+
+from utils.input_compaction import compact_input_text, remove_empty_template_lines
+
+
+@pytest.mark.parametrize("paragraph", [
+    "内服薬\nアスピリン(中止)",
+    "アレルギー\nペニシリン(発疹)",
+    "内服薬：\nアスピリン(中止)",
+    "処方\nロキソプロフェン（頓用）\nレバミピド［食後］",
+    "既往歴\n高血圧【治療中】",
+])
+def test_values_ending_with_brackets_are_kept(paragraph):
+    assert remove_empty_template_lines(paragraph) == paragraph
+
+
+@pytest.mark.parametrize("paragraph, expected", [
+    ("主訴：\n既往歴:\n現病歴：\n咳嗽", "現病歴：\n咳嗽"),
+    ("【家族歴】\n[社会歴]\n［生活歴］：", ""),
+    ("現病歴\n咳嗽\n主訴：", "現病歴\n咳嗽"),
+])
+def test_empty_labels_are_removed(paragraph, expected):
+    assert remove_empty_template_lines(paragraph) == expected
+
+
+def test_compaction_keeps_medication_and_allergy_lines():
+    text = "内服薬\nアスピリン(中止)\n\nアレルギー\nペニシリン(発疹)\n\n主訴：\n\n\n\n内服薬\nアスピリン(中止)"
+    compacted_text, chars_saved = compact_input_text(text)
+    assert compacted_text == "内服薬\nアスピリン(中止)\n\nアレルギー\nペニシリン(発疹)"
+    assert chars_saved == len(text) - len(compacted_text)
+
+
+NOTE_BEFORE = "夜間の経過：22時に入眠し、朝まで中途覚醒なく経過した。せん妄の出現なし。転倒・転落なし。食事は全量摂取した。"
+NOTE_AFTER = "夜間の経過：22時に入眠し、朝まで中途覚醒なく経過した。せん妄の出現あり。転倒・転落なし。食事は全量摂取した。"
+
+
+@pytest.mark.parametrize("before, after", [
+    (NOTE_BEFORE, NOTE_AFTER),
+    (NOTE_BEFORE, NOTE_BEFORE.replace("転倒・転落なし", "転倒・転落あり")),
+    (NOTE_BEFORE, NOTE_BEFORE.replace("全量摂取した", "全量摂取しなかった")),
+])
+def test_paragraphs_differing_in_a_finding_are_kept_by_default(before, after):
+    compacted_text, _ = compact_input_text(f"{before}\n\n{after}")
+    assert compacted_text == f"{before}\n\n{after}"
+
+
+def test_exact_duplicates_are_removed_by_default():
+    compacted_text, _ = compact_input_text(f"{NOTE_BEFORE}\n\n{NOTE_BEFORE}")
+    assert compacted_text == NOTE_BEFORE
+
+
+def test_near_duplicates_are_removed_only_when_enabled():
+    compacted_text, _ = compact_input_text(f"{NOTE_BEFORE}\n\n{NOTE_AFTER}", remove_near_duplicates=True,
+                                          near_duplicate_threshold=0.75)
+    assert compacted_text == NOTE_BEFORE
@@ -0,0 +1,34 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from utils.config import get_config
+from utils.text_processor import IncrementalSectionParser, extract_section_names, parse_discharge_summary
+
+GOLDEN_DIR = Path(__file__).parent / "golden" / "sections"
+GOLDEN_CASES = sorted(path.stem for path in GOLDEN_DIR.glob("*.txt"))
+
+
+def load_golden(name):
+    text = (GOLDEN_DIR / f"{name}.txt").read_text(encoding="utf-8")
+    expected = json.loads((GOLDEN_DIR / f"{name}.json").read_text(encoding="utf-8"))
+    return text, expected["extra_sections"], expected["sections"]
+
+
+@pytest.mark.parametrize("name", GOLDEN_CASES)
+def test_parse_discharge_summary_golden(name):
+    text, extra_sections, sections = load_golden(name)
+    assert parse_discharge_summary(text, extra_sections) == sections
+
+
+def test_golden_covers_default_prompt_sections():
+    _, _, sections = load_golden("default_prompt")
+    section_names = extract_section_names(get_config()['PROMPTS']['discharge_summary'])
+    assert set(section_names) <= set(sections)
+
+
+@pytest.mark.parametrize("name", GOLDEN_CASES)
+def test_parser_parse_matches_parse_discharge_summary(name):
+    text, extra_sections, sections = load_golden(name)
+    assert IncrementalSectionParser(extra_sections).parse(text) == sections
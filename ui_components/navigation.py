@@ -1,11 +1,13 @@
-import datetime
+import uuid
 
 import streamlit as st
 
-from database.db import get_settings_collection
-from utils.config import GEMINI_MODEL, GEMINI_CREDENTIALS, GEMINI_FLASH_MODEL, CLAUDE_API_KEY, OPENAI_API_KEY, OPENAI_MODEL, SELECTED_AI_MODEL
+from services.settings_writer import LEGACY_SETTING_ID, UserSettingsWriter, get_setting_id
+from utils.config import GEMINI_MODEL, GEMINI_CREDENTIALS, GEMINI_FLASH_MODEL, CLAUDE_API_KEY, OPENAI_API_KEY, OPENAI_MODEL, SELECTED_AI_MODEL, USER_ID_HEADER
 from utils.prompt_manager import get_all_departments, get_department_by_name
 
+SESSION_USER_ID_KEY = "session_user_id"
+
 def change_page(page):
     st.session_state.current_page = page
 
@@ -102,25 +104,44 @@ def render_sidebar():
         st.rerun()
 
 
+def get_user_id():
+    """
+    USER_ID_HEADERのヘッダーから利用者IDを返す
+    設定されていない場合やヘッダーがない場合は、このセッションだけで使うIDを返す
+    """
+    user_id = st.context.headers.get(USER_ID_HEADER) if USER_ID_HEADER else None
+    if user_id:
+        return user_id
+
+    if SESSION_USER_ID_KEY not in st.session_state:
+        st.session_state[SESSION_USER_ID_KEY] = f"session:{uuid.uuid4().hex}"
+    return st.session_state[SESSION_USER_ID_KEY]
+
+
 def save_user_settings(department, model):
+    """
+    利用者ごとの設定としてまとめて書き込む
+    利用者を識別できない場合はセッションごとの設定とし、同時に使う他の利用者の設定は上書きしない
+    """
+    user_id = get_user_id()
+
     try:
-        settings_collection = get_settings_collection()
-        settings_collection.update_one(
-            {"setting_id": "user_preferences"},
-            {"$set": {
-                "selected_department": department,
-                "selected_model": model,
-                "updated_at": datetime.datetime.now()
-            }},
-            upsert=True
+        UserSettingsWriter.get_instance().update(
+            get_setting_id(user_id),
+            {"user_id": user_id, "selected_department": department, "selected_model": model}
         )
     except Exception as e:
         print(f"設定の保存に失敗しました: {str(e)}")
 
 def load_user_settings():
+    """
+    利用者ごとの設定を返す。保存されていない場合は、以前の全員共通の設定を初期値として使う
+    """
     try:
-        settings_collection = get_settings_collection()
-        settings = settings_collection.find_one({"setting_id": "user_preferences"})
+        writer = UserSettingsWriter.get_instance()
+        settings = writer.get(get_setting_id(get_user_id()))
+        if not settings:
+            settings = writer.get(LEGACY_SETTING_ID)
         if settings:
             return settings.get("selected_department"), settings.get("selected_model")
         return None, None
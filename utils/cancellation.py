@@ -0,0 +1,45 @@
+import threading
+
+
+class CancellationToken:
+    """
+    実行中のサマリ作成を別スレッドから中断するためのトークン
+    registerしたコールバック(HTTPストリームのcloseなど)はcancel時に呼び出される
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self):
+        self.run_callbacks(self.mark_cancelled())
+
+    def mark_cancelled(self):
+        """
+        キャンセル済みにし、呼び出すコールバックを返す。呼び出し元のロックを保持したまま印を付け、
+        ストリームのcloseなど時間のかかるコールバックはロックの外でrun_callbacksに渡す
+        """
+        with self._lock:
+            if self._event.is_set():
+                return []
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            return callbacks
+
+    def run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"キャンセル処理中にエラーが発生しました: {str(e)}")
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def register(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
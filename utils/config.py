@@ -18,10 +18,18 @@ def get_config():
 load_dotenv()
 
 MONGODB_URI = os.environ.get("MONGODB_URI")
+# 統計情報の集計を別のクラスター(分析用ノードなど)で行う場合に設定する
+MONGODB_ANALYTICS_URI = os.environ.get("MONGODB_ANALYTICS_URI")
 MONGODB_DB_NAME = os.environ.get("MONGODB_DB_NAME")
 MONGODB_USERS_COLLECTION = os.environ.get("MONGODB_USERS_COLLECTION")
 MONGODB_PROMPTS_COLLECTION = os.environ.get("MONGODB_PROMPTS_COLLECTION", "prompts")
 MONGODB_DEPARTMENTS_COLLECTION = os.environ.get("MONGODB_DEPARTMENTS_COLLECTION", "departments")
+# 時系列コレクションへ移行した後は、移行先のコレクション名を設定する
+MONGODB_USAGE_COLLECTION = os.environ.get("MONGODB_USAGE_COLLECTION", "summary_usage")
+
+# mongodb: MONGODB_URIのサーバーに保存する / sqlite: SQLITE_PATHのファイルに保存する (単一サーバー・オフライン用)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mongodb")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(Path(__file__).parent.parent, "data", "app.db"))
 
 GEMINI_CREDENTIALS = os.environ.get("GEMINI_CREDENTIALS")
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL")
@@ -38,3 +46,40 @@ SELECTED_AI_MODEL = os.environ.get("SELECTED_AI_MODEL", "gemini")
 
 MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", "200000"))
 MIN_INPUT_TOKENS = int(os.environ.get("MIN_INPUT_TOKENS", "100"))
+
+# text: 自由記述を見出しで分割する / json: 見出しをキーとするJSONをスキーマ指定で出力させる
+SUMMARY_OUTPUT_MODE = os.environ.get("SUMMARY_OUTPUT_MODE", "text")
+SECTION_REGENERATION_MAX_TOKENS = int(os.environ.get("SECTION_REGENERATION_MAX_TOKENS", "1500"))
+
+GENERATION_MAX_IN_FLIGHT = int(os.environ.get("GENERATION_MAX_IN_FLIGHT", "4"))
+GENERATION_MAX_IN_FLIGHT_BY_PROVIDER = {
+    provider: int(os.environ[f"GENERATION_MAX_IN_FLIGHT_{provider.upper()}"])
+    for provider in ["claude", "gemini", "openai"]
+    if os.environ.get(f"GENERATION_MAX_IN_FLIGHT_{provider.upper()}")
+}
+GENERATION_MAX_QUEUE_SIZE = int(os.environ.get("GENERATION_MAX_QUEUE_SIZE", "20"))
+
+# これ以上かかったMongoDBの操作をログに出力し、遅い操作の一覧に残す
+MONGODB_SLOW_OP_THRESHOLD_MS = float(os.environ.get("MONGODB_SLOW_OP_THRESHOLD_MS", "100"))
+MONGODB_SLOW_OP_TOP_N = int(os.environ.get("MONGODB_SLOW_OP_TOP_N", "20"))
+MONGODB_SLOW_OP_WINDOW_MINUTES = int(os.environ.get("MONGODB_SLOW_OP_WINDOW_MINUTES", "60"))
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0")) if os.environ.get("METRICS_PORT") else None
+# メトリクスには認証がなく、診療科名やトレースIDを含むため、既定ではローカルからのみ接続できるようにする
+# Prometheusが別のホストから収集する場合は METRICS_ADDR=0.0.0.0 などを指定する
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "jsonl")
+TRACING_JSONL_PATH = os.environ.get("TRACING_JSONL_PATH", os.path.join(Path(__file__).parent.parent, "traces", "spans.jsonl"))
+TRACING_OTLP_ENDPOINT = os.environ.get("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "discharge-summary-app")
+
+# 利用者ごとに設定を保存する場合、認証プロキシが利用者IDを渡すHTTPヘッダー名 (例: X-Forwarded-User)
+USER_ID_HEADER = os.environ.get("USER_ID_HEADER", "")
+USER_SETTINGS_DEBOUNCE_SECONDS = float(os.environ.get("USER_SETTINGS_DEBOUNCE_SECONDS", "2"))
+USER_SETTINGS_MAX_DELAY_SECONDS = float(os.environ.get("USER_SETTINGS_MAX_DELAY_SECONDS", "10"))
+
+USAGE_WRITER_BATCH_SIZE = int(os.environ.get("USAGE_WRITER_BATCH_SIZE", "50"))
+USAGE_WRITER_FLUSH_INTERVAL = float(os.environ.get("USAGE_WRITER_FLUSH_INTERVAL", "5"))
+USAGE_WRITER_MAX_BUFFER = int(os.environ.get("USAGE_WRITER_MAX_BUFFER", "10000"))
+USAGE_SPOOL_PATH = os.environ.get("USAGE_SPOOL_PATH", os.path.join(Path(__file__).parent.parent, "spool", "summary_usage.jsonl"))
@@ -15,10 +15,26 @@ MESSAGES = {
     "CLAUDE_API_CREDENTIALS_MISSING": "⚠️ Claude APIの認証情報が設定されていません。環境変数を確認してください。",
     "OPENAI_API_CREDENTIALS_MISSING": "⚠️ OpenAI APIの認証情報が設定されていません。環境変数を確認してください。",
     "NO_API_CREDENTIALS": "⚠️ 使用可能なAI APIの認証情報が設定されていません。環境変数を確認してください。",
+    "GENERATION_QUEUE_FULL": "⚠️ 現在サマリ作成の待ちが多いため受け付けできません。しばらくしてから再度お試しください。",
+    "NO_SUMMARY_TO_REGENERATE": "⚠️ 再作成の元になるサマリがありません。先にサマリを作成してください。",
+    "NO_SUMMARY_TO_UPDATE": "⚠️ 更新の元になるサマリがありません。先にサマリを作成してください。",
+    "NO_NEW_INPUT": "⚠️ 前回のサマリ作成以降に追加されたカルテ記載がありません",
+}
+
+MODEL_PROVIDERS = {
+    "Claude": "claude",
+    "Gemini_Pro": "gemini",
+    "Gemini_Flash": "gemini",
+    "GPT4.1": "openai",
 }
 
 DEFAULT_DEPARTMENTS = ["内科", "消化器内科", "整形外科", "眼科"]
 DEFAULT_SECTION_NAMES = ["入院期間", "現病歴", "入院時検査", "入院中の治療経過", "退院申し送り", "備考"]
+SECTION_ALIASES = {
+    "禁忌・アレルギー": "禁忌/アレルギー",
+}
+
+STRUCTURED_OUTPUT_INSTRUCTION = "出力は各見出しをキー、その内容を値とするJSONのみとしてください。値には見出し名や記号、Markdown記法を含めないでください。"
 
 APP_TYPE = "discharge_summary"
 DOCUMENT_NAME = "退院時サマリ"
@@ -2,20 +2,22 @@ import streamlit as st
 
 from utils.exceptions import AppError, APIError, DatabaseError
 
+
+def get_error_message(e):
+    if isinstance(e, APIError):
+        return f"API接続エラー: {str(e)}"
+    if isinstance(e, DatabaseError):
+        return f"データベースエラー: {str(e)}"
+    if isinstance(e, AppError):
+        return f"エラーが発生しました: {str(e)}"
+    return f"予期しないエラー: {str(e)}"
+
+
 def handle_error(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except APIError as e:
-            st.error(f"API接続エラー: {str(e)}")
-            return None
-        except DatabaseError as e:
-            st.error(f"データベースエラー: {str(e)}")
-            return None
-        except AppError as e:
-            st.error(f"エラーが発生しました: {str(e)}")
-            return None
         except Exception as e:
-            st.error(f"予期しないエラー: {str(e)}")
+            st.error(get_error_message(e))
             return None
     return wrapper
@@ -6,3 +6,13 @@ class APIError(AppError):
 
 class DatabaseError(AppError):
     pass
+
+class QueueFullError(AppError):
+    pass
+
+class GenerationCancelledError(AppError):
+    def __init__(self, message="サマリ作成をキャンセルしました", partial_text="", input_tokens=None, output_tokens=None):
+        super().__init__(message)
+        self.partial_text = partial_text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
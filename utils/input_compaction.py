@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import re
+
+from utils.config import get_config
+
+BLANK_RUN_PATTERN = re.compile(r"\n{3,}")
+SPACE_RUN_PATTERN = re.compile(r"[ \t　\xa0]+")
+# 「主訴：」のようにコロンで終わる項目名か、「【主訴】」のように行全体が括弧で囲まれた見出しだけを項目行とする
+# 「アスピリン(中止)」のように丸括弧で終わる行は値の記載なので対象にしない
+BRACKETED_HEADING = r"(?:【[^\s【】]{1,20}】|\[[^\s\[\]]{1,20}\]|［[^\s［］]{1,20}］)"
+TEMPLATE_LABEL_PATTERN = re.compile(rf"^(?:[^\s:：]{{1,20}}[:：]|{BRACKETED_HEADING})$")
+DIGITS_PATTERN = re.compile(r"\d+(?:[.．]\d+)?")
+
+
+def load_compaction_config():
+    """
+    config.iniの[INPUT_COMPACTION]から入力圧縮の設定を読み込む関数
+    """
+    config = get_config()
+    compaction_config = config['INPUT_COMPACTION'] if 'INPUT_COMPACTION' in config else {}
+    return {
+        "enabled": str(compaction_config.get('enabled', 'true')).lower() == 'true',
+        "remove_near_duplicates": str(compaction_config.get('remove_near_duplicates', 'false')).lower() == 'true',
+        "near_duplicate_threshold": float(compaction_config.get('near_duplicate_threshold', 0.9)),
+        "shingle_size": int(compaction_config.get('shingle_size', 5)),
+        "min_paragraph_length": int(compaction_config.get('min_paragraph_length', 30)),
+    }
+
+
+def normalize_whitespace(text):
+    """
+    全角スペースや連続する空白を1つにまとめ、3行以上の空行を1行にする関数
+    """
+    lines = [SPACE_RUN_PATTERN.sub(" ", line).strip() for line in text.replace("\r\n", "\n").split("\n")]
+    return BLANK_RUN_PATTERN.sub("\n\n", "\n".join(lines)).strip()
+
+
+def remove_empty_template_lines(paragraph):
+    """
+    「主訴：」のように値が入っていないテンプレートの項目行を取り除く関数
+    項目行の次の行も項目行(または段落の末尾)であれば、値が空欄とみなす
+    """
+    lines = paragraph.split("\n")
+    is_label = [bool(TEMPLATE_LABEL_PATTERN.match(line)) for line in lines]
+    kept = [
+        line for i, line in enumerate(lines)
+        if not (is_label[i] and (i + 1 == len(lines) or is_label[i + 1]))
+    ]
+    return "\n".join(kept)
+
+
+def get_shingles(text, shingle_size):
+    compact_text = re.sub(r"\s", "", text)
+    if len(compact_text) <= shingle_size:
+        return {compact_text}
+    return {compact_text[i:i + shingle_size] for i in range(len(compact_text) - shingle_size + 1)}
+
+
+def jaccard_similarity(shingles_a, shingles_b):
+    if not shingles_a or not shingles_b:
+        return 0.0
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+
+def compact_input_text(text, remove_near_duplicates=False, near_duplicate_threshold=0.9, shingle_size=5,
+                       min_paragraph_length=30):
+    """
+    カルテ記載から空白の重複、値のないテンプレート行、完全一致する段落を取り除く
+    remove_near_duplicatesの場合はほぼ一致する段落も除く。「なし」が「あり」に変わったような所見の変化も
+    ほぼ一致とみなして除くことがあるため、既定では行わない。数値が異なる段落はほぼ一致でも残す
+    圧縮後のテキストと、除いた文字数を返す(トークン数ではない)
+    """
+    normalized_text = normalize_whitespace(text)
+
+    kept_paragraphs = []
+    seen_exact = set()
+    # 数値の並びごとに、残した段落のシングルを保持する
+    kept_shingles = {}
+
+    for paragraph in normalized_text.split("\n\n"):
+        paragraph = remove_empty_template_lines(paragraph)
+        if not paragraph:
+            continue
+
+        exact_key = re.sub(r"\s", "", paragraph)
+        if exact_key in seen_exact:
+            continue
+        seen_exact.add(exact_key)
+
+        if remove_near_duplicates and len(exact_key) >= min_paragraph_length:
+            digits_key = tuple(DIGITS_PATTERN.findall(paragraph))
+            shingles = get_shingles(paragraph, shingle_size)
+            candidates = kept_shingles.setdefault(digits_key, [])
+            if any(jaccard_similarity(shingles, kept) >= near_duplicate_threshold for kept in candidates):
+                continue
+            candidates.append(shingles)
+
+        kept_paragraphs.append(paragraph)
+
+    compacted_text = "\n\n".join(kept_paragraphs)
+    return compacted_text, max(len(text) - len(compacted_text), 0)
+
+
+def get_line_fingerprint(text):
+    """
+    カルテ記載の各行のハッシュを並べたもの。本文を保持せずに、前回から追加された行を判定するために使う
+    """
+    return [
+        hashlib.sha256(line.encode("utf-8")).hexdigest()[:16]
+        for line in normalize_whitespace(text).split("\n") if line
+    ]
+
+
+def extract_new_lines(text, previous_fingerprint):
+    """
+    前回のフィンガープリントに含まれない行だけを取り出す関数
+    前回の記載の後ろに追記された場合は追記部分を、それ以外は前回より出現回数が増えた行を返す
+    """
+    lines = [line for line in normalize_whitespace(text).split("\n") if line]
+    fingerprint = get_line_fingerprint(text)
+
+    if fingerprint[:len(previous_fingerprint)] == previous_fingerprint:
+        return "\n".join(lines[len(previous_fingerprint):])
+
+    remaining = collections.Counter(previous_fingerprint)
+    new_lines = []
+    for line, line_hash in zip(lines, fingerprint):
+        if remaining[line_hash]:
+            remaining[line_hash] -= 1
+        else:
+            new_lines.append(line)
+    return "\n".join(new_lines)
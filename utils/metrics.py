@@ -0,0 +1,127 @@
+import threading
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from utils.config import METRICS_ADDR, METRICS_PORT
+
+LATENCY_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+FIRST_TOKEN_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+MONGO_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+GENERATIONS = Counter(
+    "summary_generations_total",
+    "サマリ作成の件数",
+    ["model", "department", "status", "generation_type"]
+)
+GENERATION_LATENCY = Histogram(
+    "summary_generation_duration_seconds",
+    "受付から完了までのサマリ作成時間",
+    ["model"],
+    buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "provider_time_to_first_token_seconds",
+    "プロバイダへの要求から最初のチャンク受信までの時間",
+    ["model"],
+    buckets=FIRST_TOKEN_BUCKETS
+)
+TOKENS = Counter(
+    "summary_tokens_total",
+    "使用トークン数",
+    ["model", "direction"]
+)
+PROVIDER_ERRORS = Counter(
+    "provider_errors_total",
+    "プロバイダ呼び出しのエラー件数",
+    ["provider", "error_type"]
+)
+QUEUE_DEPTH = Gauge(
+    "generation_queue_depth",
+    "サマリ作成の待ち行列の長さ"
+)
+IN_FLIGHT = Gauge(
+    "generation_in_flight",
+    "実行中のサマリ作成数",
+    ["provider"]
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "キャッシュの参照件数",
+    ["cache", "result"]
+)
+MONGO_OPERATION_LATENCY = Histogram(
+    "mongodb_operation_duration_seconds",
+    "MongoDBコマンドの所要時間",
+    ["command", "status"],
+    buckets=MONGO_BUCKETS
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    "mongodb_pool_connections",
+    "MongoDBの接続プールの接続数 (open: 確立済み, checked_out: 使用中)",
+    ["address", "state"]
+)
+MONGO_POOL_CHECKOUT_WAIT = Histogram(
+    "mongodb_pool_checkout_wait_seconds",
+    "接続プールから接続を取り出すまでの待ち時間",
+    ["address"],
+    buckets=MONGO_BUCKETS
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "mongodb_pool_checkout_failures_total",
+    "接続プールから接続を取り出せなかった件数",
+    ["address", "reason"]
+)
+USAGE_WRITER_BUFFERED = Gauge(
+    "usage_writer_buffered",
+    "未書き込みの利用状況件数"
+)
+USAGE_WRITER_DROPPED = Counter(
+    "usage_writer_dropped_total",
+    "書き込みも退避もできなかった利用状況件数"
+)
+
+_server_started = False
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, addr=METRICS_ADDR):
+    """
+    METRICS_PORTが設定されている場合のみ、Prometheus形式のメトリクスを返すHTTPサーバーを起動する
+    Streamlitはスクリプトを再実行するため、プロセス内で一度だけ起動する
+    """
+    global _server_started
+    if not port:
+        return False
+
+    with _server_lock:
+        if _server_started:
+            return True
+        try:
+            start_http_server(port, addr=addr)
+            _server_started = True
+            print(f"メトリクスサーバーを起動しました: {addr}:{port}")
+        except OSError as e:
+            print(f"メトリクスサーバーの起動に失敗しました: {str(e)}")
+    return _server_started
+
+
+def record_generation(model, department, status, generation_type, duration, input_tokens, output_tokens):
+    model = str(model)
+    GENERATIONS.labels(model, department, status, generation_type).inc()
+    GENERATION_LATENCY.labels(model).observe(duration)
+    if input_tokens:
+        TOKENS.labels(model, "input").inc(input_tokens)
+    if output_tokens:
+        TOKENS.labels(model, "output").inc(output_tokens)
+
+
+def record_time_to_first_token(model, seconds):
+    TIME_TO_FIRST_TOKEN.labels(str(model)).observe(seconds)
+
+
+def record_provider_error(provider, error):
+    PROVIDER_ERRORS.labels(provider, type(error).__name__).inc()
+
+
+def record_cache_request(cache_name, hit):
+    CACHE_REQUESTS.labels(cache_name, "hit" if hit else "miss").inc()
@@ -1,18 +1,24 @@
 import datetime
 import os
+import time
 
 from pymongo import MongoClient
 
-from database.db import DatabaseManager
+from database.db import get_database_manager, get_tombstone_collection
 from utils.config import get_config, MONGODB_URI
 from utils.constants import DEFAULT_DEPARTMENTS, MESSAGES
 from utils.env_loader import load_environment_variables
 from utils.exceptions import DatabaseError, AppError
+from utils.metrics import record_cache_request
+from utils.text_processor import extract_section_names
+
+SECTION_NAMES_CACHE_TTL = 300
+_section_names_cache = {}
 
 
 def get_prompt_collection():
     try:
-        db_manager = DatabaseManager.get_instance()
+        db_manager = get_database_manager()
         collection_name = os.environ.get("MONGODB_PROMPTS_COLLECTION", "prompts")
         return db_manager.get_collection(collection_name)
     except Exception as e:
@@ -21,7 +27,7 @@ def get_prompt_collection():
 
 def get_department_collection():
     try:
-        db_manager = DatabaseManager.get_instance()
+        db_manager = get_database_manager()
         collection_name = os.environ.get("MONGODB_DEPARTMENTS_COLLECTION", "departments")
         return db_manager.get_collection(collection_name)
     except Exception as e:
@@ -56,6 +62,19 @@ def update_document(collection, query, update_data):
         raise DatabaseError(f"ドキュメントの更新に失敗しました: {str(e)}")
 
 
+def record_deletions(collection_name, keys):
+    """
+    増分バックアップで削除を復元できるよう、削除したドキュメントのキーを記録する関数
+    """
+    try:
+        now = get_current_datetime()
+        get_tombstone_collection().insert_many(
+            [{"collection": collection_name, "key": key, "deleted_at": now} for key in keys]
+        )
+    except Exception as e:
+        print(f"削除の記録に失敗しました: {str(e)}")
+
+
 def initialize_departments():
     try:
         department_collection = get_department_collection()
@@ -123,6 +142,8 @@ def delete_department(name):
             return False, "診療科が見つかりません"
 
         prompt_collection.delete_many({"department": name})
+        record_deletions("departments", [{"name": name}])
+        record_deletions("prompts", [{"department": name}])
 
         return True, "診療科を削除しました"
     except DatabaseError as e:
@@ -141,15 +162,17 @@ def update_department_order(name, new_order):
 
         current_order = current.get("order", 0)
 
+        # 増分バックアップの対象になるよう、順序がずれた診療科もupdated_atを更新する
+        now = get_current_datetime()
         if new_order > current_order:
             department_collection.update_many(
                 {"order": {"$gt": current_order, "$lte": new_order}},
-                {"$inc": {"order": -1}}
+                {"$inc": {"order": -1}, "$set": {"updated_at": now}}
             )
         else:
             department_collection.update_many(
                 {"order": {"$gte": new_order, "$lt": current_order}},
-                {"$inc": {"order": 1}}
+                {"$inc": {"order": 1}, "$set": {"updated_at": now}}
             )
 
         update_document(
@@ -173,13 +196,13 @@ def get_department_by_name(name):
         raise DatabaseError(f"診療科の取得に失敗しました: {str(e)}")
 
 
-def update_department(name, default_model):
+def update_department(name, default_model, input_compaction=True):
     try:
         department_collection = get_department_collection()
         update_document(
             department_collection,
             {"name": name},
-            {"default_model": default_model}
+            {"default_model": default_model, "input_compaction": input_compaction}
         )
         return True, "診療科を更新しました"
     except DatabaseError as e:
@@ -221,6 +244,29 @@ def get_prompt_by_department(department="default"):
         raise DatabaseError(f"プロンプトの取得に失敗しました: {str(e)}")
 
 
+def get_department_section_names(department="default"):
+    """
+    診療科のプロンプトに記載された見出し名を返す関数
+    サマリ作成のたびにプロンプトを再取得しないよう、一定時間キャッシュする
+    """
+    cached = _section_names_cache.get(department)
+    now = time.monotonic()
+    if cached and now - cached[0] < SECTION_NAMES_CACHE_TTL:
+        record_cache_request("section_names", True)
+        return cached[1]
+
+    record_cache_request("section_names", False)
+    prompt = get_prompt_by_department(department)
+    if prompt:
+        prompt_content = prompt.get("content", "")
+    else:
+        prompt_content = get_config()['PROMPTS']['discharge_summary']
+
+    section_names = extract_section_names(prompt_content)
+    _section_names_cache[department] = (now, section_names)
+    return section_names
+
+
 def get_all_prompts():
     try:
         prompt_collection = get_prompt_collection()
@@ -236,6 +282,7 @@ def create_or_update_prompt(department, name, content):
 
         prompt_collection = get_prompt_collection()
         existing = prompt_collection.find_one({"department": department})
+        _section_names_cache.pop(department, None)
 
         if existing:
             # 更新
@@ -272,11 +319,14 @@ def delete_prompt(department):
         department_collection = get_department_collection()
 
         result = prompt_collection.delete_one({"department": department})
+        _section_names_cache.pop(department, None)
 
         if result.deleted_count == 0:
             return False, "プロンプトが見つかりません"
 
         department_collection.delete_one({"name": department})
+        record_deletions("prompts", [{"department": department}])
+        record_deletions("departments", [{"name": department}])
 
         return True, "プロンプトと関連する診療科を削除しました"
     except DatabaseError as e:
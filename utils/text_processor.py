@@ -1,50 +1,168 @@
-from utils.constants import DEFAULT_SECTION_NAMES
+import functools
+import json
+import re
+
+from utils.constants import DEFAULT_SECTION_NAMES, SECTION_ALIASES
+
+FORMAT_REMOVE_TABLE = str.maketrans('', '', '*＊# ')
+
+HEADER_MARKERS = r"[・●○■□◆◇▪\-－【\[［(（〈<]*"
+HEADER_NUMBERING = r"(?:\d+[.)．）、]|[①-⑳])?"
+HEADER_CLOSERS = r"[】\]］)）〉>]*"
 
 
 def format_discharge_summary(summary_text):
-    processed_text = (
-        summary_text.replace('*', '')
-        .replace('＊', '')
-        .replace('#', '')
-        .replace(' ', '')
+    return summary_text.translate(FORMAT_REMOVE_TABLE)
+
+
+def extract_section_names(prompt_template):
+    """
+    プロンプトのフォーマット指定(「・」または【】で始まる行)から見出し名を取り出す関数
+    """
+    section_names = []
+    for line in (prompt_template or "").splitlines():
+        match = re.match(r"^\s*(?:・|【)\s*([^】(（:：\s]+)", line)
+        if match and match.group(1) not in section_names:
+            section_names.append(match.group(1))
+    return section_names
+
+
+@functools.lru_cache(maxsize=64)
+def compile_section_pattern(section_names):
+    """
+    見出し名の選択肢をひとつにまとめた正規表現を作る
+    行頭(記号・番号の後)にある見出しだけを対象とし、直後がひらがなの場合は本文とみなす
+    """
+    names = sorted(set(section_names) | set(SECTION_ALIASES), key=len, reverse=True)
+    alternation = "|".join(re.escape(name) for name in names)
+    return re.compile(
+        rf"^{HEADER_MARKERS}{HEADER_NUMBERING}{HEADER_MARKERS}(?P<name>{alternation})(?![ぁ-ん])"
+        rf"{HEADER_CLOSERS}[:：]?(?P<rest>.*)$"
     )
 
-    return processed_text
 
+def get_section_names(extra_sections=None):
+    section_names = list(DEFAULT_SECTION_NAMES)
+    for section in extra_sections or []:
+        section = SECTION_ALIASES.get(section, section)
+        if section not in section_names:
+            section_names.append(section)
+    return tuple(section_names)
+
+
+class IncrementalSectionParser:
+    """
+    ストリーミング中のテキストを受け取りながら見出しごとに振り分けるパーサー
+    行の途中で区切られたチャンクは改行が届くまで保留するため、見出しがチャンクをまたいでも正しく判定できる
+    """
+
+    def __init__(self, extra_sections=None):
+        self.section_names = get_section_names(extra_sections)
+        self.pattern = compile_section_pattern(self.section_names)
+        self.section_lines = {section: [] for section in self.section_names}
+        self.current_section = None
+        self.pending = ""
+
+    def feed(self, chunk):
+        """
+        チャンクを追加し、このチャンクで確定した見出しごとの追加分を返す
+        同じ見出しが本文付きで再び現れた場合は内容が置き換わるため、全体はget_sectionsで取得する
+        """
+        lines = (self.pending + chunk).split("\n")
+        self.pending = lines.pop()
+        return self._process_lines(lines)
+
+    def finish(self):
+        """
+        保留中の最終行を確定させる
+        """
+        lines = [self.pending] if self.pending else []
+        self.pending = ""
+        return self._process_lines(lines)
+
+    def parse(self, text):
+        """
+        全文をまとめて振り分け、見出しごとの内容を返す
+        """
+        self.feed(text)
+        self.finish()
+        return self.get_sections()
 
-def parse_discharge_summary(summary_text):
-    sections = {section: "" for section in DEFAULT_SECTION_NAMES}
+    def _process_lines(self, lines):
+        deltas = {}
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
 
-    section_aliases = {
-        "禁忌・アレルギー": "禁忌/アレルギー"
+            match = self.pattern.match(line)
+            if match:
+                self.current_section = SECTION_ALIASES.get(match.group("name"), match.group("name"))
+                current_lines = self.section_lines.setdefault(self.current_section, [])
+                rest = match.group("rest").strip()
+                if rest:
+                    current_lines[:] = [rest]
+                    deltas[self.current_section] = rest
+            elif self.current_section is not None:
+                self.section_lines[self.current_section].append(line)
+                delta = deltas.get(self.current_section)
+                deltas[self.current_section] = f"{delta}\n{line}" if delta else line
+        return deltas
+
+    def get_sections(self):
+        return {section: "\n".join(lines) for section, lines in self.section_lines.items()}
+
+
+def strip_section_header(section_text, section):
+    """
+    項目単位で再作成した出力の先頭に見出しが含まれていれば取り除く関数
+    """
+    section_text = format_discharge_summary(section_text).strip()
+    first_line, _, remaining = section_text.partition("\n")
+    match = compile_section_pattern((section,)).match(first_line.strip())
+    if match and SECTION_ALIASES.get(match.group("name"), match.group("name")) == section:
+        return "\n".join(part for part in [match.group("rest").strip(), remaining.strip()] if part)
+    return section_text
+
+
+def parse_discharge_summary(summary_text, extra_sections=None):
+    return IncrementalSectionParser(extra_sections).parse(summary_text)
+
+
+def build_summary_json_schema(section_names):
+    """
+    見出しごとの文字列を必須とするJSONスキーマを作る関数
+    """
+    return {
+        "type": "object",
+        "properties": {section: {"type": "string"} for section in section_names},
+        "required": list(section_names),
+        "additionalProperties": False,
     }
 
-    lines = summary_text.split('\n')
-    current_section = None
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
-        found_section = False
-        for section in list(sections.keys()) + list(section_aliases.keys()):
-            if section in line:
-                if section in section_aliases:
-                    current_section = section_aliases[section]
-                else:
-                    current_section = section
-
-                line = line.replace(section, "").replace(":", "").strip()
-                found_section = True
-                break
-
-        if current_section and line and not found_section:
-            if sections[current_section]:
-                sections[current_section] += "\n" + line
-            else:
-                sections[current_section] = line
-        elif current_section and line and found_section:
-            sections[current_section] = line
-
-    return sections
+
+def parse_structured_summary(summary_json, section_names):
+    """
+    スキーマ指定で出力させたJSONを見出しごとの辞書にする。形式が合わない場合はValueErrorを送出する
+    """
+    sections = json.loads(summary_json) if isinstance(summary_json, str) else summary_json
+    if not isinstance(sections, dict):
+        raise ValueError("サマリのJSONがオブジェクトではありません")
+
+    missing = [section for section in section_names if section not in sections]
+    if missing:
+        raise ValueError(f"サマリのJSONに見出しがありません: {', '.join(missing)}")
+
+    parsed_summary = {}
+    for section in section_names:
+        if not isinstance(sections[section], str):
+            raise ValueError(f"サマリのJSONの値が文字列ではありません: {section}")
+        parsed_summary[section] = sections[section].strip()
+    return parsed_summary
+
+
+def join_summary_sections(parsed_summary):
+    """
+    見出しごとの内容を全文表示用のテキストにまとめる関数
+    """
+    return "\n\n".join(f"{section}\n{content}" for section, content in parsed_summary.items() if content)
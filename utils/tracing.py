@@ -0,0 +1,232 @@
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+
+import requests
+
+from utils.config import TRACING_EXPORTER, TRACING_JSONL_PATH, TRACING_OTLP_ENDPOINT, TRACING_SERVICE_NAME
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_trace_id():
+    return secrets.token_hex(16)
+
+
+def new_span_id():
+    return secrets.token_hex(8)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        if self.end_time_ns is None:
+            self.end_time_ns = time.time_ns()
+
+    @property
+    def duration_ms(self):
+        end_time_ns = self.end_time_ns or time.time_ns()
+        return (end_time_ns - self.start_time_ns) / 1_000_000
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time_ns": self.start_time_ns,
+            "end_time_ns": self.end_time_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class NoopSpanExporter:
+    def export(self, span):
+        pass
+
+
+class JsonlSpanExporter:
+    """
+    スパンを1行1JSONでローカルファイルに追記するエクスポーター
+    """
+
+    def __init__(self, path=TRACING_JSONL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"トレースの書き込みに失敗しました: {str(e)}")
+
+
+class OtlpHttpSpanExporter:
+    """
+    OTLP/HTTP(JSON)形式でコレクターへスパンを送信するエクスポーター
+    リクエスト処理を妨げないよう、送信はバックグラウンドスレッドでまとめて行う
+    """
+
+    def __init__(self, endpoint=TRACING_OTLP_ENDPOINT, service_name=TRACING_SERVICE_NAME,
+                 batch_size=50, flush_interval=5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            spans = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(spans) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    spans.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if spans:
+                self._send(spans)
+
+    @staticmethod
+    def _to_otlp_attributes(attributes):
+        otlp_attributes = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                otlp_value = {"boolValue": value}
+            elif isinstance(value, int):
+                otlp_value = {"intValue": str(value)}
+            elif isinstance(value, float):
+                otlp_value = {"doubleValue": value}
+            else:
+                otlp_value = {"stringValue": str(value)}
+            otlp_attributes.append({"key": key, "value": otlp_value})
+        return otlp_attributes
+
+    def _to_otlp_span(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_time_ns),
+            "endTimeUnixNano": str(span.end_time_ns),
+            "attributes": self._to_otlp_attributes(span.attributes),
+            "status": {"code": 2 if span.status == "error" else 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def _send(self, spans):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": self._to_otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "discharge_summary_app"},
+                    "spans": [self._to_otlp_span(span) for span in spans],
+                }],
+            }]
+        }
+        try:
+            requests.post(self.endpoint, json=payload, timeout=5)
+        except Exception as e:
+            print(f"トレースの送信に失敗しました: {str(e)}")
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def create_exporter(exporter_name=TRACING_EXPORTER):
+    match exporter_name:
+        case "jsonl":
+            return JsonlSpanExporter()
+        case "otlp":
+            return OtlpHttpSpanExporter()
+        case "none":
+            return NoopSpanExporter()
+        case _:
+            raise ValueError(f"不明なトレースエクスポーター: {exporter_name}")
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = create_exporter()
+    return _exporter
+
+
+def set_exporter(exporter):
+    global _exporter
+    with _exporter_lock:
+        _exporter = exporter
+
+
+@contextlib.contextmanager
+def start_span(name, trace_id=None, parent_id=None, **attributes):
+    """
+    処理段階ごとの所要時間を記録するスパン
+    trace_idを省略した場合は現在のスパンを親とし、親がなければ新しいトレースを開始する
+    """
+    parent = _current_span.get()
+    if trace_id is None:
+        trace_id = parent.trace_id if parent else new_trace_id()
+        parent_id = parent.span_id if parent else None
+
+    span = Span(name, trace_id, parent_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.status = "error"
+        span.set_attribute("error.type", type(e).__name__)
+        raise
+    finally:
+        span.end()
+        _current_span.reset(token)
+        get_exporter().export(span)
+
+
+def get_current_span():
+    return _current_span.get()
+
+
+def get_current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span else None
@@ -111,10 +111,15 @@ def department_management_ui():
                 index=available_models.index(current_model) if current_model in available_models else 0
             ) if available_models else None
 
+            input_compaction = st.checkbox(
+                "カルテ記載の重複を除いてから送信する",
+                value=department_data.get("input_compaction", True)
+            )
+
             submit = st.form_submit_button("保存")
 
             if submit:
-                success, message = update_department(dept, default_model)
+                success, message = update_department(dept, default_model, input_compaction)
                 if success:
                     st.success(message)
                     st.session_state.edit_dept = None
@@ -1,6 +1,7 @@
 import streamlit as st
 
-from services.summary_service import process_summary
+from services.generation_scheduler import PRIORITY_LABELS
+from services.summary_service import cancel_summary, finalize_summary, get_generation_status, process_summary, regenerate_section, update_summary
 from utils.error_handlers import handle_error
 from utils.text_processor import parse_discharge_summary
 from ui_components.navigation import render_sidebar
@@ -11,6 +12,7 @@ def clear_inputs():
     st.session_state.additional_info = "退院時処方\n(ここに貼り付け)"
     st.session_state.discharge_summary = ""
     st.session_state.parsed_summary = {}
+    st.session_state.summary_source = None
     st.session_state.summary_generation_time = None
     st.session_state.clear_input = True
 
@@ -39,13 +41,27 @@ def render_input_section():
         key="additional_info"
     )
 
-    col1, col2 = st.columns(2)
+    st.radio(
+        "優先度",
+        list(PRIORITY_LABELS.keys()),
+        format_func=lambda x: PRIORITY_LABELS[x],
+        horizontal=True,
+        key="generation_priority"
+    )
+
+    col1, col2, col3 = st.columns(3)
+    is_generating = bool(st.session_state.get("generation_job"))
 
     with col1:
-        if st.button("サマリ作成", type="primary"):
+        if st.button("サマリ作成", type="primary", disabled=is_generating):
             process_summary(input_text, additional_info)
 
     with col2:
+        if st.button("追記分でサマリ更新", disabled=is_generating or not st.session_state.get("summary_source"),
+                     help="前回のサマリに、前回以降に追記されたカルテ記載だけを反映します"):
+            update_summary(input_text, additional_info)
+
+    with col3:
         if st.button("テキストをクリア", on_click=clear_inputs):
             pass
 
@@ -53,10 +69,8 @@ def render_input_section():
 def render_summary_results():
     if st.session_state.discharge_summary:
         if st.session_state.parsed_summary:
-            tabs = st.tabs([
-                "全文", "入院期間", "現病歴", "入院時検査",
-                "入院中の治療経過", "退院申し送り", "備考"
-            ])
+            sections = list(st.session_state.parsed_summary.keys())
+            tabs = st.tabs(["全文"] + sections)
 
             with tabs[0]:
                 st.code(st.session_state.discharge_summary,
@@ -64,7 +78,7 @@ def render_summary_results():
                         height=150
                         )
 
-            sections = ["入院期間", "現病歴", "入院時検査", "入院中の治療経過", "退院申し送り", "備考"]
+            is_generating = bool(st.session_state.get("generation_job"))
             for i, section in enumerate(sections, 1):
                 with tabs[i]:
                     section_content = st.session_state.parsed_summary.get(section, "")
@@ -72,6 +86,8 @@ def render_summary_results():
                             language=None,
                             height=150
                             )
+                    st.button("この項目を再作成", key=f"regenerate_{section}", on_click=regenerate_section,
+                              args=(section,), disabled=is_generating)
 
         st.info("💡 テキストエリアの右上にマウスを合わせて左クリックでコピーできます")
 
@@ -79,8 +95,58 @@ def render_summary_results():
             processing_time = st.session_state.summary_generation_time
             st.info(f"⏱️ 処理時間: {processing_time:.0f} 秒")
 
+@st.fragment(run_every=1)
+def render_generation_status():
+    job = st.session_state.get("generation_job")
+    if not job:
+        return
+
+    if job["ticket"].done():
+        finalize_summary()
+        st.rerun()
+
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        st.info(get_generation_status(job))
+    with col2:
+        st.button("キャンセル", key="cancel_generation", on_click=cancel_summary,
+                  disabled=job["ticket"].cancel_token.is_cancelled())
+
+    if job["ticket"].progress:
+        render_partial_summary(job["ticket"].progress.get_sections())
+
+
+def render_partial_summary(partial_sections):
+    """
+    生成途中のサマリを見出しごとに表示する。見出しが出そろう前でもタブの並びが変わらないよう全見出しを表示する
+    """
+    if not any(partial_sections.values()):
+        return
+
+    sections = list(partial_sections.keys())
+    tabs = st.tabs(sections)
+    for tab, section in zip(tabs, sections):
+        with tab:
+            if partial_sections[section]:
+                st.code(partial_sections[section], language=None, height=150)
+            else:
+                st.caption("作成中...")
+
+
 @handle_error
 def main_page_app():
     render_sidebar()
     render_input_section()
+
+    if st.session_state.success_message:
+        st.info(st.session_state.success_message)
+        st.session_state.success_message = None
+
+    if st.session_state.get("error_message"):
+        st.error(st.session_state.error_message)
+        st.session_state.error_message = None
+
+    if st.session_state.get("generation_job"):
+        render_generation_status()
+
     render_summary_results()
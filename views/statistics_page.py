@@ -1,10 +1,18 @@
 import datetime
+import io
+import tempfile
+
 import pytz
 
 import pandas as pd
 import streamlit as st
 
-from database.db import get_usage_collection
+from database.db import get_usage_analytics_collection
+from database.profiler import SlowOperationProfiler
+from services.export_service import EXPORT_FORMATS, export_usage
+from services.generation_scheduler import PRIORITY_LABELS
+from services.statistics_service import TIME_BUCKET_UNITS, get_latency_by_model_and_department, get_latency_time_series, get_output_tokens_by_output_mode, get_queue_wait_by_department
+from services.usage_writer import UsageWriter
 from utils.constants import DOCUMENT_NAME_OPTIONS
 from utils.error_handlers import handle_error
 from ui_components.navigation import change_page
@@ -18,6 +26,8 @@ MODEL_MAPPING = {
     "GPT4.1": {"pattern": "gpt4.1", "exclude": None},
 }
 
+OUTPUT_MODE_LABELS = {"text": "テキスト", "json": "JSON", "json_fallback": "JSON(テキスト解析)"}
+
 
 @handle_error
 def usage_statistics_ui():
@@ -25,7 +35,7 @@ def usage_statistics_ui():
         change_page("main")
         st.rerun()
 
-    usage_collection = get_usage_collection()
+    usage_collection = get_usage_analytics_collection()
 
     col1, col2 = st.columns(2)
 
@@ -129,6 +139,9 @@ def usage_statistics_ui():
     df = pd.DataFrame(data)
     st.dataframe(df, hide_index=True)
 
+    render_latency_section(usage_collection, query)
+    render_output_mode_section(usage_collection, query)
+
     detail_data = []
     for record in records:
         model_detail = str(record.get("model_detail", "")).lower()
@@ -153,8 +166,174 @@ def usage_statistics_ui():
             "AIモデル": model_info,
             "入力トークン": record["input_tokens"],
             "出力トークン": record["output_tokens"],
-            "処理時間(秒)": round(record["processing_time"]),
+            "処理時間(秒)": round(record["processing_time"], 1),
         })
 
     detail_df = pd.DataFrame(detail_data)
     st.dataframe(detail_df, hide_index=True)
+
+    render_export_section(start_datetime, end_datetime)
+    render_usage_writer_status()
+    render_slow_operations()
+
+
+def render_latency_section(usage_collection, query):
+    with st.expander("処理時間の分析"):
+        bucket_label = st.radio("集計単位", list(TIME_BUCKET_UNITS.keys()), horizontal=True, key="latency_bucket_unit")
+
+        series_df = get_latency_time_series(usage_collection, query, TIME_BUCKET_UNITS[bucket_label])
+        if series_df.empty:
+            st.info("処理時間のデータがありません")
+            return
+
+        st.caption("モデル別 p95処理時間(秒)の推移")
+        st.line_chart(series_df.pivot_table(index="bucket", columns="model_detail", values="p95_time"))
+
+        latency_df = get_latency_by_model_and_department(usage_collection, query)
+        latency_df["department"] = latency_df["department"].replace("default", "全科共通")
+
+        st.caption("診療科・モデル別 p95処理時間(秒)")
+        st.bar_chart(latency_df.pivot_table(index="department", columns="model_detail", values="p95_time"))
+
+        st.dataframe(
+            latency_df.rename(columns={
+                "department": "診療科",
+                "model_detail": "AIモデル",
+                "count": "作成件数",
+                "avg_time": "平均(秒)",
+                "p50_time": "p50(秒)",
+                "p95_time": "p95(秒)",
+                "max_time": "最大(秒)",
+            }).round(2),
+            hide_index=True
+        )
+
+        queue_wait_df = get_queue_wait_by_department(usage_collection, query)
+        if not queue_wait_df.empty:
+            queue_wait_df["department"] = queue_wait_df["department"].replace("default", "全科共通")
+            queue_wait_df["priority"] = queue_wait_df["priority"].map(PRIORITY_LABELS)
+            st.caption("診療科・優先度別 順番待ち時間(秒)")
+            st.dataframe(
+                queue_wait_df.rename(columns={
+                    "department": "診療科",
+                    "priority": "優先度",
+                    "count": "作成件数",
+                    "avg_time": "平均(秒)",
+                    "p50_time": "p50(秒)",
+                    "p95_time": "p95(秒)",
+                    "max_time": "最大(秒)",
+                }).round(2),
+                hide_index=True
+            )
+
+
+def render_output_mode_section(usage_collection, query):
+    output_mode_df = get_output_tokens_by_output_mode(usage_collection, query)
+    if output_mode_df.empty or output_mode_df["output_mode"].nunique() < 2:
+        return
+
+    with st.expander("出力形式別のトークン数"):
+        output_mode_df["output_mode"] = output_mode_df["output_mode"].map(OUTPUT_MODE_LABELS).fillna(output_mode_df["output_mode"])
+        st.dataframe(
+            output_mode_df.rename(columns={
+                "model_detail": "AIモデル",
+                "output_mode": "出力形式",
+                "count": "作成件数",
+                "avg_input_tokens": "平均入力トークン",
+                "avg_output_tokens": "平均出力トークン",
+            }).round(0),
+            hide_index=True
+        )
+
+
+def render_usage_writer_status():
+    with st.expander("利用状況ログの書き込み状態"):
+        stats = UsageWriter.get_instance().get_stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("未書き込み", stats["buffered"])
+        col2.metric("書き込み遅延(秒)", f"{stats['flush_lag']:.1f}")
+        col3.metric("退避件数", stats["spooled"])
+        col4.metric("欠損件数", stats["dropped"])
+        st.caption(
+            f"書き込み済み: {stats['written']}件 / 再送済み: {stats['replayed']}件 / "
+            f"書き込みエラー: {stats['flush_errors']}回 / 前回の書き込み遅延: {stats['last_flush_lag']:.1f}秒"
+        )
+
+
+def render_slow_operations():
+    with st.expander("MongoDBの遅い操作"):
+        profiler = SlowOperationProfiler.get_instance()
+        st.caption(
+            f"{profiler.threshold_ms:.0f}ms以上の操作をログに出力しています。"
+            f"下表は直近{profiler.window_seconds // 60}分間で遅かった上位{profiler.top_n}件です"
+        )
+
+        slowest = profiler.get_slowest_operations()
+        if slowest:
+            slowest_df = pd.DataFrame(slowest)[["timestamp", "duration_ms", "command", "collection", "shape", "status"]]
+            st.dataframe(
+                slowest_df.rename(columns={
+                    "timestamp": "日時",
+                    "duration_ms": "所要時間(ms)",
+                    "command": "コマンド",
+                    "collection": "コレクション",
+                    "shape": "クエリの形",
+                    "status": "結果",
+                }).round(1),
+                hide_index=True
+            )
+        else:
+            st.info("記録された操作がありません")
+
+        shape_stats = profiler.get_shape_stats()
+        if shape_stats:
+            st.caption("クエリの形ごとの集計 (合計時間の長い順)")
+            shape_df = pd.DataFrame(shape_stats)[
+                ["command", "collection", "shape", "count", "avg_ms", "max_ms", "total_ms", "slow_count", "failed_count"]
+            ]
+            st.dataframe(
+                shape_df.rename(columns={
+                    "command": "コマンド",
+                    "collection": "コレクション",
+                    "shape": "クエリの形",
+                    "count": "件数",
+                    "avg_ms": "平均(ms)",
+                    "max_ms": "最大(ms)",
+                    "total_ms": "合計(ms)",
+                    "slow_count": "遅い操作",
+                    "failed_count": "エラー",
+                }).round(1),
+                hide_index=True
+            )
+
+        if st.button("記録をリセット", key="reset_slow_operations"):
+            profiler.reset()
+            st.rerun()
+
+
+def render_export_section(start_datetime, end_datetime):
+    with st.expander("利用状況のエクスポート"):
+        col1, col2 = st.columns(2)
+        with col1:
+            export_format = st.radio("形式", EXPORT_FORMATS, horizontal=True, key="usage_export_format")
+        with col2:
+            with_cost = st.checkbox("料金列を追加", key="usage_export_with_cost")
+
+        if not st.button("エクスポートファイルを作成", key="usage_export_button"):
+            return
+
+        with st.spinner("エクスポート中..."):
+            export_file = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            if export_format == "csv":
+                text_output = io.TextIOWrapper(export_file, encoding="utf-8-sig", newline="")
+                row_count = export_usage(text_output, start_datetime, end_datetime, "csv", with_cost=with_cost)
+                text_output.flush()
+                text_output.detach()
+                mime = "text/csv"
+            else:
+                row_count = export_usage(export_file, start_datetime, end_datetime, "parquet", with_cost=with_cost)
+                mime = "application/octet-stream"
+            export_file.seek(0)
+
+        file_name = f"summary_usage_{start_datetime:%Y%m%d}_{end_datetime:%Y%m%d}.{export_format}"
+        st.download_button(f"ダウンロード ({row_count}件)", export_file, file_name=file_name, mime=mime)